@@ -0,0 +1,148 @@
+from __future__ import division
+
+import heapq
+import logging
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+
+def _pearson(n, sx, sy, sxx, syy, sxy):
+    # Pearson correlation from running sums (arrays or scalars)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        cov = sxy - sx * sy / n
+        var = (sxx - sx * sx / n) * (syy - sy * sy / n)
+        return cov / np.sqrt(var)
+
+
+def _bin_ranks(counts):
+    # Mid-ranks of histogram bins
+    ends = np.cumsum(counts)
+    return ends - (counts - 1) / 2
+
+
+def _blocks(a, b, idx_a, idx_b, block_size):
+    # Matched row blocks of both networks over the shared genes, keeping the
+    # edges right of the diagonal that are present in both
+    size = len(idx_a)
+    cols = np.arange(size)
+    for start in range(0, size, block_size):
+        end = min(start + block_size, size)
+        rows_a = a.get_rows(idx_a[start:end])[:, idx_a]
+        rows_b = b.get_rows(idx_b[start:end])[:, idx_b]
+        upper = cols[None, :] > np.arange(start, end)[:, None]
+        mask = upper & np.isfinite(rows_a) & np.isfinite(rows_b)
+        yield start, end, rows_a, rows_b, mask
+
+
+def compare_dabs(a, b, block_size=500, top=100, bins=1000):
+    """Compare the edges shared by two Dabs without loading either fully.
+
+    Both networks are walked in matched blocks of rows over their shared
+    genes (open them with mmap=True to keep memory to one block). Edges
+    missing from either network are skipped.
+
+    Args:
+        a, b:       Dab objects
+        block_size: number of rows compared at once
+        top:        number of largest changed edges to report
+        bins:       histogram bins per network for the Spearman correlation,
+                    computed from binned ranks in a second pass
+
+    Returns:
+        dict report of gene overlap, global Pearson and Spearman
+        correlations, per-gene row correlations and the top changed edges
+    """
+    shared = [g for g in a.gene_list if b.get_index(g) is not None]
+    idx_a = np.array([a.get_index(g) for g in shared], dtype=np.int64)
+    idx_b = np.array([b.get_index(g) for g in shared], dtype=np.int64)
+    size = len(shared)
+    logger.info('Comparing %i shared genes', size)
+
+    # Global and per-gene running sums: n, x, y, xx, yy, xy
+    totals = np.zeros(6)
+    genes = np.zeros((6, size))
+    lows, highs = [np.inf, np.inf], [-np.inf, -np.inf]
+    heap = []
+
+    for start, end, rows_a, rows_b, mask in _blocks(a, b, idx_a, idx_b,
+                                                    block_size):
+        x = np.where(mask, rows_a, 0).astype(np.float64)
+        y = np.where(mask, rows_b, 0).astype(np.float64)
+        terms = [mask.astype(np.float64), x, y, x * x, y * y, x * y]
+        for s, t in enumerate(terms):
+            totals[s] += t.sum()
+            # Each edge belongs to the rows of both of its genes
+            genes[s, start:end] += t.sum(axis=1)
+            genes[s] += t.sum(axis=0)
+
+        if mask.any():
+            lows = [min(lows[0], rows_a[mask].min()), min(lows[1], rows_b[mask].min())]
+            highs = [max(highs[0], rows_a[mask].max()), max(highs[1], rows_b[mask].max())]
+
+            # Largest absolute changes in this block
+            rr, cc = np.nonzero(mask)
+            diff = rows_b[rr, cc] - rows_a[rr, cc]
+            k = min(top, len(diff))
+            if k:
+                best = np.argpartition(-np.abs(diff), k - 1)[:k]
+                for i in best:
+                    item = (abs(float(diff[i])), int(rr[i]) + start, int(cc[i]))
+                    if len(heap) < top:
+                        heapq.heappush(heap, item)
+                    elif item > heap[0]:
+                        heapq.heapreplace(heap, item)
+
+    n = totals[0]
+    report = {
+        'genes_a': a.get_size(),
+        'genes_b': b.get_size(),
+        'shared_genes': size,
+        'edges': int(n),
+        'pearson': None,
+        'spearman': None,
+        'mean_a': totals[1] / n if n else None,
+        'mean_b': totals[2] / n if n else None,
+    }
+    if not n:
+        report['row_correlation'] = {}
+        report['top_changes'] = []
+        return report
+
+    report['pearson'] = float(_pearson(*totals))
+
+    # Second pass: joint histogram of values for the binned rank correlation
+    edges_a = np.linspace(lows[0], highs[0], bins + 1)
+    edges_b = np.linspace(lows[1], highs[1], bins + 1)
+    joint = np.zeros((bins, bins))
+    for start, end, rows_a, rows_b, mask in _blocks(a, b, idx_a, idx_b,
+                                                    block_size):
+        hist, _, _ = np.histogram2d(rows_a[mask], rows_b[mask],
+                                    bins=[edges_a, edges_b])
+        joint += hist
+    rank_a = _bin_ranks(joint.sum(axis=1))
+    rank_b = _bin_ranks(joint.sum(axis=0))
+    report['spearman'] = float(_pearson(
+        n, (joint.sum(axis=1) * rank_a).sum(), (joint.sum(axis=0) * rank_b).sum(),
+        (joint.sum(axis=1) * rank_a ** 2).sum(), (joint.sum(axis=0) * rank_b ** 2).sum(),
+        rank_a.dot(joint).dot(rank_b)))
+
+    row_corr = _pearson(*genes)
+    valid = np.isfinite(row_corr)
+    lowest = np.argsort(np.where(valid, row_corr, np.inf))[:min(top, valid.sum())]
+    report['row_correlation'] = {
+        'genes': int(valid.sum()),
+        'mean': float(row_corr[valid].mean()) if valid.any() else None,
+        'quantiles': dict((str(q), float(np.percentile(row_corr[valid], q * 100)))
+                          for q in [0.05, 0.25, 0.5, 0.75, 0.95]) if valid.any() else {},
+        'lowest': [(shared[i], float(row_corr[i])) for i in lowest],
+    }
+
+    report['top_changes'] = []
+    for (change, r, c) in sorted(heap, reverse=True):
+        va = float(a.get_value(idx_a[r], idx_a[c]))
+        vb = float(b.get_value(idx_b[r], idx_b[c]))
+        report['top_changes'].append((shared[r], shared[c], va, vb, vb - va))
+
+    return report
@@ -0,0 +1,226 @@
+from __future__ import division
+from __future__ import print_function
+
+import sys
+import logging
+from multiprocessing import Pool
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# Upper bound on the number of edge values gathered from a Dab at once
+MAX_PAIRS = 1 << 22
+
+# Shared with pool workers (set by the pool initializer)
+_worker_conn = None
+
+
+def _init_worker(conn):
+    global _worker_conn
+    _worker_conn = conn
+
+
+def _worker_null(args):
+    size, n_perm, seed = args
+    return size, _worker_conn.null_distribution(size, n_perm, seed=seed)
+
+
+class SetConnectivity(object):
+
+    """
+    Score gene sets by their mean within-set edge weight in a Dab, with
+    empirical p-values from size-matched random gene sets.
+
+    Random sets are drawn from the background genes: by default every gene
+    in the Dab, or the Dab genes that are annotated in the scored GMT when
+    background='gmt' is passed to score().
+    """
+
+    def __init__(self, dab):
+        self._dab = dab
+        self._values = dab.as_array()
+        # Packed offset of each row's upper triangle, less one
+        rows = np.arange(dab.get_size(), dtype=np.int64)
+        self._row_start = rows * dab.get_size() - rows * (rows + 1) // 2 - 1
+        self._background = np.arange(dab.get_size(), dtype=np.int64)
+        self._scores = []
+
+    def set_background(self, genes=None):
+        """Restrict random gene sets to genes (None for all Dab genes)"""
+        if genes is None:
+            self._background = np.arange(self._dab.get_size(), dtype=np.int64)
+        else:
+            self._background = self.gene_indices(genes)
+
+    def gene_indices(self, genes):
+        """Return sorted Dab indices of the genes present in the Dab"""
+        idx = [self._dab.get_index(g) for g in genes]
+        return np.array(sorted(set(i for i in idx if i is not None)),
+                        dtype=np.int64)
+
+    def _gather(self, idx1, idx2, segments, nsegments):
+        # Mean of finite edge values per segment
+        vals = self._values[self._dab.get_positions(idx1, idx2)]
+        finite = np.isfinite(vals)
+        totals = np.bincount(segments[finite], weights=vals[finite],
+                             minlength=nsegments)
+        counts = np.bincount(segments[finite], minlength=nsegments)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return totals / counts
+
+    def mean_weights(self, index_sets, max_pairs=MAX_PAIRS):
+        """Return the mean within-set edge weight of each index set.
+
+        Sets are gathered in batches of at most max_pairs edges. Missing
+        (non-finite) edges are ignored; sets with no edges score NaN.
+        """
+        means = np.empty(len(index_sets))
+        means[:] = np.nan
+
+        start = 0
+        while start < len(index_sets):
+            end, npairs = start, 0
+            while end < len(index_sets):
+                k = len(index_sets[end])
+                pairs = k * (k - 1) // 2
+                if npairs and npairs + pairs > max_pairs:
+                    break
+                npairs += pairs
+                end += 1
+
+            idx1, idx2, segments = [], [], []
+            for s in range(start, end):
+                idx = np.asarray(index_sets[s], dtype=np.int64)
+                if len(idx) < 2:
+                    continue
+                iu, ju = np.triu_indices(len(idx), 1)
+                idx1.append(idx[iu])
+                idx2.append(idx[ju])
+                segments.append(np.repeat(s - start, len(iu)))
+            if segments:
+                means[start:end] = self._gather(
+                    np.concatenate(idx1), np.concatenate(idx2),
+                    np.concatenate(segments), end - start)
+            start = end
+
+        return means
+
+    def _sample(self, rng, size, count):
+        # Draw count random background subsets of the given size (one per row)
+        nbg = len(self._background)
+        if size * size <= nbg:
+            # Few collisions expected: draw with replacement, redraw rows
+            # containing a repeated gene
+            draws = np.sort(rng.randint(0, nbg, size=(count, size)), axis=1)
+            redraw = np.nonzero(np.any(draws[:, 1:] == draws[:, :-1], axis=1))[0]
+            while len(redraw):
+                redrawn = np.sort(
+                    rng.randint(0, nbg, size=(len(redraw), size)), axis=1)
+                draws[redraw] = redrawn
+                dup = np.any(redrawn[:, 1:] == redrawn[:, :-1], axis=1)
+                redraw = redraw[dup]
+        else:
+            keys = rng.random_sample((count, nbg))
+            draws = np.sort(np.argpartition(keys, size - 1, axis=1)[:, :size],
+                            axis=1)
+        return self._background[draws]
+
+    def _mean_rows(self, draws, iu, ju):
+        # Mean of finite edge values within each row of sorted gene indices
+        first, second = draws[:, iu], draws[:, ju]
+        vals = self._values[self._row_start[first] + second - first]
+        finite = np.isfinite(vals)
+        vals[~finite] = 0
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return vals.sum(axis=1, dtype=np.float64) / finite.sum(axis=1)
+
+    def null_distribution(self, size, n_perm, seed=0, max_pairs=MAX_PAIRS):
+        """Return mean edge weights of n_perm random sets of the given size"""
+        if size < 2 or size > len(self._background):
+            return np.empty(0)
+
+        rng = np.random.RandomState([seed, size])
+        iu, ju = np.triu_indices(size, 1)
+        nbg = len(self._background)
+        row_size = len(iu) + (size if size * size <= nbg else nbg)
+        chunk = max(1, min(n_perm, max_pairs // row_size))
+
+        null = []
+        for start in range(0, n_perm, chunk):
+            count = min(chunk, n_perm - start)
+            null.append(self._mean_rows(self._sample(rng, size, count), iu, ju))
+        null = np.concatenate(null)
+        return np.sort(null[np.isfinite(null)])
+
+    def score(self, gmt, n_perm=1000, min_size=2, max_size=None,
+              background=None, processes=1, seed=0):
+        """Score every gene set in gmt.
+
+        Args:
+            gmt:        GMT of gene sets
+            n_perm:     number of random sets drawn per distinct set size
+            min_size:   smallest number of set genes in the Dab to score
+            max_size:   largest number of set genes in the Dab to score
+            background: 'gmt' to draw random sets from the Dab genes
+                        annotated in gmt, otherwise from all Dab genes
+            processes:  number of worker processes for the null distributions
+            seed:       random seed
+
+        Returns:
+            list of (gsid, size, mean weight, z-score, p-value), sorted by
+            p-value
+        """
+        if background == 'gmt':
+            self.set_background(gmt.genes)
+        else:
+            self.set_background()
+
+        gsids, index_sets = [], []
+        for gsid in sorted(gmt.genesets):
+            idx = self.gene_indices(gmt.get_genes(gsid))
+            if len(idx) < max(min_size, 2):
+                continue
+            if max_size is not None and len(idx) > max_size:
+                continue
+            gsids.append(gsid)
+            index_sets.append(idx)
+        logger.info('Scoring %i gene sets', len(gsids))
+
+        observed = self.mean_weights(index_sets)
+
+        sizes = sorted(set(len(idx) for idx in index_sets))
+        logger.info('Sampling null distributions for %i set sizes', len(sizes))
+        # Largest sizes first so the slowest draws do not trail the pool
+        jobs = [(size, n_perm, seed) for size in reversed(sizes)]
+        if processes > 1:
+            pool = Pool(processes, initializer=_init_worker, initargs=(self,))
+            nulls = dict(pool.map(_worker_null, jobs, chunksize=1))
+            pool.close()
+            pool.join()
+        else:
+            nulls = dict((size, self.null_distribution(size, n_perm, seed=seed))
+                         for size in sizes)
+
+        self._scores = []
+        for gsid, idx, obs in zip(gsids, index_sets, observed):
+            null = nulls[len(idx)]
+            if not len(null) or not np.isfinite(obs):
+                zscore, pval = np.nan, np.nan
+            else:
+                exceed = len(null) - np.searchsorted(null, obs, side='left')
+                pval = (exceed + 1) / (len(null) + 1)
+                std = null.std()
+                zscore = (obs - null.mean()) / std if std > 0 else np.nan
+            self._scores.append((gsid, len(idx), obs, zscore, pval))
+
+        self._scores.sort(key=lambda x: (np.isnan(x[4]), x[4], x[0]))
+        return self._scores
+
+    def print_scores(self, out_file=sys.stdout, setnames=None):
+        for (gsid, size, obs, zscore, pval) in self._scores:
+            line = [gsid]
+            if setnames is not None:
+                line.append(setnames.get(gsid, ''))
+            line.extend([str(size), str(obs), str(zscore), str(pval)])
+            print('\t'.join(line), file=out_file)
@@ -11,24 +11,41 @@ import array
 import logging
 import math
 
+import numpy as np
+
 logger = logging.getLogger(__name__)
 
 
+def write_dab(filename, gene_list, values):
+    """Write a DAB file from gene names and the packed upper triangle"""
+    size = len(gene_list)
+    values = np.asarray(values, dtype=np.float32)
+    assert len(values) == size * (size - 1) // 2
+    with open(filename, 'wb') as dab_file:
+        array.array('I', [size]).tofile(dab_file)
+        for gene in gene_list:
+            dab_file.write(gene.encode('utf-16-be') + b'\x00\x00')
+        dab_file.write(values.tobytes())
+
+
 class Dab(object):
 
-    def __init__(self, filename):
+    def __init__(self, filename, mmap=False):
+        """Load filename; with mmap, DAB values are memory-mapped rather
+        than read into memory (ignored for QDAB files)"""
+        self.filename = filename
         self.gene_list = []
         self.gene_table = {}
         if filename.endswith('.qdab'):
             self.open_file(filename, qdab=True)
         else:
-            self.open_file(filename)
+            self.open_file(filename, mmap=mmap)
         self.gene_index = {}
         for i in range(len(self.gene_list)):
             self.gene_index[self.gene_list[i]] = i
         logger.debug("Got %s genes.", len(self.gene_list))
 
-    def open_file(self, filename, qdab=False):
+    def open_file(self, filename, qdab=False, mmap=False):
         logger.debug("Opening %s", filename)
         dab_file = open(filename, 'rb')
 
@@ -123,6 +140,10 @@ class Dab(object):
                     iTotal = iTotal + 1
                     if self.dat[-1] == nan_val:
                         self.dat[-1] = float('inf')
+        elif mmap:
+            total = size * (size - 1) // 2
+            self.dat = np.memmap(filename, dtype=np.float32, mode='r',
+                                 offset=start, shape=(total,))
         else:
             # get half matrix values
             total = size * (size - 1) // 2
@@ -130,6 +151,7 @@ class Dab(object):
             self.dat = array.array('f')
             self.dat.fromfile(dab_file, total)
 
+        dab_file.close()
         assert len(self.dat) == total
 
     def get_size(self):
@@ -177,6 +199,58 @@ class Dab(object):
     def arith_sum(self, x, y):
         return .5 * (y - x + 1) * (x + y)
 
+    def as_array(self):
+        """Return the packed upper triangle as a float32 NumPy array (no copy)"""
+        if isinstance(self.dat, np.ndarray):
+            return self.dat
+        return np.frombuffer(self.dat, dtype=np.float32)
+
+    def _row_offsets(self):
+        # Packed offset of the first value right of the diagonal in each row
+        if getattr(self, '_offsets', None) is None:
+            rows = np.arange(len(self.gene_list), dtype=np.int64)
+            self._offsets = rows * len(self.gene_list) - rows * (rows + 1) // 2
+        return self._offsets
+
+    def get_rows(self, indices):
+        """Return the full rows of the gene indices as a float32 matrix.
+
+        Rows match get(): the self interaction value is 1.
+        """
+        size = len(self.gene_list)
+        values = self.as_array()
+        offsets = self._row_offsets()
+        cols = np.arange(size, dtype=np.int64)
+        rows = np.empty((len(indices), size), dtype=np.float32)
+        for r, i in enumerate(indices):
+            rows[r, :i] = values[offsets[:i] + (i - cols[:i] - 1)]
+            rows[r, i] = 1
+            rows[r, i + 1:] = values[offsets[i]:offsets[i] + size - i - 1]
+        return rows
+
+    def get_positions(self, idx1, idx2):
+        """Return the packed offsets of the gene index pairs (idx1, idx2)"""
+        idx1 = np.asarray(idx1, dtype=np.int64)
+        idx2 = np.asarray(idx2, dtype=np.int64)
+        g1 = np.minimum(idx1, idx2)
+        g2 = np.maximum(idx1, idx2)
+        size = len(self.gene_list)
+        return g1 * size - g1 * (g1 + 1) // 2 + (g2 - g1 - 1)
+
+    def get_values(self, idx1, idx2):
+        """Vectorized get_value over arrays of gene indices.
+
+        Pairs of a gene with itself get the self interaction value 1.
+        """
+        idx1 = np.asarray(idx1, dtype=np.int64)
+        idx2 = np.asarray(idx2, dtype=np.int64)
+        same = idx1 == idx2
+        pos = self.get_positions(idx1, idx2)
+        pos[same] = 0
+        vals = self.as_array()[pos]
+        vals[same] = 1
+        return vals
+
     def get(self, gene_str):
         vals = []
         idx = self.get_index(gene_str)
@@ -193,8 +267,8 @@ class Dab(object):
 
         start = self.arith_sum((len(self.gene_list)) - idx,
                                (len(self.gene_list) - 1))
-        vals += self.dat[int(start):int(start) +
-                         len(self.gene_list) - (idx + 1)]
+        vals.extend(self.dat[int(start):int(start) +
+                             len(self.gene_list) - (idx + 1)])
 
         return vals
 
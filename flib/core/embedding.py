@@ -0,0 +1,65 @@
+from __future__ import division
+
+import logging
+import os
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+
+def _product(dab, Q, block_size):
+    # W Q for the network W (rows as in Dab.get_rows, missing edges as 0),
+    # expanding the packed triangle one block of rows at a time
+    size = dab.get_size()
+    out = np.empty((size, Q.shape[1]))
+    for start in range(0, size, block_size):
+        end = min(start + block_size, size)
+        rows = dab.get_rows(range(start, end))
+        rows[~np.isfinite(rows)] = 0
+        out[start:end] = rows.dot(Q)
+    return out
+
+
+def network_embedding(dab, k, oversample=10, n_iter=4, block_size=1000, seed=0):
+    """Return a (genes x k) embedding from a randomized eigendecomposition.
+
+    The network W is approximated by U diag(s) U^T with the k eigenvalues of
+    largest magnitude, and genes are embedded as U diag(s), so inner products
+    of embedded genes approximate inner products of their network rows (the
+    linear kernel of NetworkSVM). Only blocks of rows are ever expanded.
+    """
+    size = dab.get_size()
+    rank = min(size, k + oversample)
+    rng = np.random.RandomState(seed)
+
+    # Randomized range finder with power iterations
+    Q, _ = np.linalg.qr(_product(dab, rng.normal(size=(size, rank)), block_size))
+    for it in range(n_iter):
+        logger.info('Power iteration %i', it + 1)
+        Q, _ = np.linalg.qr(_product(dab, Q, block_size))
+
+    B = Q.T.dot(_product(dab, Q, block_size))
+    evals, evecs = np.linalg.eigh((B + B.T) / 2)
+    top = np.argsort(-np.abs(evals))[:k]
+    U = Q.dot(evecs[:, top])
+    return (U * evals[top]).astype(np.float32)
+
+
+def embedding_file(dab, k):
+    """Return the path of the rank k embedding stored next to the Dab"""
+    return '%s.emb%i.npy' % (dab.filename, k)
+
+
+def load_embedding(dab, k, **kwargs):
+    """Return the memory-mapped rank k embedding of dab, computing and
+    storing it next to the Dab file if missing or older than the Dab"""
+    filename = embedding_file(dab, k)
+    if not os.path.exists(filename) or \
+            os.path.getmtime(filename) < os.path.getmtime(dab.filename):
+        logger.info('Computing rank %i embedding', k)
+        embedding = network_embedding(dab, k, **kwargs)
+        tmp_file = '%s.%i.tmp.npy' % (filename[:-4], os.getpid())
+        np.save(tmp_file, embedding)
+        os.rename(tmp_file, filename)
+    return np.load(filename, mmap_mode='r')
@@ -0,0 +1,338 @@
+from __future__ import division
+from __future__ import print_function
+
+import logging
+import os
+import sys
+import zlib
+from multiprocessing import Pool
+
+import numpy as np
+
+from flib.core.predictions import PredictionStore
+
+logger = logging.getLogger(__name__)
+
+# Prediction stores opened by this process, by directory
+_stores = {}
+
+# Upper bound on the number of (replicate x gene) cells resampled at once
+MAX_CELLS = 1 << 22
+
+
+def load_text(filename):
+    """Load a predictions file (gene, label, score, prob per line).
+
+    Returns:
+        (genes list, labels, scores, probs arrays), labels as 1, -1 or 0
+    """
+    with open(filename) as f:
+        text = f.read()
+    # Gene names hold no whitespace, so the file splits into a flat list of
+    # fields that is sliced into columns
+    ncols = len(text[:text.find('\n')].split())
+    fields = text.split()
+    if not fields:
+        empty = np.empty(0)
+        return [], empty, empty, empty
+    genes = fields[0::ncols]
+    labels = np.array(fields[1::ncols], dtype=np.float64)
+    scores = np.array(fields[2::ncols], dtype=np.float64)
+    probs = np.array(fields[3::ncols], dtype=np.float64) if ncols > 3 else scores
+    return genes, labels, scores, probs
+
+
+def prediction_terms(directory):
+    """Return the terms of a predictions directory (a prediction store or
+    one text file per term, skipping hidden files and subdirectories)"""
+    if PredictionStore.exists(directory):
+        return sorted(_store(directory).terms())
+    return sorted(f for f in os.listdir(directory) if not f.startswith('.') and
+                  os.path.isfile(os.path.join(directory, f)))
+
+
+def _store(directory):
+    if directory not in _stores:
+        _stores[directory] = PredictionStore(directory)
+    return _stores[directory]
+
+
+def load_term(directory, term, with_genes=False):
+    """Return (labels, scores, probs) of the labeled genes of term, labels
+    as booleans, preceded by the gene names with with_genes"""
+    if PredictionStore.exists(directory):
+        store = _store(directory)
+        scores, probs, labels = store.get_term(term)
+        genes = store.genes
+    else:
+        genes, labels, scores, probs = load_text(os.path.join(directory, term))
+    labeled = (labels != 0) & np.isfinite(scores)
+    result = (labels[labeled] == 1, scores[labeled], probs[labeled])
+    if with_genes:
+        return (np.array(genes, dtype=object)[labeled],) + result
+    return result
+
+
+def _tie_groups(scores):
+    # Descending order of scores and the start of each group of tied scores
+    order = np.argsort(-scores, kind='mergesort')
+    sorted_scores = scores[order]
+    starts = np.nonzero(np.r_[True, sorted_scores[1:] != sorted_scores[:-1]])[0]
+    return order, starts
+
+
+def _curve(pos, neg, starts):
+    # Positives and negatives per tie group (along the last axis) and their
+    # cumulative counts down the ranking
+    tp = np.add.reduceat(pos, starts, axis=-1)
+    fp = np.add.reduceat(neg, starts, axis=-1)
+    return tp, fp, np.cumsum(tp, axis=-1), np.cumsum(fp, axis=-1)
+
+
+def _auroc(tp, fp, ctp, cfp):
+    # Each positive beats the negatives ranked below it and half its ties
+    P, N = ctp[..., -1], cfp[..., -1]
+    wins = (tp * (N[..., None] - cfp + fp / 2.)).sum(axis=-1)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return wins / (P * N)
+
+
+def _auprc(tp, ctp, cfp):
+    # Average precision: precision at each threshold weighted by the recall
+    # gained there (groups ranked above any positive gain none)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        precision = ctp / np.maximum(ctp + cfp, 1)
+        return (tp * precision).sum(axis=-1) / ctp[..., -1]
+
+
+def term_metrics(labels, scores, ks=(10, 50), fdrs=(0.1,)):
+    """Compute ranking metrics of one term from a single sort.
+
+    AUROC and AUPRC (average precision) treat tied scores as one threshold,
+    as scikit-learn does.
+
+    Args:
+        labels: boolean array, True for positives
+        scores: array of scores
+        ks:     precision at each top k genes
+        fdrs:   recall at each false discovery rate
+
+    Returns:
+        dict of metric -> value (NaN when undefined)
+    """
+    labels = np.asarray(labels, dtype=bool)
+    scores = np.asarray(scores, dtype=np.float64)
+    metrics = {'pos': int(labels.sum()), 'neg': int((~labels).sum())}
+    if not len(labels):
+        metrics.update(auroc=np.nan, auprc=np.nan)
+        metrics.update(('p@%i' % k, np.nan) for k in ks)
+        metrics.update(('recall@%g' % f, np.nan) for f in fdrs)
+        return metrics
+
+    order, starts = _tie_groups(scores)
+    ranked = labels[order].astype(np.float64)
+    tp, fp, ctp, cfp = _curve(ranked, 1 - ranked, starts)
+    metrics['auroc'] = float(_auroc(tp, fp, ctp, cfp))
+    metrics['auprc'] = float(_auprc(tp, ctp, cfp))
+
+    hits = np.cumsum(ranked)
+    for k in ks:
+        metrics['p@%i' % k] = hits[k - 1] / k if k <= len(hits) else np.nan
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        fdr = cfp / (ctp + cfp)
+        recall = ctp / ctp[-1]
+    for f in fdrs:
+        passing = fdr <= f
+        metrics['recall@%g' % f] = float(recall[passing].max()) \
+            if passing.any() and ctp[-1] else (0. if ctp[-1] else np.nan)
+    return metrics
+
+
+def bootstrap(labels, score_sets, n_boot=1000, seed=0, max_cells=MAX_CELLS):
+    """Return bootstrap replicates of AUROC and AUPRC for each score set.
+
+    Every score set is evaluated on the same resamples of the genes, drawn
+    as one (replicates x genes) index matrix. Each set is sorted once and
+    its genes coded by tie group and label, so one bincount of the drawn
+    codes gives the positive and negative counts per tied score of every
+    replicate, and all replicates' curves are computed together (in chunks
+    of at most max_cells draws).
+
+    Returns:
+        array (score sets x 2 x n_boot) of AUROC and AUPRC replicates, NaN
+        for replicates drawing no positives or no negatives
+    """
+    labels = np.asarray(labels, dtype=bool)
+    n = len(labels)
+    rng = np.random.RandomState(seed)
+    coded = []
+    for scores in score_sets:
+        order, starts = _tie_groups(np.asarray(scores, dtype=np.float64))
+        group = np.empty(n, dtype=np.int64)
+        group[order] = np.cumsum(np.isin(np.arange(n), starts)) - 1
+        # Code g for a negative and G + g for a positive in tie group g
+        coded.append((group + len(starts) * labels, len(starts)))
+
+    result = np.empty((len(score_sets), 2, n_boot))
+    chunk = max(1, min(n_boot, max_cells // max(n, 1)))
+    for start in range(0, n_boot, chunk):
+        size = min(chunk, n_boot - start)
+        draws = rng.randint(0, n, size=(size, n))
+        for i, (code, ngroups) in enumerate(coded):
+            offsets = (np.arange(size) * 2 * ngroups)[:, None]
+            counts = np.bincount((code[draws] + offsets).ravel(),
+                                 minlength=size * 2 * ngroups)
+            counts = counts.reshape(size, 2, ngroups).astype(np.float64)
+            tp, fp = counts[:, 1], counts[:, 0]
+            ctp, cfp = np.cumsum(tp, axis=1), np.cumsum(fp, axis=1)
+            result[i, 0, start:start + size] = _auroc(tp, fp, ctp, cfp)
+            result[i, 1, start:start + size] = _auprc(tp, ctp, cfp)
+    return result
+
+
+def term_seed(term, seed=0):
+    """Return a resampling seed of term that does not depend on the order
+    or process terms are evaluated in"""
+    return [seed, zlib.crc32(term.encode()) & 0xffffffff]
+
+
+def confidence_intervals(replicates, alpha=0.05):
+    """Return the percentile interval of each AUROC and AUPRC replicate
+    array as (auroc_lo, auroc_hi, auprc_lo, auprc_hi)"""
+    bounds = [100 * alpha / 2, 100 * (1 - alpha / 2)]
+    with np.errstate(invalid='ignore'):
+        auroc = np.nanpercentile(replicates[0], bounds) \
+            if np.isfinite(replicates[0]).any() else [np.nan, np.nan]
+        auprc = np.nanpercentile(replicates[1], bounds) \
+            if np.isfinite(replicates[1]).any() else [np.nan, np.nan]
+    return tuple(float(x) for x in list(auroc) + list(auprc))
+
+
+def paired_test(replicates_a, replicates_b, alpha=0.05):
+    """Compare two prediction sets on the same bootstrap resamples.
+
+    Returns:
+        dict with, for auroc and auprc, the percentile interval of the
+        difference b - a and a two-sided p-value for no difference
+    """
+    result = {}
+    for m, metric in enumerate(['auroc', 'auprc']):
+        diff = replicates_b[m] - replicates_a[m]
+        diff = diff[np.isfinite(diff)]
+        if not len(diff):
+            result.update([('d%s_lo' % metric, np.nan), ('d%s_hi' % metric, np.nan),
+                           ('p_%s' % metric, np.nan)])
+            continue
+        lo, hi = np.percentile(diff, [100 * alpha / 2, 100 * (1 - alpha / 2)])
+        tail = min((diff <= 0).sum(), (diff >= 0).sum())
+        result['d%s_lo' % metric] = float(lo)
+        result['d%s_hi' % metric] = float(hi)
+        result['p_%s' % metric] = float(min(1., 2. * (tail + 1) / (len(diff) + 1.)))
+    return result
+
+
+def _evaluate_term(job):
+    directory, term, ks, fdrs, n_boot, seed = job
+    labels, scores, probs = load_term(directory, term)
+    metrics = term_metrics(labels, scores, ks=ks, fdrs=fdrs)
+    prob_metrics = term_metrics(labels, probs, ks=(), fdrs=())
+    metrics['auroc_prob'] = prob_metrics['auroc']
+    metrics['auprc_prob'] = prob_metrics['auprc']
+    if n_boot:
+        replicates = bootstrap(labels, [scores], n_boot=n_boot,
+                               seed=term_seed(term, seed))[0]
+        (metrics['auroc_lo'], metrics['auroc_hi'],
+         metrics['auprc_lo'], metrics['auprc_hi']) = confidence_intervals(replicates)
+    return term, metrics
+
+
+def _compare_term(job):
+    directory_a, directory_b, term, n_boot, seed = job
+    genes_a, labels_a, scores_a, probs_a = load_term(directory_a, term, with_genes=True)
+    genes_b, labels_b, scores_b, probs_b = load_term(directory_b, term, with_genes=True)
+
+    # Genes labeled alike in both sets
+    row_b = dict((g, i) for i, g in enumerate(genes_b))
+    shared = [(i, row_b[g]) for i, g in enumerate(genes_a)
+              if g in row_b and labels_a[i] == labels_b[row_b[g]]]
+    if len(shared) < len(genes_a) or len(shared) < len(genes_b):
+        logger.warning('%s: comparing %i of %i/%i labeled genes', term,
+                       len(shared), len(genes_a), len(genes_b))
+    idx_a = np.array([i for i, j in shared], dtype=np.int64)
+    idx_b = np.array([j for i, j in shared], dtype=np.int64)
+    labels = labels_a[idx_a]
+
+    metrics_a = term_metrics(labels, scores_a[idx_a], ks=(), fdrs=())
+    metrics_b = term_metrics(labels, scores_b[idx_b], ks=(), fdrs=())
+    result = {'pos': metrics_a['pos'], 'neg': metrics_a['neg'],
+              'auroc_a': metrics_a['auroc'], 'auroc_b': metrics_b['auroc'],
+              'auprc_a': metrics_a['auprc'], 'auprc_b': metrics_b['auprc']}
+    replicates = bootstrap(labels, [scores_a[idx_a], scores_b[idx_b]],
+                           n_boot=n_boot, seed=term_seed(term, seed))
+    result.update(paired_test(replicates[0], replicates[1]))
+    return term, result
+
+
+def _run_jobs(func, jobs, processes):
+    # Map func over jobs in this process or across a pool
+    logger.info('Evaluating %i terms', len(jobs))
+    if processes > 1:
+        pool = Pool(processes)
+        results = pool.map(func, jobs,
+                           chunksize=max(1, len(jobs) // (4 * processes)))
+        pool.close()
+        pool.join()
+        return results
+    return [func(job) for job in jobs]
+
+
+def evaluate_directory(directory, processes=1, ks=(10, 50), fdrs=(0.1,),
+                       n_boot=0, seed=0):
+    """Evaluate every term of a predictions directory, across a pool of
+    processes that each load their terms. With n_boot, percentile
+    intervals of AUROC and AUPRC from n_boot resamples are added.
+
+    Returns:
+        list of (term, metrics dict) in term order
+    """
+    jobs = [(directory, term, tuple(ks), tuple(fdrs), n_boot, seed)
+            for term in prediction_terms(directory)]
+    return _run_jobs(_evaluate_term, jobs, processes)
+
+
+def compare_directories(directory_a, directory_b, processes=1, n_boot=1000,
+                        seed=0):
+    """Compare two prediction sets over the terms they share, by paired
+    bootstrap resamples of the genes labeled alike in both.
+
+    Returns:
+        list of (term, dict) of AUROC and AUPRC of each set with the
+        interval and p-value of their difference (b - a)
+    """
+    terms = sorted(set(prediction_terms(directory_a)) &
+                   set(prediction_terms(directory_b)))
+    jobs = [(directory_a, directory_b, term, n_boot, seed) for term in terms]
+    return _run_jobs(_compare_term, jobs, processes)
+
+
+COMPARE_COLUMNS = ['pos', 'neg', 'auroc_a', 'auroc_b', 'dauroc_lo', 'dauroc_hi',
+                   'p_auroc', 'auprc_a', 'auprc_b', 'dauprc_lo', 'dauprc_hi',
+                   'p_auprc']
+
+
+def metric_columns(ks=(10, 50), fdrs=(0.1,), bootstrap=False):
+    columns = (['pos', 'neg', 'auroc', 'auprc'] + ['p@%i' % k for k in ks] +
+               ['recall@%g' % f for f in fdrs] + ['auroc_prob', 'auprc_prob'])
+    if bootstrap:
+        columns += ['auroc_lo', 'auroc_hi', 'auprc_lo', 'auprc_hi']
+    return columns
+
+
+def write_summary(results, out_file=sys.stdout, columns=None):
+    """Write a tab-separated table of term metrics"""
+    if columns is None:
+        columns = metric_columns()
+    print('\t'.join(['term'] + columns), file=out_file)
+    for term, metrics in results:
+        print('\t'.join([term] + [str(metrics[c]) for c in columns]), file=out_file)
@@ -1,3 +1,5 @@
+from __future__ import print_function
+
 import sys
 import os
 from collections import defaultdict
@@ -129,4 +131,4 @@ if __name__ == '__main__':
         gs = gmt(options.gmt)
         for gname, gset in gs.overlap().iteritems():
             for gname2, ovlp in gset.iteritems():
-                print gname, gname2, ovlp
+                print(gname, gname2, ovlp)
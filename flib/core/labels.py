@@ -39,24 +39,36 @@ class OntoLabels:
     def __init__(self, obo=None, slim_terms=None):
         self._slim_terms = slim_terms
         self._obo = obo
+        # Genes of all terms and of the descendents of each slim term,
+        # computed on first use
+        self._all_genes = None
+        self._slim_genes = None
+
+    def _load_slim_genes(self):
+        genes = {}
+        for obo_term in self._obo.get_termobject_list():
+            genes[obo_term.go_id] = set(obo_term.get_annotated_genes())
+        self._all_genes = set().union(*genes.values())
+        self._slim_genes = {}
+        for slim_term in self._slim_terms:
+            self._slim_genes[slim_term] = set().union(
+                *[genes[d] for d in self._obo.get_descendents(slim_term)])
 
     def get_labels(self, term_id):
         term = self._obo.get_term(term_id)
         if not term:
             return (set(), set())
+        if self._slim_genes is None:
+            self._load_slim_genes()
 
         pos = set(term.get_annotated_genes())
-        unknown, all_genes = set(), set()
-        term_tree = self._obo.get_ancestors(term_id)
 
-        for obo_term in self._obo.get_termobject_list():
-            obo_term_tree = self._obo.get_ancestors(obo_term.go_id)
-            genes = set(obo_term.get_annotated_genes())
-            if len(set(self._slim_terms & term_tree & obo_term_tree)):
-                unknown |= genes
-            all_genes |= genes
+        # Genes of terms sharing a slim ancestor with the term are unknown
+        unknown = set()
+        for slim_term in self._slim_terms & self._obo.get_ancestors(term_id):
+            unknown |= self._slim_genes[slim_term]
 
-        neg = all_genes - unknown - pos
+        neg = self._all_genes - unknown - pos
 
         return (pos, neg)
 
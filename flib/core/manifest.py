@@ -0,0 +1,103 @@
+from __future__ import division
+
+import hashlib
+import json
+import logging
+import os
+import time
+
+logger = logging.getLogger(__name__)
+
+MANIFEST_FILE = '.manifest.jsonl'
+
+
+def file_signature(filename):
+    """Return a string identifying a file by path, size and mtime"""
+    stat = os.stat(filename)
+    return '%s:%i:%f' % (os.path.realpath(filename), stat.st_size, stat.st_mtime)
+
+
+def input_hash(pos_genes, neg_genes, params):
+    """Hash a term's labels and the run parameters (JSON-serializable)"""
+    key = hashlib.sha1(json.dumps(params, sort_keys=True).encode())
+    for g in sorted(pos_genes):
+        key.update(('+%s\n' % g).encode())
+    for g in sorted(neg_genes):
+        key.update(('-%s\n' % g).encode())
+    return key.hexdigest()
+
+
+class RunManifest(object):
+
+    """
+    Append-only record of the terms completed by a run in an output
+    directory.
+
+    Each record is one JSON line written with a single append, so records
+    from concurrent workers never interleave. A term is complete for a
+    restarted run only if it was recorded with the same input hash.
+    """
+
+    def __init__(self, directory, filename=MANIFEST_FILE):
+        self._filename = os.path.join(directory, filename)
+
+    def _append(self, record):
+        line = (json.dumps(record, sort_keys=True) + '\n').encode()
+        fd = os.open(self._filename, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            os.write(fd, line)
+        finally:
+            os.close(fd)
+
+    def records(self):
+        """Return all records in the manifest, skipping a torn last line"""
+        if not os.path.exists(self._filename):
+            return []
+        records = []
+        with open(self._filename) as f:
+            for line in f:
+                try:
+                    records.append(json.loads(line))
+                except ValueError:
+                    logger.warning('Skipping incomplete manifest line')
+        return records
+
+    def start(self, terms, params):
+        """Record the start of a run over terms"""
+        self._append({'event': 'start', 'time': time.time(),
+                      'terms': list(terms), 'params': params})
+
+    def record(self, term, term_hash, seconds, size=None):
+        """Record term as complete for the inputs hashed to term_hash, with
+        its run time and number of labeled genes"""
+        self._append({'event': 'done', 'term': term, 'hash': term_hash,
+                      'time': time.time(), 'seconds': seconds, 'size': size})
+
+    def completed(self):
+        """Return a dict of term -> input hash of its latest completion"""
+        done = {}
+        for record in self.records():
+            if record.get('event') == 'done':
+                done[record['term']] = record['hash']
+        return done
+
+    def status(self):
+        """Return the progress of the latest run, with an ETA in seconds"""
+        records = self.records()
+        starts = [i for i, r in enumerate(records) if r.get('event') == 'start']
+        if not starts:
+            return None
+        start = records[starts[-1]]
+        terms = set(start['terms'])
+        run_done = set(r['term'] for r in records[starts[-1]:]
+                       if r.get('event') == 'done')
+        done = len(terms & set(self.completed()))
+
+        elapsed = time.time() - start['time']
+        remaining = len(terms) - done
+        eta = None
+        if run_done and remaining:
+            eta = elapsed / len(run_done) * remaining
+        return {'terms': len(terms), 'done': done,
+                'done_this_run': len(run_done), 'remaining': remaining,
+                'elapsed': elapsed, 'eta': eta}
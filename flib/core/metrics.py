@@ -0,0 +1,151 @@
+from __future__ import division
+from __future__ import print_function
+
+import json
+import os
+import resource
+import sys
+import time
+import uuid
+from contextlib import contextmanager
+
+METRICS_FILE = '.metrics.jsonl'
+
+
+def _cpu_time():
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+
+def _peak_rss():
+    # Peak resident set size of this process in MB (ru_maxrss is in KB on
+    # Linux, bytes on OS X)
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss / (1 << 20) if sys.platform == 'darwin' else rss / 1024
+
+
+def _reset_peak_rss():
+    """Reset the peak RSS of this process to its current RSS where the OS
+    allows it (Linux), returning False otherwise"""
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return True
+    except (IOError, OSError):
+        return False
+
+
+def _stage_peak_rss():
+    # Peak RSS in MB since the last reset, from VmHWM on Linux
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024
+    except (IOError, OSError):
+        pass
+    return _peak_rss()
+
+
+class StageMetrics(object):
+
+    """
+    Wall time, CPU time and peak RSS of named pipeline stages.
+
+    On Linux the peak RSS of a stage is measured from the stage start by
+    resetting the process high-water mark, with nested stages folded into
+    the enclosing ones; elsewhere it is the process peak so far.
+
+    Each completed stage is one JSON line appended with a single write to
+    the metrics file, so forked workers can share it; summarize() aggregates
+    the file across workers. Without a file only in-process totals are kept.
+    Records carry the current term (see set_term) and a run id.
+    """
+
+    def __init__(self, filename=None, run=None):
+        self._filename = filename
+        self.run = run if run is not None else uuid.uuid4().hex
+        self.term = None
+        self.totals = {}
+        # Peak RSS seen so far by each open stage, innermost last
+        self._open = []
+
+    def set_term(self, term):
+        self.term = term
+
+    @contextmanager
+    def stage(self, name):
+        # The enclosing stages keep the peak reached before the reset
+        peak = _stage_peak_rss()
+        self._open = [max(p, peak) for p in self._open] + [0.]
+        _reset_peak_rss()
+        wall, cpu = time.time(), _cpu_time()
+        try:
+            yield
+        finally:
+            rss = max(self._open.pop(), _stage_peak_rss())
+            self._open = [max(p, rss) for p in self._open]
+            self._record(name, time.time() - wall, _cpu_time() - cpu, rss)
+
+    def _record(self, name, wall, cpu, rss):
+        total = self.totals.setdefault(name, [0, 0., 0., 0., 0.])
+        total[0] += 1
+        total[1] += wall
+        total[2] += cpu
+        total[3] = max(total[3], wall)
+        total[4] = max(total[4], rss)
+
+        if self._filename:
+            record = {'run': self.run, 'pid': os.getpid(), 'term': self.term,
+                      'stage': name, 'wall': wall, 'cpu': cpu, 'rss_mb': rss}
+            line = (json.dumps(record, sort_keys=True) + '\n').encode()
+            fd = os.open(self._filename, os.O_WRONLY | os.O_APPEND | os.O_CREAT,
+                         0o644)
+            try:
+                os.write(fd, line)
+            finally:
+                os.close(fd)
+
+    def summarize(self):
+        """Return stage totals of this run from the metrics file (all
+        workers), or of this process without a file"""
+        if not self._filename:
+            return dict((name, list(total)) for name, total in self.totals.items())
+        return summarize_metrics(self._filename, run=self.run)
+
+    def print_summary(self, out_file=sys.stderr):
+        print_summary(self.summarize(), out_file)
+
+
+def summarize_metrics(filename, run=None):
+    """Aggregate a metrics file into stage -> [calls, wall, cpu, max wall,
+    peak RSS MB], optionally for one run"""
+    totals = {}
+    if not os.path.exists(filename):
+        return totals
+    with open(filename) as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue
+            if run is not None and record['run'] != run:
+                continue
+            total = totals.setdefault(record['stage'], [0, 0., 0., 0., 0.])
+            total[0] += 1
+            total[1] += record['wall']
+            total[2] += record['cpu']
+            total[3] = max(total[3], record['wall'])
+            total[4] = max(total[4], record['rss_mb'])
+    return totals
+
+
+def print_summary(totals, out_file=sys.stderr):
+    """Print stage totals as a table, slowest stage first"""
+    print('%-16s %8s %10s %10s %10s %10s %10s' % (
+        'stage', 'calls', 'wall_s', 'mean_s', 'max_s', 'cpu_s', 'rss_mb'),
+        file=out_file)
+    for name, (calls, wall, cpu, max_wall, rss) in sorted(
+            totals.items(), key=lambda x: -x[1][1]):
+        print('%-16s %8i %10.2f %10.3f %10.3f %10.2f %10.1f' % (
+            name, calls, wall, wall / calls, max_wall, cpu, rss), file=out_file)
@@ -1,3 +1,9 @@
+from __future__ import print_function
+
+import gc
+import hashlib
+import io
+import os
 import sys
 import logging
 logging.basicConfig()
@@ -6,15 +12,217 @@ logger.setLevel(logging.ERROR)
 
 import re
 from collections import defaultdict
-from idmap import IDMap
-from gmt import GMT
-import urllib2
+import numpy as np
+from flib.core.idmap import IDMap
+from flib.core.gmt import GMT
+try:
+    from urllib2 import urlopen
+except ImportError:
+    from urllib.request import urlopen
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+try:
+    _intern = intern
+except NameError:
+    from sys import intern as _intern
+
+# Runs of anything but letters and digits become one underscore in names
+_NAME_SEP = re.compile(r'[\W_]+')
+_REGULATES = frozenset(['regulates', 'positively_regulates',
+                        'negatively_regulates'])
+# Version of the save_cache layout, part of the cache keys
+_CACHE_VERSION = 1
+
+
+def _open_obo(obo_file, remote_location=False, timeout=5):
+    """Return an iterator over the text lines of a local or remote obo"""
+    if remote_location:
+        obo = urlopen(obo_file, timeout=timeout)
+    else:
+        obo = open(obo_file, 'rb')
+    return _text_lines(obo)
+
+
+def _text_lines(obo):
+    """Return an iterator over the text lines of a binary file object"""
+    if sys.version_info[0] > 2:
+        obo = io.TextIOWrapper(obo, encoding='utf-8')
+    return obo
+
+
+def _interned(value):
+    """Return the interned copy of a string, other values unchanged"""
+    return _intern(value) if type(value) is str else value
+
+
+def _propagated(annotations, relation, flyweights=None):
+    """Return the copies of annotations propagated to a parent term along
+    relation ('is_a', 'part_of' or 'regulates'), shared through flyweights
+    (see Annotation.prop_copy).
+
+    Annotations reaching a term through a regulates or part_of relation are
+    marked ready_regulates_cutoff, and such annotations are not propagated
+    further along regulates relations.
+    See: http://www.geneontology.org/page/ontology-relations##reg_reas
+    """
+    cutoff = True if relation != 'is_a' else None
+    copies = set()
+    for annotation in annotations:
+        if annotation.ready_regulates_cutoff and relation == 'regulates':
+            continue
+        copies.add(annotation.prop_copy(cutoff, flyweights))
+    return copies
+
+
+def _or_into(bitsets, other):
+    """OR the gene bitsets of other into bitsets, both keyed by evidence"""
+    for evidence, bits in other.items():
+        bitsets[evidence] = bitsets.get(evidence, 0) | bits
+
+
+def _mapped_genes(gid, id_name):
+    """Return the genes id_name maps gid to, or None with a warning"""
+    mapped_genes = id_name.get(gid)
+    if mapped_genes is None and 'CELE_' in gid:
+        mapped_genes = id_name.get(gid[5:len(gid)])
+    if mapped_genes is None:
+        logger.warning('No matching gene id: %s', gid)
+    return mapped_genes
+
+
+def _propagate_bits(gterm, parent, relation):
+    """Propagate the compact annotations of gterm to parent along relation,
+    with the regulates cutoff of _propagated"""
+    if relation == 'is_a':
+        _or_into(parent.gene_bits, gterm.gene_bits)
+        _or_into(parent.cutoff_bits, gterm.cutoff_bits)
+        cross = parent.gene_bits
+    else:
+        _or_into(parent.cutoff_bits, gterm.gene_bits)
+        if relation == 'part_of':
+            _or_into(parent.cutoff_bits, gterm.cutoff_bits)
+        cross = parent.cutoff_bits
+    # Propagated cross annotations are plain annotations without evidence
+    if gterm.cross_bits:
+        cross[None] = cross.get(None, 0) | gterm.cross_bits
+
+
+class GeneIndex(object):
+    """Interns gene ids to the bit positions of compact annotations"""
+
+    def __init__(self):
+        self.genes = []
+        self.ids = {}
+
+    def bit(self, gene):
+        """Return the bitset of gene alone"""
+        i = self.ids.get(gene)
+        if i is None:
+            i = self.ids[gene] = len(self.genes)
+            self.genes.append(gene)
+        return 1 << i
+
+    def decode(self, bits):
+        """Return the genes of bitset bits"""
+        # Bit i is character i of the reversed binary representation
+        return [self.genes[i]
+                for i, c in enumerate(reversed(bin(bits)[2:])) if c == '1']
+
+
+class TermClosure(object):
+    """Index of the ancestors and descendents of every term of an ontology,
+    following parents of the term's own namespace.
+
+    Each term's ancestors and descendents are sorted arrays of term
+    positions, so queries cost a lookup plus the size of their result.
+    """
+
+    def __init__(self, go_terms):
+        self.go_ids = sorted(go_terms)
+        self.index = dict((go_id, i) for i, go_id in enumerate(self.go_ids))
+        terms = [go_terms[go_id] for go_id in self.go_ids]
+        parents = [[self.index[p.go_id] for p in term.child_of
+                    if p.go_id in self.index and p.namespace == term.namespace]
+                   for term in terms]
+
+        # Ancestors of each term from those of its parents, parents first
+        children = [[] for _ in terms]
+        pending = [len(p) for p in parents]
+        for i, term_parents in enumerate(parents):
+            for p in term_parents:
+                children[p].append(i)
+        empty = np.zeros(0, dtype=np.int32)
+        self.ancestors = [None] * len(terms)
+        ready = [i for i, n in enumerate(pending) if not n]
+        # ready grows as the loop runs, one entry per term
+        for i in ready:
+            if parents[i]:
+                self.ancestors[i] = np.unique(np.concatenate(
+                    [parents[i]] + [self.ancestors[p] for p in parents[i]])
+                ).astype(np.int32)
+            else:
+                self.ancestors[i] = empty
+            for c in children[i]:
+                pending[c] -= 1
+                if not pending[c]:
+                    ready.append(c)
+        if len(ready) < len(terms):
+            logger.warning('Ontology has cycles, no ancestors for %i terms',
+                           len(terms) - len(ready))
+            self.ancestors = [empty if a is None else a for a in self.ancestors]
+
+        # Descendents: the terms grouped by ancestor, in term order
+        members = np.repeat(np.arange(len(terms), dtype=np.int32),
+                            [len(a) for a in self.ancestors])
+        flat = np.concatenate(self.ancestors + [empty])
+        order = np.argsort(flat, kind='mergesort')
+        bounds = np.searchsorted(flat[order], np.arange(len(terms) + 1))
+        members = members[order]
+        self.descendents = [members[bounds[i]:bounds[i + 1]]
+                            for i in range(len(terms))]
+
+    def get_ancestors(self, go_id):
+        """Return the set of ancestor ids of term go_id"""
+        return self._ids(self.ancestors, go_id)
+
+    def get_descendents(self, go_id):
+        """Return the set of descendent ids of term go_id"""
+        return self._ids(self.descendents, go_id)
+
+    def is_ancestor(self, ancestor_id, go_id):
+        """Return whether ancestor_id is an ancestor of term go_id"""
+        if ancestor_id not in self.index or go_id not in self.index:
+            return False
+        ancestors = self.ancestors[self.index[go_id]]
+        i = self.index[ancestor_id]
+        k = np.searchsorted(ancestors, i)
+        return k < len(ancestors) and ancestors[k] == i
+
+    def _ids(self, closure, go_id):
+        if go_id not in self.index:
+            return set()
+        return set(self.go_ids[i] for i in closure[self.index[go_id]].tolist())
 
 
 class OBO:
 
-    def __init__(self, obo_file=None):
-        """Initialize with optional obo file"""
+    def __init__(self, obo_file=None, compact=False):
+        """Initialize with optional obo file.
+
+        In compact mode genes are interned to integers and each term stores
+        its annotated genes as bitsets (Python ints) instead of Annotation
+        objects: per evidence code for annotations that may still propagate
+        along regulates (gene_bits) and those that may not (cutoff_bits),
+        plus the direct and cross annotated genes. Propagation ORs bitsets
+        along the DAG. Annotation details other than gene, evidence and
+        provenance are dropped, so association file output and removing
+        annotations raise ValueError; the other outputs, map_genes and
+        get_leaves read the bitsets.
+        """
+        self.compact = compact
+        self.gene_index = GeneIndex() if compact else None
         self.heads = []
         self.go_terms = {}
         self.go_obsolete = {}
@@ -22,199 +230,321 @@ class OBO:
         self.name2synonyms = {}
         self.populated = False
         self._meta = {}
+        self._closure = None
 
         if obo_file:
             self.load_obo(obo_file)
 
     def load_obo(self, obo_file, remote_location=False, timeout=5):
+        """Load the terms of an obo file, or of a URL with remote_location.
 
+        The file is read one line at a time, so remote ontologies are parsed
+        as they download. Metadata is read from the header before the first
+        stanza; term tags are dispatched to their parsers by tag.
+        """
+        return self._read_obo(_open_obo(obo_file, remote_location, timeout))
+
+    def load_obo_cached(self, obo_file, cache_dir, remote_location=False,
+                        timeout=5):
+        """Load an obo file, or a URL with remote_location, through
+        cache_dir: the parsed ontology is saved there under the sha1 of the
+        obo content and loaded from that cache while the content is the
+        same"""
         if remote_location:
-            obo = urllib2.urlopen(obo_file, timeout=timeout)
-            lines = obo.readlines()
+            obo = urlopen(obo_file, timeout=timeout)
         else:
-            obo = open(obo_file, 'r')
-            lines = obo.readlines()
+            obo = open(obo_file, 'rb')
+        try:
+            content = obo.read()
+        finally:
+            obo.close()
+
+        key = hashlib.sha1(('%i\n' % _CACHE_VERSION).encode())
+        key.update(content)
+        filename = os.path.join(cache_dir, key.hexdigest() + '.obo.pkl')
+        if os.path.exists(filename):
+            logger.info('Loading cached ontology %s', filename)
+            return self.load_cache(filename)
+
+        self._read_obo(_text_lines(io.BytesIO(content)))
+        del content
+        tmp_file = '%s.%i.tmp' % (filename, os.getpid())
+        try:
+            if not os.path.isdir(cache_dir):
+                os.makedirs(cache_dir)
+            self.save_cache(tmp_file)
+            os.rename(tmp_file, filename)
+        except (IOError, OSError) as e:
+            # The ontology is loaded either way
+            logger.warning('Could not cache ontology in %s: %s', cache_dir, e)
+        return True
 
-        inside = False
-        gterm = None
-        for line in lines:
-            fields = line.rstrip().split()
+    def save_cache(self, cache_file):
+        """Save the parsed terms, relationships and metadata, without
+        annotations, to cache_file for load_cache"""
+        terms = list(self.go_terms.values()) + list(self.go_obsolete.values())
+        # Terms refer to each other by position in terms
+        position = dict((id(gterm), i) for i, gterm in enumerate(terms))
+
+        def positions(gterms):
+            return [position[id(gterm)] for gterm in gterms]
+
+        cache = {
+            'version': _CACHE_VERSION,
+            'meta': self._meta,
+            'alt_id2std_id': self.alt_id2std_id,
+            'name2synonyms': self.name2synonyms,
+            'current': len(self.go_terms),
+            'heads': positions(self.heads),
+            'terms': [(gterm.go_id, gterm.head, gterm.obsolete, gterm.name,
+                       gterm.fullname, gterm.namespace, gterm.desc,
+                       gterm.alt_id, gterm.synonyms, gterm.xrefs,
+                       positions(gterm.is_a),
+                       positions(gterm.relationship_regulates),
+                       positions(gterm.relationship_part_of),
+                       positions(gterm.parent_of))
+                      for gterm in terms],
+        }
+        with open(cache_file, 'wb') as f:
+            pickle.dump(cache, f, pickle.HIGHEST_PROTOCOL)
+
+    def load_cache(self, cache_file):
+        """Load the terms of a cache file written by save_cache"""
+        collect = gc.isenabled()
+        gc.disable()
+        try:
+            with open(cache_file, 'rb') as f:
+                cache = pickle.load(f)
+            if cache.get('version') != _CACHE_VERSION:
+                raise ValueError('Unsupported ontology cache version %s in %s'
+                                 % (cache.get('version'), cache_file))
+
+            terms = []
+            for fields in cache['terms']:
+                gterm = GOTerm(fields[0])
+                gterm.gene_index = self.gene_index
+                (gterm.head, gterm.obsolete, gterm.name, gterm.fullname,
+                 gterm.namespace, gterm.desc, gterm.alt_id, gterm.synonyms,
+                 gterm.xrefs) = fields[1:10]
+                terms.append(gterm)
+
+            for gterm, fields in zip(terms, cache['terms']):
+                is_a, regulates, part_of, children = fields[10:]
+                gterm.is_a = [terms[i] for i in is_a]
+                gterm.relationship_regulates = [terms[i] for i in regulates]
+                gterm.relationship_part_of = [terms[i] for i in part_of]
+                gterm.child_of = set(gterm.is_a + gterm.relationship_regulates +
+                                     gterm.relationship_part_of)
+                gterm.parent_of = set([terms[i] for i in children])
+
+            current = cache['current']
+            self.go_terms.update((gterm.go_id, gterm) for gterm in terms[:current])
+            self.go_obsolete.update((gterm.go_id, gterm) for gterm in terms[current:])
+            self.heads.extend(terms[i] for i in cache['heads'])
+            self.alt_id2std_id.update(cache['alt_id2std_id'])
+            self.name2synonyms.update(cache['name2synonyms'])
+            self._meta.update(cache['meta'])
+        finally:
+            if collect:
+                gc.enable()
+            self.invalidate_closure()
 
-            if len(fields) < 1:
-                continue
+        return True
 
-            # Load the meta data commonly included at the
-            # start of the obo file.
-            # Example keys: format-version, data-version, etc
-            elif not inside and not len(self.go_terms.keys()) and len(fields) > 1:
-                key = fields[0]
-                if key.endswith(':'):
-                    key = key[:-1]
-                self._meta[key] = fields[1]
-
-            # Term definition block
-            elif fields[0] == '[Term]':
-                if gterm:
-                    if gterm.head:
-                        self.heads.append(gterm)
-                inside = True
-
-            # Relationship definition block
-            elif fields[0] == '[Typedef]':
-                if gterm:
-                    if gterm.head:
-                        self.heads.append(gterm)
-                inside = False
-
-            # Term identifier field (e.g. GO:00008150)
-            elif inside and fields[0] == 'id:':
-                if fields[1] in self.go_terms:
-                    gterm = self.go_terms[fields[1]]
-                else:
-                    gterm = GOTerm(fields[1])
-                    self.go_terms[gterm.get_id()] = gterm
-
-            # Term name field (e.g. biological process)
-            elif inside and fields[0] == 'name:':
-                # Term name is underscore delimited; term fullname is
-                # space delimited
-                fields.pop(0)
-                gterm.fullname = ' '.join(fields)
-                name = '_'.join(fields)
-                name = name.replace('\'', '')
-                name = re.sub('[^\w\s_-]', '_', name).strip().lower()
-                name = re.sub('[-\s_]+', '_', name)
-                gterm.name = name
-
-            # Ontology namespace field (e.g. molecular function)
-            elif inside and fields[0] == 'namespace:':
-                gterm.namespace = fields[1]
-
-            # Term definition field (e.g. "The maintenance of the...")
-            elif inside and fields[0] == 'def:':
-                gterm.desc = ' '.join(fields[1:]).split('\"')[1]
-
-            # Alternative identifiers, likely historical, now obsolete terms
-            elif inside and fields[0] == 'alt_id:':
-                gterm.alt_id.append(fields[1])
-                self.alt_id2std_id[fields[1]] = gterm.get_id()
-
-            # is_a relationship field
-            elif inside and fields[0] == 'is_a:':
-                # If term has a parent, it can't be a head (root) term
-                gterm.head = False
-
-                fields.pop(0)
-                pgo_id = fields.pop(0)
-                if pgo_id not in self.go_terms:
-                    self.go_terms[pgo_id] = GOTerm(pgo_id)
-
-                gterm.is_a.append(self.go_terms[pgo_id])
-                self.go_terms[pgo_id].parent_of.add(gterm)
-                gterm.child_of.add(self.go_terms[pgo_id])
-
-            # Relationship field defined in Typedef
-            # e.g. "relationship: regulates GO:0000XXX"
-            elif inside and fields[0] == 'relationship:':
-                if fields[1].find('has_part') != -1:
-                    # has part is not a parental relationship -- it is actually
-                    # for children.
+    def _read_obo(self, obo):
+        """Parse the text lines of obo, then close it"""
+        parsers = {
+            'name:': self._parse_name,
+            'namespace:': self._parse_namespace,
+            'def:': self._parse_def,
+            'alt_id:': self._parse_alt_id,
+            'is_a:': self._parse_is_a,
+            'relationship:': self._parse_relationship,
+            'is_obsolete:': self._parse_obsolete,
+            'synonym:': self._parse_synonym,
+            'xref:': self._parse_xref,
+        }
+
+        header, inside, gterm = True, False, None
+        # The term graph is all reference cycles; collecting while it grows
+        # rescans it repeatedly, so collection waits for the parse to end
+        collect = gc.isenabled()
+        gc.disable()
+        try:
+            for line in obo:
+                fields = line.split(None, 1)
+                if not fields:
                     continue
+                tag = fields[0]
+
+                # Stanza start: [Term] blocks define terms, other blocks
+                # (e.g. [Typedef] relationship definitions) are skipped
+                if tag[0] == '[':
+                    self._end_term(gterm)
+                    header, inside, gterm = False, tag == '[Term]', None
+                elif inside:
+                    if len(fields) < 2:
+                        continue
+                    if tag == 'id:':
+                        gterm = self._add_term(fields[1].split(None, 1)[0])
+                    elif gterm is not None:
+                        parser = parsers.get(tag)
+                        if parser is not None:
+                            parser(gterm, fields[1])
+
+                # Header metadata, e.g. format-version, data-version
+                elif header and len(fields) > 1:
+                    key = tag[:-1] if tag.endswith(':') else tag
+                    self._meta[key] = fields[1].split(None, 1)[0]
+            self._end_term(gterm)
+        finally:
+            obo.close()
+            if collect:
+                gc.enable()
+            self.invalidate_closure()
 
-                # If term has a parent, it can't be a head (root) term
-                gterm.head = False
+        return True
 
-                pgo_id = fields[2]
-                if pgo_id not in self.go_terms:
-                    self.go_terms[pgo_id] = GOTerm(pgo_id)
+    def _add_term(self, go_id):
+        # Terms may be referenced as parents before their own stanza
+        gterm = self.go_terms.get(go_id)
+        if gterm is None:
+            gterm = self.go_terms[go_id] = GOTerm(go_id)
+            gterm.gene_index = self.gene_index
+        return gterm
+
+    def _end_term(self, gterm):
+        # A term without parents is a head (root) term
+        if gterm is not None and gterm.head:
+            self.heads.append(gterm)
+
+    def _parse_name(self, gterm, value):
+        # Term name is underscore delimited; term fullname is space delimited
+        gterm.fullname = ' '.join(value.split())
+        gterm.name = _NAME_SEP.sub('_', gterm.fullname.replace('\'', '')).lower()
+
+    def _parse_namespace(self, gterm, value):
+        gterm.namespace = value.split(None, 1)[0]
+
+    def _parse_def(self, gterm, value):
+        # Term definition (e.g. "The maintenance of the...")
+        gterm.desc = ' '.join(value.split()).split('"')[1]
+
+    def _parse_alt_id(self, gterm, value):
+        # Alternative identifiers, likely historical, now obsolete terms
+        alt_id = value.split(None, 1)[0]
+        gterm.alt_id.append(alt_id)
+        self.alt_id2std_id[alt_id] = gterm.get_id()
+
+    def _parse_is_a(self, gterm, value):
+        # If term has a parent, it can't be a head (root) term
+        gterm.head = False
+
+        parent = self._add_term(value.split(None, 1)[0])
+        gterm.is_a.append(parent)
+        parent.parent_of.add(gterm)
+        gterm.child_of.add(parent)
+
+    def _parse_relationship(self, gterm, value):
+        # Relationship defined in a Typedef, e.g. "regulates GO:0000XXX"
+        fields = value.split(None, 2)
+        relation = fields[0]
+        if 'has_part' in relation:
+            # has part is not a parental relationship -- it is actually
+            # for children.
+            return
 
-                # Check which relationship you are with this parent go term
-                if fields[1] == 'regulates' or \
-                        fields[1] == 'positively_regulates' or \
-                        fields[1] == 'negatively_regulates':
-                    gterm.relationship_regulates.append(self.go_terms[pgo_id])
-                elif fields[1] == 'part_of':
-                    gterm.relationship_part_of.append(self.go_terms[pgo_id])
-                else:
-                    logger.info(
-                        "Unknown relationship %s",
-                        self.go_terms[pgo_id].name)
-                    continue
-                self.go_terms[pgo_id].parent_of.add(gterm)
-                gterm.child_of.add(self.go_terms[pgo_id])
-
-            # Term obsolete flag
-            elif inside and fields[0] == 'is_obsolete:':
-                # If term is obsolete, it can't be a root term
-                gterm.head = False
-
-                # Only keep current terms
-                del self.go_terms[gterm.get_id()]
-
-                gterm.obsolete = True
-                self.go_obsolete[gterm.get_id()] = gterm
-
-            # Term name synonyms
-            elif inside and fields[0] == 'synonym:':
-                syn = ' '.join(fields[1:]).split('\"')[1]
-                syn = syn.replace('lineage name: ', '')
-                gterm.synonyms.append(syn)
-                if gterm.name in self.name2synonyms:
-                    self.name2synonyms[gterm.name].append(syn)
-                else:
-                    self.name2synonyms[gterm.name] = [syn]
+        # If term has a parent, it can't be a head (root) term
+        gterm.head = False
 
-            # Term id mapping to another resources (e.g. OMIM, Wikipedia)
-            elif inside and fields[0] == 'xref:':
-                tok = fields[1].split(':')
-                if len(tok) > 1:
-                    (xrefdb, xrefid) = tok[:2]
-                    gterm.xrefs.setdefault(xrefdb, set()).add(xrefid)
+        parent = self._add_term(fields[1])
+        if relation in _REGULATES:
+            gterm.relationship_regulates.append(parent)
+        elif relation == 'part_of':
+            gterm.relationship_part_of.append(parent)
+        else:
+            logger.info("Unknown relationship %s", parent.name)
+            return
+        parent.parent_of.add(gterm)
+        gterm.child_of.add(parent)
 
-        return True
+    def _parse_obsolete(self, gterm, value):
+        # If term is obsolete, it can't be a root term
+        gterm.head = False
+
+        # Only keep current terms
+        self.go_terms.pop(gterm.get_id(), None)
+
+        gterm.obsolete = True
+        self.go_obsolete[gterm.get_id()] = gterm
+
+    def _parse_synonym(self, gterm, value):
+        syn = ' '.join(value.split()).split('"')[1]
+        syn = syn.replace('lineage name: ', '')
+        gterm.synonyms.append(syn)
+        self.name2synonyms.setdefault(gterm.name, []).append(syn)
+
+    def _parse_xref(self, gterm, value):
+        # Term id mapping to another resources (e.g. OMIM, Wikipedia)
+        tok = value.split(None, 1)[0].split(':')
+        if len(tok) > 1:
+            (xrefdb, xrefid) = tok[:2]
+            gterm.xrefs.setdefault(xrefdb, set()).add(xrefid)
 
     def propagate(self):
         """Propagate all gene annotations"""
         logger.info("Propagate gene annotations")
-        for head_gterm in self.heads:
-            logger.info("Propagating %s", head_gterm.name)
-            self._propagate_recurse(head_gterm)
-
-    def _propagate_recurse(self, gterm):
-        if not len(gterm.parent_of):
-            logger.debug("Base case with term %s", gterm.name)
-            return
-
-        for child_term in gterm.parent_of:
-            self._propagate_recurse(child_term)
-            new_annotations = set()
-
-            regulates_relation = (gterm in child_term.relationship_regulates)
-            part_of_relation = (gterm in child_term.relationship_part_of)
-
-            for annotation in child_term.annotations:
-                copied_annotation = None
-                # If this relation with child is a regulates (and its sub class)
-                # filter annotations
-                if regulates_relation:
-                    # Only add annotations that didn't come from a part_of or
-                    # regulates relationship. "ready_regulates_cutoff" indicates
-                    # the annotation was propagated from a regulates or part_of
-                    # relationship already.
-                    # See: http://www.geneontology.org/page/ontology-relations##reg_reas
-                    if annotation.ready_regulates_cutoff:
-                        continue
-                    else:
-                        copied_annotation = annotation.prop_copy(
-                            ready_regulates_cutoff=True)
-                elif part_of_relation:
-                    copied_annotation = annotation.prop_copy(
-                        ready_regulates_cutoff=True)
+        order = self._propagation_order()
+        # Only terms below the heads receive annotations
+        below_heads = set(order)
+        # One shared object per distinct propagated annotation
+        flyweights = {}
+        for gterm in order:
+            # Copies of the term's annotations along each kind of relation,
+            # made once and shared by all its parents
+            copies = {}
+            for parent in gterm.child_of:
+                if parent not in below_heads:
+                    continue
+                if parent in gterm.relationship_regulates:
+                    relation = 'regulates'
+                elif parent in gterm.relationship_part_of:
+                    relation = 'part_of'
                 else:
-                    copied_annotation = annotation.prop_copy()
-
-                new_annotations.add(copied_annotation)
-            gterm.annotations = gterm.annotations | new_annotations
+                    relation = 'is_a'
+                if self.compact:
+                    _propagate_bits(gterm, parent, relation)
+                    continue
+                if relation not in copies:
+                    copies[relation] = _propagated(gterm.annotations, relation,
+                                                   flyweights)
+                parent.annotations |= copies[relation]
+
+    def _propagation_order(self):
+        """Return the terms below the heads, each after all of its children"""
+        reachable, stack = set(), list(self.heads)
+        while stack:
+            gterm = stack.pop()
+            if gterm not in reachable:
+                reachable.add(gterm)
+                stack.extend(gterm.parent_of)
+
+        # Children still to be propagated into each term
+        pending = dict((gterm, len(gterm.parent_of)) for gterm in reachable)
+        ready = [gterm for gterm, n in pending.items() if not n]
+        order = []
+        while ready:
+            gterm = ready.pop()
+            order.append(gterm)
+            for parent in gterm.child_of:
+                if parent in reachable:
+                    pending[parent] -= 1
+                    if not pending[parent]:
+                        ready.append(parent)
+        if len(order) < len(reachable):
+            logger.warning('Ontology has cycles, %i terms not propagated',
+                           len(reachable) - len(order))
+        return order
 
     def get_term(self, tid):
         """Return GOTerm object corresponding with id=tid"""
@@ -271,15 +601,16 @@ class OBO:
         gmt = GMT()
         tlist = sorted(self.get_termobject_list())
         for term in tlist:
-            if len(term.annotations):
+            genes = term.get_annotated_genes()
+            if genes:
                 gmt.add_geneset(gsid=term.go_id, name=term.name)
-            for annotation in term.annotations:
-                gmt.add_gene(term.go_id, annotation.gid)
+            for gid in genes:
+                gmt.add_gene(term.go_id, gid)
         return gmt
 
     def map_genes(self, id_name):
         """Map gene names using the idmap object id_name"""
-        for go_term in self.go_terms.itervalues():
+        for go_term in self.go_terms.values():
             go_term.map_genes(id_name)
 
     def populate_annotations(self, annotation_file, xdb_col=0,
@@ -325,6 +656,9 @@ class OBO:
             if go_term is None:
                 continue
             logger.info('Gene %s and term %s', gene, go_term.go_id)
+            if self.compact:
+                go_term.add_bit(gene, evidence=ev, direct=True)
+                continue
             annotation = Annotation(
                 xdb=xdb,
                 gid=gene,
@@ -339,7 +673,7 @@ class OBO:
 
     def populate_annotations_from_gmt(self, gmt):
         """Populate the ontology with gene annotations from a GMT file"""
-        for (gsid, genes) in gmt.genesets.iteritems():
+        for (gsid, genes) in gmt.genesets.items():
             term = self.get_term(gsid)
             if term:
                 for gid in genes:
@@ -359,56 +693,42 @@ class OBO:
         go_term = self.get_term(go_id)
         if not go_term:
             return False
+        if self.compact:
+            go_term.add_bit(gid, direct=direct)
+            return True
         annot = Annotation(xdb=None, gid=gid, direct=direct, ref=ref)
         go_term.annotations.add(annot)
         return True
 
-    def get_descendents(self, gterm):
-        """Return propagated descendents of term"""
-        if gterm not in self.go_terms:
-            return set()
-        term = self.go_terms[gterm]
-
-        if len(term.parent_of) == 0:
-            return set()
+    def get_closure(self):
+        """Return the TermClosure of the ontology, built on first use"""
+        if self._closure is None:
+            self._closure = TermClosure(self.go_terms)
+        return self._closure
 
-        child_terms = set()
-        for child_term in term.parent_of:
-            if child_term.namespace != term.namespace:
-                logger.info("Parent and child terms are different namespaces: %s and %s",
-                        parent_term, term)
-                continue
-            child_terms.add(child_term.go_id)
-            child_terms = child_terms | self.get_descendents(child_term.go_id)
+    def invalidate_closure(self):
+        """Drop the TermClosure, e.g. after editing term relationships.
+        Loading an obo file invalidates it."""
+        self._closure = None
 
-        return child_terms
+    def get_descendents(self, gterm):
+        """Return propagated descendents of term, in the term's namespace"""
+        return self.get_closure().get_descendents(gterm)
 
     def get_ancestors(self, gterm):
-        """Return propagated ancestors of term"""
-        if (gterm in self.go_terms) is False:
-            return set()
-        term = self.go_terms[gterm]
+        """Return propagated ancestors of term, in the term's namespace"""
+        return self.get_closure().get_ancestors(gterm)
 
-        if len(term.child_of) == 0:
-            return set()
-
-        parent_terms = set()
-        for parent_term in term.child_of:
-            if parent_term.namespace != term.namespace:
-                logger.info("Parent and child terms are different namespaces: %s and %s",
-                        parent_term, term)
-                continue
-            parent_terms.add(parent_term.go_id)
-            parent_terms = parent_terms | self.get_ancestors(parent_term.go_id)
-
-        return parent_terms
+    def is_ancestor(self, ancestor, gterm):
+        """Return whether term ancestor is a propagated ancestor of term"""
+        return self.get_closure().is_ancestor(ancestor, gterm)
 
     def get_leaves(self, namespace='biological_process', min_annot=10):
         """Return a set of leaf terms from the ontology"""
         leaves, bottom = set(), set()
         for term in self.go_terms.values():
-            if len(term.parent_of) == 0 and term.namespace == namespace and len(
-                    term.annotations) >= min_annot:
+            if len(term.parent_of) == 0 and term.namespace == namespace and \
+                    term.get_annotation_size() >= min_annot:
                 leaves.add(term)
         return leaves
 
@@ -429,12 +749,18 @@ class OBO:
     def print_to_single_file(self, out_file, terms=None,
                              p_namespace=None, gene_asso_format=False):
         logger.info('print_to_single_file')
+        if self.compact and gene_asso_format:
+            raise ValueError('Compact annotations have no association details')
         tlist = sorted(
             self.get_termobject_list(
                 terms=terms,
                 p_namespace=p_namespace))
         f = open(out_file, 'w')
         for term in tlist:
+            if self.compact:
+                for gid in term.get_annotated_genes():
+                    print(term.go_id + '\t' + term.name + '\t' + gid, file=f)
+                continue
             for annotation in term.annotations:
                 if gene_asso_format:
                     to_print = [annotation.xdb if annotation.xdb else '',
@@ -456,9 +782,9 @@ class OBO:
                                 # cross_annotation (e.g. bootstrap value,
                                 # p-value)
                                 str(annotation.ortho_evidence) if annotation.ortho_evidence else '', '', '']
-                    print >> f, '\t'.join([str(x) for x in to_print])
+                    print('\t'.join([str(x) for x in to_print]), file=f)
                 else:
-                    print >> f, term.go_id + '\t' + term.name + '\t' + annotation.gid
+                    print(term.go_id + '\t' + term.name + '\t' + annotation.gid, file=f)
         f.close()
 
     def print_to_gmt_file(self, out_file, terms=None, p_namespace=None):
@@ -469,12 +795,10 @@ class OBO:
                 p_namespace=p_namespace))
         f = open(out_file, 'w')
         for term in tlist:
-            genes = set()
-            for annotation in term.annotations:
-                genes.add(annotation.gid)
+            genes = set(term.get_annotated_genes())
             if len(genes) > 0:
-                print >> f, term.go_id + '\t' + term.name + \
-                    '\t' + '\t'.join(genes)
+                print(term.go_id + '\t' + term.name +
+                      '\t' + '\t'.join(genes), file=f)
         f.close()
 
     def print_to_mat_file(self, out_file, terms=None, p_namespace=None):
@@ -489,94 +813,137 @@ class OBO:
         genedict = defaultdict(set)
         termlist = []
         for term in tlist:
-            if len(term.annotations) == 0:
+            genes = term.get_annotated_genes()
+            if len(genes) == 0:
                 continue
 
             termlist.append(term.go_id)
 
-            for annotation in term.annotations:
-                allgenes.add(annotation.gid)
-                genedict[annotation.gid].add(term.go_id)
+            for gid in genes:
+                allgenes.add(gid)
+                genedict[gid].add(term.go_id)
 
-        print >> f, '\t' + '\t'.join(termlist)
+        print('\t' + '\t'.join(termlist), file=f)
         for g in list(allgenes):
             row = []
             row.append(g)
             for termid in termlist:
                 row.append('1' if termid in genedict[g] else '0')
-            print >> f, '\t'.join(row)
+            print('\t'.join(row), file=f)
         f.close()
 
 
 class Annotation(object):
+    """Immutable gene annotation of a term.
+
+    Annotations are held by the million once propagated, so they have slots,
+    their hash is computed once, and their strings are interned.
+    """
+
+    __slots__ = ('xdb', 'gid', 'ref', 'evidence', 'date', 'direct',
+                 'cross_annotated', 'origin', 'ortho_evidence',
+                 'ready_regulates_cutoff', '_hash')
 
     def __init__(self, xdb=None, gid=None, ref=None, evidence=None, date=None, direct=False,
                  cross_annotated=False, origin=None, ortho_evidence=None, ready_regulates_cutoff=False):
+        set_field = super(Annotation, self).__setattr__
         # Annotation source
-        super(Annotation, self).__setattr__('xdb', xdb)
+        set_field('xdb', _interned(xdb))
         # Gene identifier
-        super(Annotation, self).__setattr__('gid', gid)
+        set_field('gid', _interned(gid))
 
         # Publication reference
-        super(Annotation, self).__setattr__('ref', ref)
+        set_field('ref', _interned(ref))
 
         # Evidence code
-        super(Annotation, self).__setattr__('evidence', evidence)
+        set_field('evidence', _interned(evidence))
 
         # Date of annotation
-        super(Annotation, self).__setattr__('date', date)
+        set_field('date', _interned(date))
 
         # Direct annotation or possibly propagated
-        super(Annotation, self).__setattr__('direct', direct)
+        set_field('direct', direct)
 
         # Annotated from another organism
-        super(Annotation, self).__setattr__('cross_annotated', cross_annotated)
-        super(Annotation, self).__setattr__('origin', origin)
-        super(Annotation, self).__setattr__('ortho_evidence', ortho_evidence)
+        set_field('cross_annotated', cross_annotated)
+        set_field('origin', origin)
+        set_field('ortho_evidence', ortho_evidence)
 
         # Boolean indicating whether the annotation can be propagated along a
         # regulates relationship.
         # See: http://www.geneontology.org/page/ontology-relations##reg_reas
-        super(
-            Annotation,
-            self).__setattr__(
-            'ready_regulates_cutoff',
-            ready_regulates_cutoff)
+        set_field('ready_regulates_cutoff', ready_regulates_cutoff)
+
+        set_field('_hash', hash(self._key()))
 
-    def prop_copy(self, ready_regulates_cutoff=None):
+    def _key(self):
+        return (self.xdb, self.gid, self.ref, self.evidence, self.date,
+                self.direct, self.cross_annotated, self.ortho_evidence,
+                self.ready_regulates_cutoff, self.origin)
+
+    def prop_copy(self, ready_regulates_cutoff=None, flyweights=None):
+        """Return the propagated form of the annotation: not direct, not
+        cross annotated, and with ready_regulates_cutoff if given.
+
+        An annotation already in that form is its own copy. Copies are
+        shared through the dict flyweights if given, so equal propagated
+        annotations are one object.
+        """
         if ready_regulates_cutoff is None:
             ready_regulates_cutoff = self.ready_regulates_cutoff
-
-        return Annotation(xdb=self.xdb, gid=self.gid, ref=self.ref,
-                          evidence=self.evidence, date=self.date, direct=False, cross_annotated=False,
-                          ortho_evidence=self.ortho_evidence, ready_regulates_cutoff=ready_regulates_cutoff)
+        if not (self.direct or self.cross_annotated) and self.origin is None \
+                and self.ready_regulates_cutoff == ready_regulates_cutoff:
+            return self
+
+        key = (self.xdb, self.gid, self.ref, self.evidence, self.date,
+               False, False, self.ortho_evidence, ready_regulates_cutoff, None)
+        copy = flyweights.get(key) if flyweights is not None else None
+        if copy is None:
+            copy = Annotation(xdb=self.xdb, gid=self.gid, ref=self.ref,
+                              evidence=self.evidence, date=self.date, direct=False, cross_annotated=False,
+                              ortho_evidence=self.ortho_evidence, ready_regulates_cutoff=ready_regulates_cutoff)
+            if flyweights is not None:
+                flyweights[key] = copy
+        return copy
+
+    def __reduce__(self):
+        # Rebuilt through __init__, as the fields cannot be set
+        return (Annotation, (self.xdb, self.gid, self.ref, self.evidence,
+                             self.date, self.direct, self.cross_annotated,
+                             self.origin, self.ortho_evidence,
+                             self.ready_regulates_cutoff))
 
     def __hash__(self):
-        return hash((self.xdb, self.gid, self.ref, self.evidence, self.date,
-                     self.direct, self.cross_annotated, self.ortho_evidence,
-                     self.ready_regulates_cutoff, self.origin))
+        return self._hash
 
     def __eq__(self, other):
-        return (self.xdb, self.gid, self.ref, self.evidence, self.date,
-                self.direct, self.cross_annotated, self.ortho_evidence,
-                self.ready_regulates_cutoff, self.origin).__eq__((other.xdb,
-                                                                  other.gid, other.ref, other.evidence, other.date,
-                                                                  other.direct, other.cross_annotated, other.ortho_evidence,
-                                                                  other.ready_regulates_cutoff, other.origin))
+        return self is other or (self._hash == other._hash and
+                                 self._key() == other._key())
+
+    def __ne__(self, other):
+        return not self == other
 
     def __setattr__(self, *args):
         raise TypeError("Attempt to modify immutable object.")
     __delattr__ = __setattr__
 
 
-class GOTerm:
+class GOTerm(object):
+
+    __slots__ = ('head', 'go_id', '_hash', 'annotations', 'is_a',
+                 'relationship_regulates', 'relationship_part_of',
+                 'parent_of', 'child_of', 'alt_id', 'desc', 'name',
+                 'namespace', 'fullname', 'synonyms', 'xrefs', 'obsolete',
+                 'gene_index', 'gene_bits', 'cutoff_bits', 'direct_bits',
+                 'cross_bits')
 
     def __init__(self, go_id):
         # Indicator of whether the term is a root node
         self.head = True
 
-        # Term identifier
+        # Term identifier, and its hash
         self.go_id = go_id
+        self._hash = hash(go_id)
 
         # Set of gene annotations
         self.annotations = set([])
@@ -606,6 +973,9 @@ class GOTerm:
         # Term name, delimited by underscores
         self.name = None
 
+        # Term namespace, e.g. biological_process
+        self.namespace = None
+
         # Official term name, unadulterated
         self.fullname = None
 
@@ -618,6 +988,16 @@ class GOTerm:
         # Boolean indicated whether the term is now obsolete
         self.obsolete = False
 
+        # Compact annotations (see OBO): the GeneIndex of the ontology,
+        # evidence code to bitset of genes whose annotations may propagate
+        # along regulates, and whose may not, then direct and cross
+        # annotated genes
+        self.gene_index = None
+        self.gene_bits = {}
+        self.cutoff_bits = {}
+        self.direct_bits = 0
+        self.cross_bits = 0
+
         # As far as I can tell, no longer used (7/13/2017)
         # self.cross_annotated_genes = set([])
         # self.included_in_all = True
@@ -629,8 +1009,23 @@ class GOTerm:
     def __cmp__(self, other):
         return cmp(self.go_id, other.go_id)
 
+    def __eq__(self, other):
+        return isinstance(other, GOTerm) and self.go_id == other.go_id
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __lt__(self, other):
+        return self.go_id < other.go_id
+
     def __hash__(self):
-        return(self.go_id.__hash__())
+        return self._hash
+
+    def __reduce__(self):
+        # Rebuilt from its id first, so the term hashes by the time the
+        # cycles of the term graph add it to sets
+        return (GOTerm, (self.go_id,),
+                (None, dict((name, getattr(self, name)) for name in self.__slots__)))
 
     def __repr__(self):
         return(self.go_id + ': ' + self.name)
@@ -640,15 +1035,18 @@ class GOTerm:
 #
     def map_genes(self, id_name):
         """Map gene ids"""
+        if self.gene_index is not None:
+            for bitsets in (self.gene_bits, self.cutoff_bits):
+                for evidence, bits in list(bitsets.items()):
+                    bitsets[evidence] = self._map_bits(bits, id_name)
+            self.direct_bits = self._map_bits(self.direct_bits, id_name)
+            self.cross_bits = self._map_bits(self.cross_bits, id_name)
+            return
+
         mapped_annotations_set = set([])
         for annotation in self.annotations:
-            mapped_genes = id_name.get(annotation.gid)
-            if mapped_genes is None and 'CELE_' in annotation.gid:
-                mapped_genes = id_name.get(
-                    annotation.gid[5:len(annotation.gid)])
-
+            mapped_genes = _mapped_genes(annotation.gid, id_name)
             if mapped_genes is None:
-                logger.warning('No matching gene id: %s', annotation.gid)
                 continue
             for mgene in mapped_genes:
                 mapped_annotations_set.add(Annotation(xdb=None, gid=mgene,
@@ -659,7 +1057,18 @@ class GOTerm:
                                                       cross_annotated=annotation.cross_annotated))
         self.annotations = mapped_annotations_set
 
+    def _map_bits(self, bits, id_name):
+        # Bitset of the genes of bits mapped through id_name
+        mapped = 0
+        for gid in self.gene_index.decode(bits):
+            for mgene in _mapped_genes(gid, id_name) or []:
+                mapped |= self.gene_index.bit(mgene)
+        return mapped
+
     def get_annotated_genes(self, include_cross_annotated=True):
+        if self.gene_index is not None:
+            return self.gene_index.decode(
+                self.get_annotated_bits(include_cross_annotated))
         genes = []
         for annotation in self.annotations:
             if (not include_cross_annotated) and annotation.cross_annotated:
@@ -667,7 +1076,27 @@ class GOTerm:
             genes.append(annotation.gid)
         return genes
 
+    def get_annotated_bits(self, include_cross_annotated=True):
+        """Return the bitset of genes annotated in compact mode"""
+        bits = self.cross_bits if include_cross_annotated else 0
+        for bitsets in (self.gene_bits, self.cutoff_bits):
+            for evidence_bits in bitsets.values():
+                bits |= evidence_bits
+        return bits
+
+    def add_bit(self, gid, evidence=None, direct=False, cross_annotated=False):
+        """Annotate gene gid in compact mode"""
+        bit = self.gene_index.bit(gid)
+        if cross_annotated:
+            self.cross_bits |= bit
+            return
+        self.gene_bits[evidence] = self.gene_bits.get(evidence, 0) | bit
+        if direct:
+            self.direct_bits |= bit
+
     def remove_annotation(self, annot):
+        if self.gene_index is not None:
+            raise ValueError('Compact annotations cannot be removed')
         try:
             self.annotations.remove(annot)
         except KeyError:
@@ -675,6 +1104,9 @@ class GOTerm:
 
     def add_annotation(self, gid, ref=None, cross_annotated=False,
                        allow_duplicate_gid=True, origin=None, ortho_evidence=None):
+        if self.gene_index is not None:
+            self.add_bit(gid, cross_annotated=cross_annotated)
+            return
         if not allow_duplicate_gid:
             for annotated in self.annotations:
                 if annotated.gid == gid:
@@ -688,6 +1120,8 @@ class GOTerm:
                 ortho_evidence=ortho_evidence))
 
     def get_annotation_size(self):
+        if self.gene_index is not None:
+            return bin(self.get_annotated_bits()).count('1')
         return len(self.annotations)
 
     def get_namespace(self):
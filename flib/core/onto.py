@@ -1,4 +1,6 @@
-from obo import OBO
+import os
+
+from flib.core.obo import OBO
 
 DO_URL = 'https://raw.githubusercontent.com/DiseaseOntology/HumanDiseaseOntology/master/src/ontology/doid-non-classified.obo'
 DO_NAME = 'Disease Ontology'
@@ -6,28 +8,42 @@ DO_NAME = 'Disease Ontology'
 GO_URL = 'http://geneontology.org/ontology/go.obo'
 GO_NAME = 'Gene Ontology'
 
+# Parsed ontologies are cached here, keyed on their obo content. Set
+# FLIB_OBO_CACHE to use another directory, or to nothing to disable it.
+CACHE_DIR = os.environ.get('FLIB_OBO_CACHE', os.path.join(
+    os.path.expanduser('~'), '.cache', 'flib', 'obo'))
+
 
 class Ontology:
 
     @staticmethod
-    def generate(obo_file=None, obo_url=None):
+    def generate(obo_file=None, obo_url=None, cache_dir=CACHE_DIR):
+        """Load an ontology from an obo file or URL, through the parsed
+        ontologies cached in cache_dir unless it is None or empty"""
         onto = OBO()
         if obo_file:
-            onto.load_obo(file=obo_file)
+            if cache_dir:
+                onto.load_obo_cached(obo_file, cache_dir)
+            else:
+                onto.load_obo(obo_file)
         elif obo_url:
-            onto.load_obo(obo_url, remote_location=True, timeout=5)
+            if cache_dir:
+                onto.load_obo_cached(obo_url, cache_dir,
+                                     remote_location=True, timeout=5)
+            else:
+                onto.load_obo(obo_url, remote_location=True, timeout=5)
         return onto
 
 
 class DiseaseOntology():
 
     @staticmethod
-    def generate():
-        return Ontology.generate(obo_url=DO_URL)
+    def generate(cache_dir=CACHE_DIR):
+        return Ontology.generate(obo_url=DO_URL, cache_dir=cache_dir)
 
 
 class GeneOntology:
 
     @staticmethod
-    def generate():
-        return Ontology.generate(obo_url=GO_URL)
+    def generate(cache_dir=CACHE_DIR):
+        return Ontology.generate(obo_url=GO_URL, cache_dir=cache_dir)
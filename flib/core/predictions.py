@@ -0,0 +1,190 @@
+from __future__ import division
+
+import fcntl
+import logging
+import os
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+GENES_FILE = 'genes.txt'
+TERMS_FILE = 'terms.txt'
+LOCK_FILE = '.lock'
+MATRICES = ['scores', 'probs', 'labels']
+
+
+class PredictionStore(object):
+
+    """
+    Predictions of many terms in one directory, as (terms x genes) float32
+    matrices of scores, probabilities and labels (1, -1 or 0).
+
+    The gene index (genes.txt) is fixed when the store is created and the
+    term index (terms.txt) lists the matrix rows in order. Terms are appended
+    as they complete under an exclusive lock on the store, so several
+    processes may write to it; a term's row becomes visible once its line is
+    in the term index. Genes without a prediction hold NaN. A term written
+    again supersedes its earlier row.
+    """
+
+    def __init__(self, directory, genes=None):
+        """
+        Args:
+            directory: store directory, created if missing
+            genes:     gene list of a new store; must match an existing one
+        """
+        self._directory = directory
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+
+        with self._lock():
+            genes_file = self._path(GENES_FILE)
+            if not os.path.exists(genes_file):
+                if genes is None:
+                    raise ValueError('No prediction store in %s' % directory)
+                with open(genes_file, 'w') as f:
+                    f.write(''.join(g + '\n' for g in genes))
+        with open(self._path(GENES_FILE)) as f:
+            self._genes = [l.rstrip('\n') for l in f]
+        if genes is not None and list(genes) != self._genes:
+            raise ValueError('Genes do not match the store in %s' % directory)
+        self._gene_col = dict((g, i) for i, g in enumerate(self._genes))
+
+    @staticmethod
+    def exists(directory):
+        return os.path.exists(os.path.join(directory, GENES_FILE))
+
+    def _path(self, name):
+        return os.path.join(self._directory, name)
+
+    def _lock(self):
+        return _FileLock(self._path(LOCK_FILE))
+
+    def _term_rows(self):
+        # Term -> its latest complete row
+        rows = {}
+        if os.path.exists(self._path(TERMS_FILE)):
+            with open(self._path(TERMS_FILE)) as f:
+                for row, line in enumerate(f):
+                    if line.endswith('\n'):
+                        rows[line[:-1]] = row
+        return rows
+
+    def _nrows(self):
+        if not os.path.exists(self._path(TERMS_FILE)):
+            return 0
+        with open(self._path(TERMS_FILE)) as f:
+            return sum(1 for line in f if line.endswith('\n'))
+
+    def _complete_terms(self):
+        # Number of complete term index lines and their length in bytes
+        if not os.path.exists(self._path(TERMS_FILE)):
+            return 0, 0
+        with open(self._path(TERMS_FILE), 'rb') as f:
+            content = f.read()
+        end = content.rfind(b'\n') + 1
+        return content.count(b'\n'), end
+
+    @property
+    def genes(self):
+        return list(self._genes)
+
+    def terms(self):
+        """Return the terms in the store, in the order first written"""
+        return [t for (t, row) in sorted(self._term_rows().items(),
+                                         key=lambda x: x[1])]
+
+    def append(self, term, predictions, pos_genes, neg_genes):
+        """Add the (gene, score, prob) predictions of term"""
+        scores = np.empty(len(self._genes), dtype=np.float32)
+        probs = np.empty(len(self._genes), dtype=np.float32)
+        scores[:], probs[:] = np.nan, np.nan
+        for (g, s, p) in predictions:
+            col = self._gene_col.get(g)
+            if col is not None:
+                scores[col], probs[col] = s, p
+
+        labels = np.zeros(len(self._genes), dtype=np.float32)
+        labels[[self._gene_col[g] for g in pos_genes if g in self._gene_col]] = 1
+        labels[[self._gene_col[g] for g in neg_genes if g in self._gene_col]] = -1
+
+        row_bytes = len(self._genes) * 4
+        with self._lock():
+            # Write at the end of the complete rows, dropping any partial row
+            # or term line left by an interrupted writer, then publish the row
+            nrows, terms_end = self._complete_terms()
+            offset = nrows * row_bytes
+            for name, values in zip(MATRICES, [scores, probs, labels]):
+                with open(self._path(name + '.f32'), 'ab') as f:
+                    f.truncate(offset)
+                    f.write(values.tobytes())
+            with open(self._path(TERMS_FILE), 'ab') as f:
+                f.truncate(terms_end)
+                f.write((term + '\n').encode('utf-8'))
+
+    def matrix(self, name='scores'):
+        """Return the memory-mapped (terms x genes) matrix of 'scores',
+        'probs' or 'labels', with rows in term index order"""
+        nrows = self._nrows()
+        if not nrows:
+            return np.empty((0, len(self._genes)), dtype=np.float32)
+        return np.memmap(self._path(name + '.f32'), dtype=np.float32,
+                         mode='r', shape=(nrows, len(self._genes)))
+
+    def get_term(self, term):
+        """Return (scores, probs, labels) arrays over genes for term"""
+        row = self._term_rows()[term]
+        return tuple(np.array(self.matrix(name)[row]) for name in MATRICES)
+
+    def get_gene(self, gene):
+        """Return a dict of term -> (score, prob, label) for gene"""
+        col = self._gene_col[gene]
+        rows = self._term_rows()
+        columns = [self.matrix(name)[:, col] for name in MATRICES]
+        return dict((term, tuple(float(c[row]) for c in columns))
+                    for term, row in rows.items())
+
+    def get_predictions(self, term):
+        """Return the (gene, score, prob) predictions of term sorted by
+        score, with the positive and negative genes"""
+        scores, probs, labels = self.get_term(term)
+        predicted = np.nonzero(np.isfinite(scores))[0]
+        order = predicted[np.argsort(-scores[predicted], kind='mergesort')]
+        predictions = [(self._genes[i], float(scores[i]), float(probs[i]))
+                       for i in order]
+        pos_genes = set(self._genes[i] for i in np.nonzero(labels == 1)[0])
+        neg_genes = set(self._genes[i] for i in np.nonzero(labels == -1)[0])
+        return predictions, pos_genes, neg_genes
+
+    def export_text(self, directory, terms=None):
+        """Write one tab-separated predictions file per term, as written by
+        NetworkSVM.print_predictions"""
+        # Imported here so store readers do not load scikit-learn
+        from flib.core.svm import write_predictions
+
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        for term in (terms if terms is not None else self.terms()):
+            predictions, pos_genes, neg_genes = self.get_predictions(term)
+            write_predictions(os.path.join(directory, term), predictions,
+                              pos_genes, neg_genes)
+
+
+class _FileLock(object):
+
+    # Exclusive flock on a lock file for the duration of a with block
+
+    def __init__(self, filename):
+        self._filename = filename
+        self._file = None
+
+    def __enter__(self):
+        self._file = open(self._filename, 'a')
+        fcntl.flock(self._file, fcntl.LOCK_EX)
+        return self
+
+    def __exit__(self, *exc):
+        fcntl.flock(self._file, fcntl.LOCK_UN)
+        self._file.close()
+        self._file = None
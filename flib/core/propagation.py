@@ -0,0 +1,186 @@
+from __future__ import division
+
+import logging
+from operator import itemgetter
+
+import numpy as np
+from scipy import sparse
+from sklearn.model_selection import StratifiedKFold
+
+from flib.core.svm import fit_calibration, write_predictions
+
+logger = logging.getLogger(__name__)
+
+
+class NetworkPropagation(object):
+
+    """
+    Random walk with restart from the positive genes of a term over a Dab.
+
+    The network is symmetrically degree normalized and used in one of three
+    representations:
+        dense:  the full matrix in memory
+        sparse: a CSR matrix of the edges above threshold
+        packed: the Dab triangle itself, expanded block by block on each
+                multiplication (lowest memory)
+
+    Seeds of many terms (and cross-validation folds) are stacked as columns
+    so one sweep of matrix products serves all of them.
+    """
+
+    def __init__(self, dab, representation='dense', threshold=None,
+                 restart=0.5, tol=1e-6, max_iter=100, block_size=1000):
+        self._dab = dab
+        self._representation = representation
+        self._threshold = threshold
+        self._restart = restart
+        self._tol = tol
+        self._max_iter = max_iter
+        self._block_size = block_size
+        self._W = None
+        self._norm = None
+        self._predictions = []
+
+    def _rows(self, start, end):
+        # Network rows without self edges, missing or sub-threshold values
+        rows = self._dab.get_rows(range(start, end))
+        rows[np.arange(end - start), np.arange(start, end)] = 0
+        rows[~np.isfinite(rows)] = 0
+        if self._threshold is not None:
+            rows[rows < self._threshold] = 0
+        return rows
+
+    def _blocks(self):
+        size = self._dab.get_size()
+        for start in range(0, size, self._block_size):
+            end = min(start + self._block_size, size)
+            yield start, end, self._rows(start, end)
+
+    def _build(self):
+        if self._norm is not None:
+            return
+
+        size = self._dab.get_size()
+        degree = np.zeros(size)
+        if self._representation == 'dense':
+            self._W = np.empty((size, size), dtype=np.float32)
+            for start, end, rows in self._blocks():
+                self._W[start:end] = rows
+            degree = self._W.sum(axis=1, dtype=np.float64)
+        elif self._representation == 'sparse':
+            blocks = []
+            for start, end, rows in self._blocks():
+                blocks.append(sparse.csr_matrix(rows))
+            self._W = sparse.vstack(blocks, format='csr')
+            degree = np.asarray(self._W.sum(axis=1), dtype=np.float64).ravel()
+        elif self._representation == 'packed':
+            for start, end, rows in self._blocks():
+                degree[start:end] = rows.sum(axis=1, dtype=np.float64)
+        else:
+            raise ValueError('Unknown representation: %s' % self._representation)
+
+        with np.errstate(divide='ignore'):
+            self._norm = np.where(degree > 0, 1 / np.sqrt(degree), 0)
+
+    def _matvec(self, F):
+        # D^-1/2 W D^-1/2 F
+        G = F * self._norm[:, None]
+        if self._representation == 'packed':
+            out = np.empty_like(G)
+            for start, end, rows in self._blocks():
+                out[start:end] = rows.dot(G)
+        else:
+            out = self._W.dot(G)
+        return out * self._norm[:, None]
+
+    def propagate(self, seeds):
+        """Propagate each column of the (genes x columns) seed matrix.
+
+        Each column is normalized to sum to one and iterated until the
+        largest change in any column is below tol.
+        """
+        self._build()
+        P = np.asarray(seeds, dtype=np.float64)
+        totals = P.sum(axis=0)
+        P = P / np.where(totals > 0, totals, 1)
+
+        F = P.copy()
+        for it in range(self._max_iter):
+            F_next = (1 - self._restart) * self._matvec(F) + self._restart * P
+            delta = np.abs(F_next - F).max() if F.size else 0
+            F = F_next
+            if delta < self._tol:
+                logger.info('Converged after %i iterations', it + 1)
+                break
+        else:
+            logger.warning('No convergence after %i iterations', self._max_iter)
+        return F
+
+    def predict_many(self, label_sets, prob_fit='SIGMOID', cv_folds=5,
+                     max_columns=500):
+        """Score all genes for many terms at once.
+
+        Args:
+            label_sets:  dict of term -> (pos_genes, neg_genes)
+            prob_fit:    'SIGMOID' or 'ISO' calibration of scores
+            cv_folds:    labeled genes are scored with their fold's positives
+                         held out of the seeds
+            max_columns: number of seed columns propagated together
+
+        Returns:
+            dict of term -> list of (gene, score, prob) sorted by score
+        """
+        size = self._dab.get_size()
+
+        # One seed column per term and fold
+        columns, folds = [], {}
+        for term, (pos_genes, neg_genes) in label_sets.items():
+            genes = [g for g in (pos_genes | neg_genes)
+                     if self._dab.get_index(g) is not None]
+            idx = np.array([self._dab.get_index(g) for g in genes], dtype=np.int64)
+            y = np.array([1 if g in pos_genes else -1 for g in genes])
+
+            kf = StratifiedKFold(n_splits=cv_folds, shuffle=True, random_state=0)
+            folds[term] = (idx, y, [])
+            for train, test in kf.split(idx, y):
+                folds[term][2].append((len(columns), test))
+                columns.append(idx[train][y[train] == 1])
+
+        scores = np.empty((size, len(columns)))
+        for start in range(0, len(columns), max_columns):
+            end = min(start + max_columns, len(columns))
+            seeds = np.zeros((size, end - start))
+            for c in range(start, end):
+                seeds[columns[c], c - start] = 1
+            logger.info('Propagating %i seed columns', end - start)
+            scores[:, start:end] = self.propagate(seeds)
+
+        predictions = {}
+        for term, (idx, y, term_folds) in folds.items():
+            cols = [c for (c, test) in term_folds]
+            term_scores = np.median(scores[:, cols], axis=1)
+
+            # Labeled genes get the score from the fold that held them out
+            train_scores = np.empty(len(idx))
+            for c, test in term_folds:
+                train_scores[test] = scores[idx[test], c]
+            term_scores[idx] = train_scores
+
+            calibration = fit_calibration(train_scores, y, prob_fit)
+            term_probs = calibration.predict(term_scores)
+
+            predictions[term] = sorted(
+                zip(self._dab.gene_list, term_scores, term_probs),
+                key=itemgetter(1), reverse=True)
+
+        return predictions
+
+    def predict(self, pos_genes, neg_genes, prob_fit='SIGMOID', cv_folds=5):
+        """Score all genes from the positive genes of one term"""
+        self._predictions = self.predict_many(
+            {None: (pos_genes, neg_genes)},
+            prob_fit=prob_fit, cv_folds=cv_folds)[None]
+        return self._predictions
+
+    def print_predictions(self, ofile, pos_genes, neg_genes):
+        write_predictions(ofile, self._predictions, pos_genes, neg_genes)
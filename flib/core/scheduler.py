@@ -0,0 +1,124 @@
+from __future__ import division
+from __future__ import print_function
+
+import logging
+import os
+import sys
+import time
+from multiprocessing import Pool
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# Shared with pool workers (set by the pool initializer)
+_worker_func = None
+
+
+def _init_worker(func):
+    global _worker_func
+    _worker_func = func
+
+
+def _run_job(job):
+    start = time.time()
+    result = _worker_func(job)
+    return os.getpid(), start, time.time(), result
+
+
+def estimate_costs(sizes, records=()):
+    """Estimate the run time of each term.
+
+    Terms with a recorded time in records (RunManifest done records) use
+    their latest time. Others are scaled from their number of labeled genes
+    by the seconds per gene fitted to the recorded terms, or cost their
+    number of labeled genes without history.
+
+    Args:
+        sizes:   dict of term -> number of labeled genes
+        records: manifest records with 'term', 'seconds' and 'size'
+
+    Returns:
+        dict of term -> estimated cost
+    """
+    seconds, timed = {}, []
+    for record in records:
+        if record.get('event') == 'done' and record.get('seconds') is not None:
+            seconds[record['term']] = record['seconds']
+            if record.get('size'):
+                timed.append((record['size'], record['seconds']))
+
+    rate = 1.
+    if timed:
+        x, y = np.array(timed, dtype=np.float64).T
+        rate = x.dot(y) / x.dot(x)
+
+    return dict((term, seconds.get(term, rate * size))
+                for term, size in sizes.items())
+
+
+class TermScheduler(object):
+
+    """
+    Run jobs across a pool largest estimated cost first, one job per
+    dispatch, so long terms start early and short terms fill in behind them.
+    Results are yielded to the caller as they complete, and the busy time
+    of each worker is kept for a utilization report.
+    """
+
+    def __init__(self, processes):
+        self._processes = processes
+        self._busy = {}
+        self._wall = 0.
+
+    def run(self, func, jobs, costs):
+        """Yield func(job) for each job, in completion order.
+
+        Args:
+            func:  function of one job, run in the workers (or in this
+                   process with one process)
+            jobs:  dict of key -> job
+            costs: dict of key -> estimated cost
+        """
+        order = sorted(jobs, key=lambda k: (-costs.get(k, 0), str(k)))
+        self._busy = {}
+        start = time.time()
+        if self._processes > 1:
+            pool = Pool(self._processes, initializer=_init_worker,
+                        initargs=(func,))
+            results = pool.imap_unordered(_run_job, [jobs[k] for k in order],
+                                          chunksize=1)
+        else:
+            _init_worker(func)
+            pool = None
+            results = (_run_job(jobs[k]) for k in order)
+
+        try:
+            for pid, job_start, job_end, result in results:
+                busy = self._busy.setdefault(pid, [0, 0.])
+                busy[0] += 1
+                busy[1] += job_end - job_start
+                yield result
+        finally:
+            self._wall = time.time() - start
+            if pool is not None:
+                pool.close()
+                pool.join()
+
+    def utilization(self):
+        """Return a dict of worker pid -> (jobs, busy seconds, fraction of
+        the run spent busy)"""
+        return dict((pid, (jobs, busy, busy / self._wall if self._wall else 0.))
+                    for pid, (jobs, busy) in self._busy.items())
+
+    def print_utilization(self, out_file=sys.stderr):
+        utilization = self.utilization()
+        print('%-10s %8s %10s %8s' % ('worker', 'jobs', 'busy_s', 'util'),
+              file=out_file)
+        for pid, (jobs, busy, fraction) in sorted(utilization.items()):
+            print('%-10i %8i %10.2f %7.1f%%' % (pid, jobs, busy, 100 * fraction),
+                  file=out_file)
+        if utilization:
+            mean = sum(u[2] for u in utilization.values()) / self._processes
+            print('Wall %.2fs, mean utilization %.1f%% over %i workers' % (
+                self._wall, 100 * mean, self._processes), file=out_file)
@@ -0,0 +1,204 @@
+from __future__ import division
+
+import json
+import logging
+import os
+import shutil
+
+from flib.core.manifest import RunManifest
+from flib.core.predictions import PredictionStore
+
+logger = logging.getLogger(__name__)
+
+PLAN_FILE = '.shards.json'
+CLAIMS_DIR = '.claims'
+
+
+def parse_shard(shard):
+    """Parse 'i/N' into (i, N), shards numbered from 0"""
+    try:
+        index, count = [int(x) for x in shard.split('/')]
+    except ValueError:
+        raise ValueError('Shard must be i/N: %s' % shard)
+    if count < 1 or not 0 <= index < count:
+        raise ValueError('Shard index must be in 0..N-1: %s' % shard)
+    return index, count
+
+
+def balance(costs, count):
+    """Assign terms to count shards, largest estimated cost first to the
+    least loaded shard (ties to the lowest shard), so every node computing
+    the plan from the same costs gets the same assignment.
+
+    Returns:
+        dict of term -> shard
+    """
+    loads = [0.] * count
+    assignment = {}
+    for term in sorted(costs, key=lambda t: (-costs[t], t)):
+        shard = min(range(count), key=lambda s: (loads[s], s))
+        assignment[term] = shard
+        loads[shard] += costs[term]
+    return assignment
+
+
+class ShardPlan(object):
+
+    """
+    Assignment of terms to the shards of a run sharing an output directory
+    (on a shared filesystem).
+
+    The first node writes the plan of terms, cost estimates and shards;
+    later nodes read it, so all shards work from one assignment. Each shard
+    writes to its own subdirectory. Terms are claimed with exclusively
+    created lock files before running, so with work stealing a shard that
+    finishes early can run terms of slower shards without two shards
+    running the same term.
+    """
+
+    def __init__(self, directory):
+        self._directory = directory
+        self._plan = None
+
+    def _path(self, *names):
+        return os.path.join(self._directory, *names)
+
+    def create(self, costs, count):
+        """Write the plan for costs (dict of term -> cost) over count shards,
+        or load the existing plan of the directory"""
+        if not os.path.exists(self._path(PLAN_FILE)):
+            plan = {'shards': count, 'costs': costs,
+                    'assignment': balance(costs, count)}
+            tmp_file = self._path('%s.%i.tmp' % (PLAN_FILE, os.getpid()))
+            with open(tmp_file, 'w') as f:
+                json.dump(plan, f, sort_keys=True)
+            try:
+                # Fails if another node wrote the plan first
+                os.link(tmp_file, self._path(PLAN_FILE))
+            except OSError:
+                pass
+            os.remove(tmp_file)
+
+        self.load()
+        if self._plan['shards'] != count:
+            raise ValueError('Plan in %s has %i shards' % (
+                self._directory, self._plan['shards']))
+        if set(self._plan['costs']) != set(costs):
+            logger.warning('Terms differ from the plan, running the planned terms')
+        return self
+
+    def load(self):
+        with open(self._path(PLAN_FILE)) as f:
+            self._plan = json.load(f)
+        return self
+
+    @property
+    def count(self):
+        return self._plan['shards']
+
+    @property
+    def costs(self):
+        return dict(self._plan['costs'])
+
+    @property
+    def assignment(self):
+        return dict(self._plan['assignment'])
+
+    def shard_terms(self, shard):
+        """Return the terms assigned to shard, largest first"""
+        costs = self._plan['costs']
+        return sorted((t for t, s in self._plan['assignment'].items() if s == shard),
+                      key=lambda t: (-costs[t], t))
+
+    def shard_dir(self, shard):
+        directory = self._path('shard-%i' % shard)
+        if not os.path.exists(directory):
+            try:
+                os.makedirs(directory)
+            except OSError:
+                if not os.path.isdir(directory):
+                    raise
+        return directory
+
+    def claim(self, term, shard):
+        """Claim term for shard. Returns False if another shard holds it; a
+        shard keeps its own claims when restarted."""
+        claims = self._path(CLAIMS_DIR)
+        if not os.path.exists(claims):
+            try:
+                os.makedirs(claims)
+            except OSError:
+                if not os.path.isdir(claims):
+                    raise
+        filename = os.path.join(claims, term.replace('/', '_') + '.lock')
+        try:
+            fd = os.open(filename, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644)
+        except OSError:
+            with open(filename) as f:
+                owner = f.read().strip()
+            # An empty file is a claim still being written by its owner
+            return owner == str(shard)
+        try:
+            os.write(fd, str(shard).encode())
+        finally:
+            os.close(fd)
+        return True
+
+    def steal_order(self, shard):
+        """Return the terms of other shards to try claiming once shard has
+        finished its own, smallest first so owners keep their large terms"""
+        costs = self._plan['costs']
+        return sorted((t for t, s in self._plan['assignment'].items() if s != shard),
+                      key=lambda t: (costs[t], t))
+
+
+def merge_shards(directory):
+    """Merge the outputs of every shard of the plan in directory into
+    directory itself (prediction files or a prediction store).
+
+    A term completed by more than one shard is taken from its planned shard
+    if that shard completed it, otherwise from the lowest shard.
+
+    Returns:
+        dict report with the number of planned terms, the merged terms and
+        the missing and duplicated (term -> shards) terms
+    """
+    plan = ShardPlan(directory).load()
+    assignment = plan.assignment
+
+    done = {}
+    for shard in range(plan.count):
+        shard_dir = os.path.join(directory, 'shard-%i' % shard)
+        if not os.path.exists(shard_dir):
+            continue
+        for term in RunManifest(shard_dir).completed():
+            done.setdefault(term, []).append(shard)
+
+    source = {}
+    for term, shards in done.items():
+        shards = sorted(shards)
+        source[term] = assignment.get(term) if assignment.get(term) in shards \
+            else shards[0]
+
+    stores = {}
+    for term in sorted(source):
+        shard_dir = os.path.join(directory, 'shard-%i' % source[term])
+        if PredictionStore.exists(shard_dir):
+            if shard_dir not in stores:
+                stores[shard_dir] = PredictionStore(shard_dir)
+            shard_store = stores[shard_dir]
+            if directory not in stores:
+                stores[directory] = PredictionStore(directory,
+                                                    genes=shard_store.genes)
+            predictions, pos_genes, neg_genes = shard_store.get_predictions(term)
+            stores[directory].append(term, predictions, pos_genes, neg_genes)
+        else:
+            tmp_file = os.path.join(directory, '.%s.%i.tmp' % (term, os.getpid()))
+            shutil.copyfile(os.path.join(shard_dir, term), tmp_file)
+            os.rename(tmp_file, os.path.join(directory, term))
+
+    return {'terms': len(assignment),
+            'merged': len(source),
+            'missing': sorted(t for t in assignment if t not in done),
+            'duplicated': dict((t, sorted(s)) for t, s in done.items()
+                               if len(s) > 1)}
@@ -1,25 +1,254 @@
-import argparse
+import hashlib
+import json
+import warnings
 import numpy as np
 import os
+from scipy import sparse
 from operator import itemgetter
 
+from multiprocessing import Pool
+
 import logging
 logging.basicConfig()
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
 
-from sklearn.svm import LinearSVC
-from sklearn.model_selection import GridSearchCV, StratifiedKFold
+from sklearn.svm import LinearSVC, SVC
+from sklearn.linear_model import SGDClassifier
+from sklearn.exceptions import ConvergenceWarning
+from sklearn.model_selection import GridSearchCV, ParameterGrid, StratifiedKFold
 from sklearn.preprocessing import label_binarize
-from sklearn.metrics import roc_auc_score, average_precision_score
+from sklearn.metrics import average_precision_score
 from sklearn.calibration import _SigmoidCalibration
 from sklearn.isotonic import IsotonicRegression
 
-from dab import Dab
-from gmt import GMT
-from omim import OMIM
-from onto import DiseaseOntology
-from labels import OntoLabels
+try:
+    from joblib import Parallel, delayed, parallel_backend
+except ImportError:
+    from sklearn.externals.joblib import Parallel, delayed, parallel_backend
+
+from flib.core.metrics import StageMetrics
+
+# Logistic loss of SGDClassifier (renamed in newer scikit-learn)
+LOG_LOSS = 'log_loss' if 'log_loss' in SGDClassifier.loss_functions else 'log'
+
+
+def fit_calibration(scores, y, prob_fit='SIGMOID'):
+    """Fit a score to probability calibration on labels y (1/-1)
+
+    Returns an object whose predict() maps scores to probabilities.
+    """
+    Y = label_binarize(y, classes=[-1, 1])
+    if prob_fit == 'ISO':
+        calibration = IsotonicRegression(out_of_bounds='clip')
+    else:
+        calibration = _SigmoidCalibration()
+    calibration.fit(scores, Y[:, 0])
+    return calibration
+
+
+def write_predictions(ofile, predictions, pos_genes, neg_genes):
+    """Write (gene, score, prob) predictions with their labels to ofile.
+
+    The file is written under a temporary name and renamed into place, so a
+    partial file never appears.
+    """
+    tmp_file = os.path.join(os.path.dirname(ofile),
+                            '.%s.%i.tmp' % (os.path.basename(ofile), os.getpid()))
+    with open(tmp_file, 'w') as outfile:
+        for (g, s, p) in predictions:
+            if g in pos_genes:
+                label = '1'
+            elif g in neg_genes:
+                label = '-1'
+            else:
+                label = '0'
+            line = [g, label, str(s), str(p), '\n']
+            outfile.write('\t'.join(line))
+    os.rename(tmp_file, ofile)
+
+
+def write_matrix(dab, filename, block_size=1000):
+    """Write the full Dab matrix to a .npy file and return it memory-mapped.
+
+    Processes forked after this share the read-only pages instead of each
+    holding a copy of the network.
+    """
+    size = dab.get_size()
+    X = np.lib.format.open_memmap(filename, mode='w+', dtype=np.float32,
+                                  shape=(size, size))
+    for start in range(0, size, block_size):
+        end = min(start + block_size, size)
+        logger.info('Loaded %i', start)
+        X[start:end] = dab.get_rows(range(start, end))
+    X.flush()
+    del X
+    return np.load(filename, mmap_mode='r')
+
+
+def sparse_features(dab, threshold=None, top_k=None, background=None,
+                    block_size=1000):
+    """Return the Dab as a CSR matrix of the informative edges of each row.
+
+    Rows are expanded from the packed triangle one block at a time and only
+    their kept values are stored, so linear SVMs train in time proportional
+    to the number of kept edges.
+
+    Args:
+        dab:        Dab network
+        threshold:  keep edges above this value (after background
+                    subtraction)
+        top_k:      keep the k largest edges of each row
+        background: value subtracted from every edge first, a float or
+                    'mean' for the mean of the finite edges
+        block_size: number of rows expanded at once
+    """
+    if background == 'mean':
+        values = dab.as_array()
+        total, count = 0., 0
+        for start in range(0, len(values), 1 << 22):
+            chunk = np.asarray(values[start:start + (1 << 22)], dtype=np.float64)
+            finite = np.isfinite(chunk)
+            total += chunk[finite].sum()
+            count += finite.sum()
+        background = total / count if count else 0.
+        logger.info('Background edge value %f', background)
+
+    size = dab.get_size()
+    blocks = []
+    for start in range(0, size, block_size):
+        end = min(start + block_size, size)
+        rows = dab.get_rows(range(start, end))
+        keep = np.isfinite(rows)
+        rows[~keep] = 0
+        if background:
+            rows -= background
+        if threshold is not None:
+            keep &= rows > threshold
+        if top_k is not None and top_k < size:
+            top = np.argpartition(-rows, top_k - 1, axis=1)[:, :top_k]
+            in_top = np.zeros(rows.shape, dtype=bool)
+            in_top[np.arange(end - start)[:, None], top] = True
+            keep &= in_top
+        rows[~keep] = 0
+        blocks.append(sparse.csr_matrix(rows))
+        logger.info('Sparsified %i rows', end)
+    X = sparse.vstack(blocks, format='csr')
+    logger.info('Kept %i of %i edges', X.nnz, size * size)
+    return X
+
+
+def _dense(X, dtype=None):
+    # Rows of a memmap or matrix product as an in-memory array
+    if sparse.issparse(X):
+        X = X.toarray()
+    return np.asarray(X, dtype=dtype)
+
+
+def _rows(X):
+    # Read rows of a memmap into memory, keeping a sparse matrix sparse
+    return X if sparse.issparse(X) else np.asarray(X)
+
+
+def gram_matrix(X, filename=None, block_size=2000):
+    """Return the linear kernel X X^T (X dense or sparse), computed in
+    blocks of rows.
+
+    With filename the kernel is written to (and returned memory-mapped from)
+    a .npy file.
+    """
+    size = X.shape[0]
+    if filename:
+        K = np.lib.format.open_memmap(filename + '.tmp', mode='w+',
+                                      dtype=np.float32, shape=(size, size))
+    else:
+        K = np.empty((size, size), dtype=np.float32)
+    for i in range(0, size, block_size):
+        Xi = _rows(X[i:i + block_size])
+        for j in range(i, size, block_size):
+            Kij = _dense(Xi.dot(_rows(X[j:j + block_size]).T), np.float32)
+            K[i:i + block_size, j:j + block_size] = Kij
+            K[j:j + block_size, i:i + block_size] = Kij.T
+        logger.info('Kernel rows %i', i)
+    if filename:
+        K.flush()
+        del K
+        os.rename(filename + '.tmp', filename)
+        return np.load(filename, mmap_mode='r')
+    return K
+
+
+def _fit_fold(X_train, y_train, X_test, params, precomputed, seed):
+    # Train one cross-validation fold, returning the model and its scores
+    # of the held out genes
+    logger.info('Learning SVM')
+    if precomputed:
+        clf = SVC(kernel='precomputed', random_state=seed, **params)
+    else:
+        clf = LinearSVC(random_state=seed, **params)
+    clf.fit(X_train, y_train)
+
+    logger.info('Predicting SVM')
+    return clf, clf.decision_function(X_test)
+
+
+def _fit_sgd_fold(svm, train_idx, y_train, test_idx, params, seed):
+    # Train one fold by streaming shuffled mini-batches of Dab rows through
+    # SGDClassifier.partial_fit; the training rows are never held at once.
+    # C maps to alpha = 1 / (C * n_samples) as for the liblinear objective,
+    # and balanced class weights are fixed from the fold's labels.
+    logger.info('Learning SGD SVM')
+    class_weight = params.get('class_weight')
+    if class_weight == 'balanced':
+        class_weight = dict((c, len(y_train) / (2. * (y_train == c).sum()))
+                            for c in [-1, 1])
+    clf = SGDClassifier(loss=svm._sgd_loss, penalty='l2',
+                        alpha=1. / (params['C'] * len(y_train)),
+                        learning_rate='optimal', class_weight=class_weight,
+                        random_state=seed)
+
+    rng = np.random.RandomState(seed)
+    for epoch in range(svm._epochs):
+        order = rng.permutation(len(train_idx))
+        for start in range(0, len(order), svm._batch_size):
+            # Read each batch in Dab order
+            batch = np.sort(order[start:start + svm._batch_size])
+            clf.partial_fit(svm._batch_rows(train_idx[batch]), y_train[batch],
+                            classes=np.array([-1, 1]))
+
+    logger.info('Predicting SGD SVM')
+    return clf, np.concatenate(
+        [clf.decision_function(svm._batch_rows(test_idx[start:start + svm._batch_size]))
+         for start in range(0, len(test_idx), svm._batch_size)])
+
+
+# Shared with forked predict_many workers
+_worker_state = None
+
+
+def _predict_term(job):
+    (term, pos_genes, neg_genes) = job
+    (svm, X_union, union_row, fold_of, kwargs) = _worker_state
+
+    train_genes = sorted(g for g in (pos_genes | neg_genes) if g in union_row)
+    rows = [union_row[g] for g in train_genes]
+    train_genes_idx = [svm._dab.get_index(g) for g in train_genes]
+    y = np.array([1 if g in pos_genes else -1 for g in train_genes])
+    logger.info('Running SVM for %s, %i pos, %i neg',
+                term, (y == 1).sum(), (y == -1).sum())
+
+    svm._metrics.set_term(term)
+    folds = svm._shared_folds(fold_of[rows], y, kwargs['cv_folds'])
+    with svm._metrics.stage('features'):
+        if svm._K is not None:
+            X = svm._kernel_block(train_genes_idx)
+        elif X_union is None:
+            X = np.array(train_genes_idx)
+        else:
+            X = _rows(X_union[rows])
+    predictions = svm._fit_predict(X, y, train_genes,
+                                   train_genes_idx, folds=folds, **kwargs)
+    return term, predictions
 
 
 class NetworkSVM:
@@ -30,20 +259,198 @@ class NetworkSVM:
             'class_weight':['balanced', None]},
     ]
 
-    def __init__(self, dab):
+    def __init__(self, dab, X_all=None, kernel='linear', kernel_cache=None,
+                 n_jobs=1, backend='threading', random_state=0,
+                 param_search='path', param_cache=None, metrics=None,
+                 solver='liblinear', sgd_loss='hinge', epochs=5,
+                 batch_size=256, features=None):
+        """
+        Args:
+            dab:          Dab network
+            X_all:        optional existing (genes x features) matrix or view,
+                          e.g. from write_matrix, or a CSR matrix from
+                          sparse_features, with rows in Dab gene order
+            kernel:       'linear' trains LinearSVC on feature rows;
+                          'precomputed' trains SVC on a Gram matrix computed
+                          once for the labeled gene universe
+            kernel_cache: directory where Gram matrices are cached, keyed on
+                          the Dab file, features and gene universe
+            n_jobs:       workers for cross-validation folds and grid search
+            backend:      joblib backend of the workers, 'threading' to share
+                          the read-only features or 'loky' for processes
+            random_state: base seed; fold k trains with random_state + k
+            param_search: 'path' for the warm-started regularization path
+                          with early stopping (linear kernel only) or 'grid'
+                          for an exhaustive grid search, used by best_params
+            param_cache:  directory where selected parameters are cached,
+                          keyed on the Dab file, features, labels and search
+            metrics:      StageMetrics recording the time and memory of the
+                          features, params, fit, calibration and predict_all
+                          stages
+            solver:       'liblinear' fits LinearSVC on the training rows;
+                          'sgd' streams mini-batches of rows from the Dab (or
+                          X_all) through SGDClassifier.partial_fit without
+                          building the training matrix (linear kernel only)
+            sgd_loss:     'hinge' or 'log' loss of the sgd solver
+            epochs:       passes over the training genes, reshuffled each
+                          epoch, of the sgd solver
+            batch_size:   rows per mini-batch of the sgd solver
+            features:     JSON-serializable description of X_all for the
+                          cache keys, e.g. {'embedding': k}; by default the
+                          Dab rows, or a digest of X_all if it is not the
+                          full Dab matrix
+        """
         self._dab = dab
+        self._X_all = X_all
+        self._kernel = kernel
+        self._kernel_cache = kernel_cache
+        self._K = None
+        self._K_row = None
+        self._n_jobs = n_jobs
+        self._backend = backend
+        self._random_state = random_state
+        self._param_search = param_search
+        self._param_cache = param_cache
+        self._metrics = metrics if metrics is not None else StageMetrics()
+        if solver == 'sgd' and kernel == 'precomputed':
+            raise ValueError('The sgd solver requires the linear kernel')
+        self._solver = solver
+        self._sgd_loss = LOG_LOSS if sgd_loss == 'log' else sgd_loss
+        self._epochs = epochs
+        self._batch_size = batch_size
+        self._features = features
+        self._features_id = None
+
+    def _features_key(self):
+        # Identify the features of X_all, computed once: the Dab rows, the
+        # caller's description or a digest of the feature values
+        if self._features_id is None:
+            size = self._dab.get_size()
+            if self._features is not None:
+                self._features_id = json.dumps(self._features, sort_keys=True)
+            elif self._X_all is None or (not sparse.issparse(self._X_all) and
+                                         self._X_all.shape == (size, size)):
+                self._features_id = 'rows'
+            elif sparse.issparse(self._X_all):
+                X = self._X_all.tocsr()
+                key = hashlib.sha1(repr(X.shape).encode())
+                for values in (X.indptr, X.indices, X.data):
+                    key.update(np.ascontiguousarray(values).tobytes())
+                self._features_id = key.hexdigest()
+            else:
+                key = hashlib.sha1(repr(self._X_all.shape).encode())
+                for start in range(0, size, 1000):
+                    key.update(np.ascontiguousarray(
+                        self._X_all[start:start + 1000]).tobytes())
+                self._features_id = key.hexdigest()
+        return self._features_id
+
+    def _kernel_key(self, idx):
+        # Identify the Dab file, features and gene universe of a Gram matrix
+        key = hashlib.sha1()
+        filename = getattr(self._dab, 'filename', None)
+        if filename:
+            stat = os.stat(filename)
+            key.update(('%s:%i:%f' % (os.path.realpath(filename), stat.st_size,
+                                      stat.st_mtime)).encode())
+        key.update(self._features_key().encode())
+        key.update(np.asarray(idx, dtype=np.int64).tobytes())
+        return key.hexdigest()
+
+    def use_kernel(self, genes=None):
+        """Compute (or load from the cache) the Gram matrix of genes, by
+        default all Dab genes, for precomputed-kernel training"""
+        if genes is None:
+            idx = list(range(self._dab.get_size()))
+        else:
+            idx = sorted(set(self._dab.get_index(g) for g in genes
+                             if self._dab.get_index(g) is not None))
+
+        filename = None
+        if self._kernel_cache:
+            filename = os.path.join(self._kernel_cache,
+                                    self._kernel_key(idx) + '.gram.npy')
+            if os.path.exists(filename):
+                logger.info('Loading cached kernel %s', filename)
+                self._K = np.load(filename, mmap_mode='r')
+                self._K_row = dict((i, r) for r, i in enumerate(idx))
+                return self._K
+
+        if self._X_all is not None or len(idx) == self._dab.get_size():
+            X = self._dab_matrix()[idx]
+        else:
+            X = self._dab.get_rows(idx)
+        logger.info('Computing kernel for %i genes', len(idx))
+        self._K = gram_matrix(X, filename)
+        self._K_row = dict((i, r) for r, i in enumerate(idx))
+        return self._K
+
+    def _kernel_block(self, train_genes_idx):
+        # Gram matrix of the training genes
+        rows = [self._K_row[i] for i in train_genes_idx]
+        return np.asarray(self._K[np.ix_(rows, rows)], dtype=np.float64)
+
+    def _kernel_rows(self, start, end, train_genes_idx):
+        # Kernel of a block of Dab genes against the given training genes
+        if len(self._K_row) == self._dab.get_size():
+            cols = [self._K_row[i] for i in train_genes_idx]
+            return np.asarray(self._K[start:end][:, cols], dtype=np.float64)
+        return _dense(self._feature_rows(start, end).dot(
+            self._training_rows(train_genes_idx).T), np.float64)
 
     def _dab_matrix(self):
-        if not self._X_all:
+        if self._X_all is None:
             # Load dab as matrix
             self._X_all = np.empty(
-                [self._dab.get_size(), self._dab.get_size()])
-            for i, g in enumerate(self._dab.gene_list):
-                if not i % 1000:
-                    logger.info('Loaded %i', i)
-                self._X_all[i] = self._dab.get(g)
+                [self._dab.get_size(), self._dab.get_size()], dtype=np.float32)
+            for i in range(0, self._dab.get_size(), 1000):
+                logger.info('Loaded %i', i)
+                end = min(i + 1000, self._dab.get_size())
+                self._X_all[i:end] = self._dab.get_rows(range(i, end))
         return self._X_all
 
+    def _training_rows(self, idx):
+        # Feature rows of the given Dab gene indices
+        if self._X_all is not None:
+            return self._X_all[idx]
+        return self._dab.get_rows(idx)
+
+    def _batch_rows(self, idx):
+        # Feature rows of a sorted mini-batch of Dab gene indices
+        X = self._training_rows(idx)
+        return X.astype(np.float64) if sparse.issparse(X) else \
+            np.asarray(X, dtype=np.float64)
+
+    def _feature_rows(self, start, end):
+        # Feature rows of a block of consecutive Dab genes
+        if self._X_all is not None:
+            return _rows(self._X_all[start:end])
+        return self._dab.get_rows(range(start, end))
+
+    def _score_all(self, models, folds, train_genes_idx, block_size=1000):
+        # Median over the fold models of the score of every Dab gene,
+        # streamed over blocks of rows so only one block is held at a time
+        size = self._dab.get_size()
+        scores = np.empty(size)
+        if self._kernel == 'precomputed':
+            fold_idx = [[train_genes_idx[i] for i in train]
+                        for (train, test) in folds]
+        else:
+            coef = np.vstack([clf.coef_.ravel() for clf in models]).T
+            intercept = np.array([clf.intercept_[0] for clf in models])
+
+        for start in range(0, size, block_size):
+            end = min(start + block_size, size)
+            if self._kernel == 'precomputed':
+                block = np.column_stack([
+                    clf.decision_function(self._kernel_rows(start, end, idx))
+                    for clf, idx in zip(models, fold_idx)])
+            else:
+                block = self._feature_rows(start, end).dot(coef) + intercept
+            scores[start:end] = np.median(block, axis=1)
+            logger.info('Scored %i genes', end)
+        return scores
+
     def predict(self, pos_genes, neg_genes,
                 predict_all=False,
                 best_params=False,
@@ -52,99 +459,272 @@ class NetworkSVM:
 
         logger.info("Running %i fold SVM", cv_folds)
 
-        # Group training genes
-        train_genes = [g for g in (pos_genes | neg_genes)
-                       if self._dab.get_index(g) is not None]
+        # Group training genes, in a fixed order so folds are reproducible
+        train_genes = sorted(g for g in (pos_genes | neg_genes)
+                             if self._dab.get_index(g) is not None)
         train_genes_idx = [self._dab.get_index(g) for g in train_genes]
 
-        # Subset training matrix and labels
-        if predict_all:
-            X = self._dab_matrix()[train_genes_idx]
-            y = np.array([1 if g in pos_genes else -1 for g in train_genes])
+        # Subset training matrix (or Gram matrix) and labels
+        with self._metrics.stage('features'):
+            if self._kernel == 'precomputed':
+                if self._K is None or \
+                        any(i not in self._K_row for i in train_genes_idx):
+                    self.use_kernel()
+                X = self._kernel_block(train_genes_idx)
+            elif self._solver == 'sgd':
+                # Rows are streamed from the Dab by index during training
+                X = np.array(train_genes_idx)
+            else:
+                X = _rows(self._training_rows(train_genes_idx))
+        y = np.array([1 if g in pos_genes else -1 for g in train_genes])
+
+        self._predictions = self._fit_predict(
+            X, y, train_genes, train_genes_idx,
+            predict_all=predict_all, best_params=best_params,
+            prob_fit=prob_fit, cv_folds=cv_folds)
+        return self._predictions
+
+    def _grid_params(self, X, y):
+        # Exhaustive grid search over the tuned parameters
+        score = 'average_precision'
+        precomputed = self._kernel == 'precomputed'
+        estimator = SVC(kernel='precomputed') if precomputed else LinearSVC()
+        estimator.set_params(random_state=self._random_state)
+        clf = GridSearchCV(estimator, NetworkSVM.tuned_parameters, cv=3,
+                           n_jobs=self._n_jobs, scoring=score)
+        with parallel_backend(self._backend, n_jobs=self._n_jobs):
+            clf.fit(X, y)
+        return clf.best_params_
+
+    def _path_params(self, X, y, patience=2, min_gain=1e-3):
+        # Regularization path: for each class weight, fit C values in
+        # increasing order, warm starting every fold's model from its
+        # solution at the previous C, until validation average precision
+        # stops improving. The squared hinge SGD objective matches
+        # LinearSVC's with alpha = 1 / (C * n_samples).
+        grid = NetworkSVM.tuned_parameters[0]
+        folds = list(StratifiedKFold(n_splits=3).split(X, y))
+        best = (-np.inf, None)
+        for class_weight in grid['class_weight']:
+            models = [SGDClassifier(loss='squared_hinge', penalty='l2',
+                                    learning_rate='optimal', warm_start=True,
+                                    class_weight=class_weight, tol=1e-4,
+                                    max_iter=50, random_state=self._random_state + cv)
+                      for cv in range(len(folds))]
+            best_weight, stale = -np.inf, 0
+            for C in sorted(grid['C']):
+                precisions = []
+                for model, (train, test) in zip(models, folds):
+                    model.set_params(alpha=1. / (C * len(train)))
+                    with warnings.catch_warnings():
+                        warnings.simplefilter('ignore', ConvergenceWarning)
+                        model.fit(X[train], y[train])
+                    precisions.append(average_precision_score(
+                        y[test], model.decision_function(X[test])))
+                ap = np.mean(precisions)
+                logger.debug('C=%s class_weight=%s: AP %.4f', C, class_weight, ap)
+                if ap > best[0]:
+                    best = (ap, {'C': C, 'class_weight': class_weight})
+                if ap > best_weight + min_gain:
+                    best_weight, stale = ap, 0
+                else:
+                    stale += 1
+                    if stale >= patience:
+                        break
+        return best[1]
+
+    def _sgd_params(self, idx, y):
+        # Grid over the tuned parameters, each scored by 3 fold streamed
+        # SGD cross-validation
+        folds = list(StratifiedKFold(n_splits=3).split(idx, y))
+        best = (-np.inf, None)
+        for params in ParameterGrid(NetworkSVM.tuned_parameters):
+            precisions = []
+            for cv, (train, test) in enumerate(folds):
+                clf, scores = _fit_sgd_fold(self, idx[train], y[train], idx[test],
+                                            params, self._random_state + cv)
+                precisions.append(average_precision_score(y[test], scores))
+            if np.mean(precisions) > best[0]:
+                best = (np.mean(precisions), params)
+        return best[1]
+
+    def _params_key(self, y, train_genes):
+        # Identify the Dab, features, labels and search settings of a
+        # parameter choice
+        key = hashlib.sha1(self._kernel_key([]).encode())
+        key.update(repr((self._kernel, self._solver, self._param_search,
+                         NetworkSVM.tuned_parameters)).encode())
+        for g, label in sorted(zip(train_genes, y)):
+            key.update(('%s:%i\n' % (g, label)).encode())
+        return key.hexdigest()
+
+    def _select_params(self, X, y, train_genes):
+        """Choose SVM parameters by cross-validation, reusing choices cached
+        for the same network, labels and search"""
+        filename = None
+        if self._param_cache:
+            filename = os.path.join(self._param_cache,
+                                    self._params_key(y, train_genes) + '.json')
+            if os.path.exists(filename):
+                with open(filename) as f:
+                    return json.load(f)
+
+        if self._solver == 'sgd':
+            params = self._sgd_params(X, y)
+        elif self._param_search == 'path' and self._kernel != 'precomputed':
+            params = self._path_params(X, y)
         else:
-            X = np.empty([len(train_genes), self._dab.get_size()])
-            y = np.empty(len(train_genes))
-            for i, g in enumerate(train_genes):
-                X[i] = self._dab.get(g)
-                y[i] = 1 if g in pos_genes else -1
+            params = self._grid_params(X, y)
+        logger.info('Selected parameters %s', params)
+
+        if filename:
+            tmp_file = '%s.%i.tmp' % (filename, os.getpid())
+            with open(tmp_file, 'w') as f:
+                json.dump(params, f)
+            os.rename(tmp_file, filename)
+        return params
+
+    def _fit_predict(self, X, y, train_genes, train_genes_idx,
+                     predict_all=False,
+                     best_params=False,
+                     prob_fit='SIGMOID',
+                     cv_folds=5,
+                     folds=None):
 
         params = NetworkSVM.default_params
+        precomputed = self._kernel == 'precomputed'
 
         if best_params:
-            # Set the parameters by cross-validation
-            score = 'average_precision'
-            clf = GridSearchCV(LinearSVC(), NetworkSVM.tuned_parameters, cv=3, n_jobs=10,
-                               scoring=score)
-            clf.fit(X, y)
-            params = clf.best_params_
-
-        train_scores, train_probs = np.empty(
-            len(train_genes)), np.empty(len(train_genes))
-        train_scores[:], train_probs[:] = np.NAN, np.NAN
-        scores, probs = None, None
-
-        kf = StratifiedKFold(n_splits=cv_folds)
-        for cv, (train, test) in enumerate(kf.split(X, y)):
-            X_train, X_test, y_train, y_test = X[
-                train], X[test], y[train], y[test]
-
-            logger.info('Learning SVM')
-            clf = LinearSVC(**params)
-            clf.fit(X_train, y_train)
-
-            logger.info('Predicting SVM')
-            if predict_all:
-                scores_cv = clf.decision_function(X_all)
-                scores = scores_cv if scores is None else np.column_stack(
-                    (scores, scores_cv))
-
-                for idx in test:
-                    train_scores[idx] = scores_cv[train_genes_idx[idx]]
-            else:
-                scores_cv = clf.decision_function(X_test)
-                for i, idx in enumerate(test):
-                    train_scores[idx] = scores_cv[i]
-
-        if prob_fit == 'ISO':
-            ir = IsotonicRegression(out_of_bounds='clip')
-            Y = label_binarize(y, [-1, 1])
-            ir.fit(train_scores, Y[:, 0])
-            train_probs = ir.predict(train_scores)
-        else:
-            Y = label_binarize(y, [-1, 1])
-            sc = _SigmoidCalibration()
-            sc.fit(train_scores, Y)
-            train_probs = sc.predict(train_scores)
+            with self._metrics.stage('params'):
+                params = self._select_params(X, y, train_genes)
 
-        if predict_all:
-            scores = np.median(scores, axis=1)
-            for i, idx in enumerate(train_genes_idx):
-                scores[idx] = train_scores[i]
+        train_scores = np.empty(len(train_genes))
+        train_scores[:] = np.nan
+
+        if folds is None:
+            kf = StratifiedKFold(n_splits=cv_folds)
+            folds = kf.split(X, y)
+        folds = list(folds)
 
-            probs = np.median(probs, axis=1)
-            for i, idx in enumerate(train_genes_idx):
-                probs[idx] = train_probs[i]
+        def fold_jobs():
+            # Each fold gets its own fixed seed so results do not depend on
+            # the number of workers or their scheduling
+            for cv, (train, test) in enumerate(folds):
+                if self._solver == 'sgd':
+                    yield delayed(_fit_sgd_fold)(self, X[train], y[train], X[test],
+                                                 params, self._random_state + cv)
+                    continue
+                if precomputed:
+                    X_train = X[np.ix_(train, train)]
+                    X_test = X[np.ix_(test, train)]
+                else:
+                    X_train, X_test = X[train], X[test]
+                yield delayed(_fit_fold)(X_train, y[train], X_test, params,
+                                         precomputed, self._random_state + cv)
+
+        with self._metrics.stage('fit'), \
+                parallel_backend(self._backend, n_jobs=self._n_jobs):
+            fold_results = Parallel(n_jobs=self._n_jobs)(fold_jobs())
+
+        for (train, test), (clf, scores_cv) in zip(folds, fold_results):
+            train_scores[test] = scores_cv
 
-            genes = dab.gene_list
+        with self._metrics.stage('calibration'):
+            calibration = fit_calibration(train_scores, y, prob_fit)
+
+        if predict_all:
+            # Labeled genes keep the score of the fold that held them out
+            with self._metrics.stage('predict_all'):
+                scores = self._score_all(
+                    [clf for (clf, scores_cv) in fold_results],
+                    folds, train_genes_idx)
+            scores[train_genes_idx] = train_scores
+            genes = self._dab.gene_list
         else:
             scores = train_scores
             genes = train_genes
-            probs = train_probs
+        probs = calibration.predict(scores)
 
-        self._predictions = sorted(
-            zip(genes, scores, probs), key=itemgetter(1), reverse=True)
+        return sorted(zip(genes, scores, probs), key=itemgetter(1), reverse=True)
 
-        return self._predictions
+    def _shared_folds(self, fold_of, y, cv_folds):
+        # Folds from the shared gene assignment, if every fold holds out a
+        # positive and trains on both classes
+        folds = []
+        for k in range(cv_folds):
+            test = np.nonzero(fold_of == k)[0]
+            train = np.nonzero(fold_of != k)[0]
+            if not (y[test] == 1).any() or len(set(y[train])) < 2:
+                return None
+            folds.append((train, test))
+        return folds
+
+    def iter_predict_many(self, label_sets,
+                          predict_all=False,
+                          best_params=False,
+                          prob_fit='SIGMOID',
+                          cv_folds=5,
+                          processes=1,
+                          seed=0):
+        """Train many terms against one feature matrix.
+
+        The feature rows of the union of labeled genes are built once and
+        each gene is assigned a cross-validation fold once; terms whose
+        labels fit the shared folds reuse them, the rest are stratified on
+        their own. Terms are trained in this process or, with processes > 1,
+        across a pool of forked workers sharing the matrix.
+
+        Args:
+            label_sets: dict of term -> (pos_genes, neg_genes)
+
+        Yields:
+            (term, predictions) as terms complete
+        """
+        union = set()
+        for (pos_genes, neg_genes) in label_sets.values():
+            union |= pos_genes | neg_genes
+        union_genes = sorted(g for g in union if self._dab.get_index(g) is not None)
+        union_idx = [self._dab.get_index(g) for g in union_genes]
+        union_row = dict((g, i) for i, g in enumerate(union_genes))
+        self._metrics.set_term(None)
+        with self._metrics.stage('union_features'):
+            if self._kernel == 'precomputed':
+                if self._K is None or \
+                        any(i not in self._K_row for i in union_idx):
+                    self.use_kernel(union_genes)
+                X_union = None
+            elif self._solver == 'sgd':
+                X_union = None
+            else:
+                logger.info('Building features for %i genes', len(union_genes))
+                X_union = self._training_rows(union_idx)
+
+        rng = np.random.RandomState(seed)
+        fold_of = rng.permutation(len(union_genes)) % cv_folds
+
+        kwargs = dict(predict_all=predict_all, best_params=best_params,
+                      prob_fit=prob_fit, cv_folds=cv_folds)
+        # Largest terms first so they do not trail the pool
+        jobs = sorted(((term, pos_genes, neg_genes)
+                       for term, (pos_genes, neg_genes) in label_sets.items()),
+                      key=lambda job: (-len(job[1] | job[2]), str(job[0])))
+
+        global _worker_state
+        _worker_state = (self, X_union, union_row, fold_of, kwargs)
+        if processes > 1:
+            pool = Pool(processes)
+            for result in pool.imap_unordered(_predict_term, jobs, chunksize=1):
+                yield result
+            pool.close()
+            pool.join()
+        else:
+            for job in jobs:
+                yield _predict_term(job)
+        _worker_state = None
+
+    def predict_many(self, label_sets, **kwargs):
+        """Return a dict of term -> predictions, see iter_predict_many"""
+        return dict(self.iter_predict_many(label_sets, **kwargs))
 
     def print_predictions(self, ofile, pos_genes, neg_genes):
-        with open(ofile, 'w') as outfile:
-            for (g, s, p) in self._predictions:
-                if g in pos_genes:
-                    label = '1'
-                elif g in neg_genes:
-                    label = '-1'
-                else:
-                    label = '0'
-                line = [g, label, str(s), str(p), '\n']
-                outfile.write('\t'.join(line))
-            outfile.close()
+        write_predictions(ofile, self._predictions, pos_genes, neg_genes)
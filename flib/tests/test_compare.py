@@ -0,0 +1,62 @@
+import shutil
+import tempfile
+import unittest
+import numpy
+from scipy.stats import pearsonr, spearmanr
+
+from flib.core.dab import Dab, write_dab
+from flib.core.compare import compare_dabs
+
+
+class TestCompareDabs(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        rng = numpy.random.RandomState(0)
+
+        self.genes_a = ['G%i' % i for i in range(30)]
+        values = rng.random_sample(30 * 29 // 2)
+        values[::7] = numpy.nan
+        write_dab(self.tmp_dir + '/a.dab', self.genes_a, values)
+
+        # Second network: reordered, missing two genes, with one extra gene
+        self.genes_b = self.genes_a[2:][::-1] + ['X']
+        a = Dab(self.tmp_dir + '/a.dab')
+        b_values = []
+        for i, g1 in enumerate(self.genes_b):
+            for g2 in self.genes_b[i + 1:]:
+                v = a.get_value_genestr(g1, g2)
+                b_values.append(rng.random_sample() if v is None
+                                else v + rng.normal(0, .1))
+        b_values[5] += 10
+        write_dab(self.tmp_dir + '/b.dab', self.genes_b, b_values)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_compare(self):
+        a = Dab(self.tmp_dir + '/a.dab', mmap=True)
+        b = Dab(self.tmp_dir + '/b.dab', mmap=True)
+        report = compare_dabs(a, b, block_size=4, top=5)
+
+        shared = self.genes_b[:-1]
+        xs, ys = [], []
+        for i, g1 in enumerate(shared):
+            for g2 in shared[i + 1:]:
+                x, y = a.get_value_genestr(g1, g2), b.get_value_genestr(g1, g2)
+                if numpy.isfinite(x) and numpy.isfinite(y):
+                    xs.append(x)
+                    ys.append(y)
+
+        self.assertEqual(report['shared_genes'], 28)
+        self.assertEqual(report['edges'], len(xs))
+        assert numpy.isclose(report['pearson'], pearsonr(xs, ys)[0])
+        assert numpy.isclose(report['spearman'], spearmanr(xs, ys)[0], atol=1e-3)
+        self.assertEqual(report['row_correlation']['genes'], 28)
+
+        # The largest change is the shifted edge
+        g1, g2, va, vb, diff = report['top_changes'][0]
+        self.assertEqual(set([g1, g2]), set([self.genes_b[0], self.genes_b[6]]))
+        self.assertEqual(len(report['top_changes']), 5)
+        diffs = [abs(d) for (g1, g2, va, vb, d) in report['top_changes']]
+        self.assertEqual(diffs, sorted(diffs, reverse=True))
@@ -0,0 +1,78 @@
+import unittest
+import numpy
+
+from flib.core.dab import Dab
+from flib.core.gmt import GMT
+from flib.core.connectivity import SetConnectivity
+
+
+class TestSetConnectivity(unittest.TestCase):
+
+    def setUp(self):
+        self.dab = Dab('files/test_data/test_dab.dab')
+        self.conn = SetConnectivity(self.dab)
+
+        self.gmt = GMT()
+        genes = self.dab.gene_list
+        # Only edges from the first gene and among the last five genes are
+        # present in the test network
+        for gsid, members in [('A', genes[:4]), ('B', genes[11:16]),
+                              ('C', genes[2:6]), ('D', genes[:1])]:
+            self.gmt.add_geneset(gsid=gsid, name=gsid)
+            for g in members:
+                self.gmt.add_gene(gsid, g)
+
+    def tearDown(self):
+        return
+
+    def mean_weight(self, genes):
+        vals = []
+        for i, g1 in enumerate(genes):
+            for g2 in genes[i + 1:]:
+                v = self.dab.get_value_genestr(g1, g2)
+                if numpy.isfinite(v):
+                    vals.append(v)
+        return numpy.mean(vals) if vals else numpy.nan
+
+    def test_mean_weights(self):
+        # Test batched gathers against pairwise lookups
+        index_sets = [self.conn.gene_indices(self.gmt.get_genes(gsid))
+                      for gsid in ['A', 'B', 'C']]
+        for max_pairs in [1, 10, 1000]:
+            means = self.conn.mean_weights(index_sets, max_pairs=max_pairs)
+            for idx, mean in zip(index_sets, means):
+                expected = self.mean_weight([self.dab.gene_list[i] for i in idx])
+                assert numpy.isclose(mean, expected, rtol=1e-05, atol=1e-08,
+                                     equal_nan=True)
+
+    def test_null_distribution(self):
+        # Test random sets are reproducible and drawn without replacement
+        null = self.conn.null_distribution(4, 50, seed=1)
+        self.assertTrue(0 < len(null) <= 50)
+        self.assertTrue(numpy.all(numpy.isfinite(null)))
+        self.assertTrue(numpy.array_equal(
+            null, self.conn.null_distribution(4, 50, seed=1)))
+
+        rng = numpy.random.RandomState(0)
+        for size in [2, 4, 10, 16]:
+            draws = self.conn._sample(rng, size, 20)
+            for row in draws:
+                self.assertEqual(len(set(row)), size)
+
+    def test_score(self):
+        scores = self.conn.score(self.gmt, n_perm=100)
+        self.assertEqual(set(s[0] for s in scores), set(['A', 'B', 'C']))
+        for (gsid, size, obs, zscore, pval) in scores:
+            self.assertEqual(size, len(self.gmt.get_genes(gsid)))
+            if gsid == 'C':
+                # No edges within the set
+                self.assertTrue(numpy.isnan(obs) and numpy.isnan(pval))
+            else:
+                self.assertTrue(0 < pval <= 1)
+
+        # Test the pool computes the same null distributions
+        pooled = SetConnectivity(self.dab).score(self.gmt, n_perm=100,
+                                                 processes=2)
+        self.assertEqual([s[:2] for s in scores], [s[:2] for s in pooled])
+        numpy.testing.assert_array_equal([s[2:] for s in scores],
+                                         [s[2:] for s in pooled])
@@ -75,3 +75,25 @@ class TestDab(unittest.TestCase):
                     # Test the values from dab.get match dab.get_value
                     self.assertEqual(
                         vals[j], self.qdab.get_value_genestr(g1, g2))
+
+    def test_get_values(self):
+        # Test the vectorized lookup matches get_value for every pair
+        idx1, idx2 = [], []
+        for i in range(self.dab.get_size()):
+            for j in range(self.dab.get_size()):
+                idx1.append(i)
+                idx2.append(j)
+        vals = self.dab.get_values(idx1, idx2)
+        for i, j, v in zip(idx1, idx2, vals):
+            if i == j:
+                self.assertEqual(v, 1)
+            else:
+                self.assertEqual(v, self.dab.get_value(i, j))
+
+    def test_get_rows(self):
+        # Test full rows match dab.get
+        rows = self.dab.get_rows(range(self.dab.get_size()))
+        for i, g in enumerate(self.dab.gene_list):
+            numpy.testing.assert_array_equal(rows[i], self.dab.get(g))
+        rows = self.qdab.get_rows([3, 0])
+        numpy.testing.assert_array_equal(rows[0], self.qdab.get(self.qdab.gene_list[3]))
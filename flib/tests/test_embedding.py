@@ -0,0 +1,40 @@
+import os
+import shutil
+import tempfile
+import unittest
+import numpy
+
+from flib.core.dab import Dab
+from flib.core.embedding import network_embedding, load_embedding, embedding_file
+from flib.core.svm import NetworkSVM
+from flib.tests.test_svm import synthetic_network
+
+
+class TestEmbedding(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        genes = synthetic_network(self.tmp_dir + '/net.dab')
+        self.dab = Dab(self.tmp_dir + '/net.dab')
+        self.pos = set(genes[:12])
+        self.neg = set(genes[20:])
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_full_rank(self):
+        """Test a full rank embedding reproduces the network inner products"""
+        X = self.dab.get_rows(range(self.dab.get_size()))
+        E = network_embedding(self.dab, self.dab.get_size(), block_size=7)
+        assert numpy.allclose(E.dot(E.T), X.dot(X.T), rtol=1e-3, atol=1e-2)
+
+    def test_svm(self):
+        """Test NetworkSVM trains on a stored low rank embedding"""
+        E = load_embedding(self.dab, 5)
+        self.assertEqual(E.shape, (self.dab.get_size(), 5))
+        self.assertTrue(os.path.exists(embedding_file(self.dab, 5)))
+
+        predictions = NetworkSVM(self.dab, X_all=E).predict(self.pos, self.neg,
+                                                            cv_folds=3)
+        top = set(g for (g, s, p) in predictions[:len(self.pos)])
+        self.assertTrue(len(top & self.pos) >= len(self.pos) - 2)
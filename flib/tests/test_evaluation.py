@@ -0,0 +1,106 @@
+import shutil
+import tempfile
+import unittest
+import numpy
+
+from sklearn.metrics import roc_auc_score, average_precision_score
+
+from flib.core.evaluation import term_metrics, evaluate_directory, load_term, \
+    bootstrap, paired_test, compare_directories
+from flib.core.predictions import PredictionStore
+from flib.core.svm import write_predictions
+
+
+class TestEvaluation(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        rng = numpy.random.RandomState(0)
+        self.labels = rng.rand(200) < .2
+        # Rounded scores have many ties
+        self.scores = numpy.round(self.labels + rng.normal(0, 1, 200), 1)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_term_metrics(self):
+        metrics = term_metrics(self.labels, self.scores, ks=(10,), fdrs=(.2, .5))
+        self.assertAlmostEqual(metrics['auroc'], roc_auc_score(self.labels, self.scores))
+        self.assertAlmostEqual(metrics['auprc'],
+                               average_precision_score(self.labels, self.scores))
+        self.assertEqual(metrics['pos'], self.labels.sum())
+
+        order = numpy.argsort(-self.scores, kind='mergesort')
+        self.assertEqual(metrics['p@10'], self.labels[order[:10]].mean())
+
+        # Recall at FDR from the thresholds of the scores
+        for fdr in [.2, .5]:
+            best = 0.
+            for t in numpy.unique(self.scores):
+                called = self.scores >= t
+                if (~self.labels[called]).mean() <= fdr:
+                    best = max(best, self.labels[called].sum() / float(self.labels.sum()))
+            self.assertAlmostEqual(metrics['recall@%g' % fdr], best)
+
+    def test_directory(self):
+        """Test text and store outputs evaluate the same across a pool"""
+        genes = ['G%i' % i for i in range(200)]
+        predictions = sorted(zip(genes, self.scores, self.scores / 10),
+                             key=lambda x: -x[1])
+        pos = set(g for g, l in zip(genes, self.labels) if l)
+        neg = set(genes) - pos - set(genes[:10])
+        store = PredictionStore(self.tmp_dir + '/store', genes=genes)
+        for term in ['A', 'B']:
+            write_predictions(self.tmp_dir + '/' + term, predictions, pos, neg)
+            store.append(term, predictions, pos, neg)
+
+        labels, scores, probs = load_term(self.tmp_dir, 'A')
+        self.assertEqual(len(labels), len(pos | neg))
+        text = evaluate_directory(self.tmp_dir, processes=2)
+        binary = evaluate_directory(self.tmp_dir + '/store')
+        self.assertEqual([t for t, m in text], ['A', 'B'])
+        for (t1, m1), (t2, m2) in zip(text, binary):
+            for metric in m1:
+                self.assertAlmostEqual(m1[metric], m2[metric], places=5)
+
+    def test_bootstrap(self):
+        """Test replicates match scikit-learn on the same resamples"""
+        replicates = bootstrap(self.labels, [self.scores, -self.scores],
+                               n_boot=20, seed=1)
+        draws = numpy.random.RandomState(1).randint(0, 200, size=(20, 200))
+        for b in range(20):
+            labels, scores = self.labels[draws[b]], self.scores[draws[b]]
+            self.assertAlmostEqual(replicates[0, 0, b], roc_auc_score(labels, scores))
+            self.assertAlmostEqual(replicates[0, 1, b],
+                                   average_precision_score(labels, scores))
+            self.assertAlmostEqual(replicates[1, 0, b], 1 - replicates[0, 0, b])
+
+        # Chunked resampling draws the same replicates
+        chunked = bootstrap(self.labels, [self.scores], n_boot=20, seed=1,
+                            max_cells=1000)
+        numpy.testing.assert_allclose(chunked[0], replicates[0])
+
+        test = paired_test(replicates[0], replicates[0])
+        self.assertEqual((test['p_auroc'], test['dauprc_lo']), (1., 0.))
+        test = paired_test(replicates[1], replicates[0])
+        self.assertTrue(test['p_auroc'] < .1 and test['dauroc_lo'] > 0)
+
+    def test_compare(self):
+        genes = ['G%i' % i for i in range(200)]
+        pos = set(g for g, l in zip(genes, self.labels) if l)
+        noisy = self.scores + numpy.random.RandomState(1).normal(0, 2, 200)
+        for name, scores in [('a', noisy), ('b', self.scores)]:
+            write_predictions('%s/%s' % (self.tmp_dir, name),
+                              zip(genes, scores, scores), pos, set(genes) - pos)
+        evaluated = dict(evaluate_directory(self.tmp_dir, n_boot=200))
+        self.assertTrue(evaluated['b']['auprc_lo'] < evaluated['b']['auprc'] <
+                        evaluated['b']['auprc_hi'])
+
+        shutil.os.mkdir(self.tmp_dir + '/old')
+        shutil.os.rename(self.tmp_dir + '/a', self.tmp_dir + '/old/T')
+        shutil.os.mkdir(self.tmp_dir + '/new')
+        shutil.os.rename(self.tmp_dir + '/b', self.tmp_dir + '/new/T')
+        (term, result), = compare_directories(self.tmp_dir + '/old',
+                                              self.tmp_dir + '/new', n_boot=200)
+        self.assertTrue(result['auprc_b'] > result['auprc_a'])
+        self.assertTrue(result['p_auroc'] < .05)
@@ -0,0 +1,50 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from flib.core.manifest import RunManifest, input_hash
+from flib.core.svm import write_predictions
+
+
+class TestRunManifest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.manifest = RunManifest(self.tmp_dir)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_input_hash(self):
+        params = {'dab': 'net.dab', 'predict_all': False}
+        h = input_hash(set(['a', 'b']), set(['c']), params)
+        self.assertEqual(h, input_hash(set(['b', 'a']), set(['c']), dict(params)))
+        self.assertNotEqual(h, input_hash(set(['a']), set(['b', 'c']), params))
+        self.assertNotEqual(h, input_hash(set(['a', 'b']), set(['c']),
+                                          {'dab': 'net.dab', 'predict_all': True}))
+
+    def test_resume(self):
+        self.assertEqual(self.manifest.status(), None)
+        self.manifest.start(['T1', 'T2', 'T3'], {})
+        self.manifest.record('T1', 'h1', 1.5)
+        self.manifest.record('T2', 'h2', 2.5)
+
+        # A torn trailing line from a crash is ignored
+        with open(os.path.join(self.tmp_dir, '.manifest.jsonl'), 'a') as f:
+            f.write('{"event": "do')
+
+        manifest = RunManifest(self.tmp_dir)
+        self.assertEqual(manifest.completed(), {'T1': 'h1', 'T2': 'h2'})
+        status = manifest.status()
+        self.assertEqual(status['terms'], 3)
+        self.assertEqual(status['done'], 2)
+        self.assertEqual(status['remaining'], 1)
+        self.assertTrue(status['eta'] is not None)
+
+    def test_write_predictions(self):
+        ofile = os.path.join(self.tmp_dir, 'T1')
+        write_predictions(ofile, [('a', 1.0, .9), ('b', -1.0, .1)],
+                          set(['a']), set(['b']))
+        self.assertEqual(os.listdir(self.tmp_dir), ['T1'])
+        self.assertEqual(open(ofile).read(), 'a\t1\t1.0\t0.9\t\nb\t-1\t-1.0\t0.1\t\n')
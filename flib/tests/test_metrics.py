@@ -0,0 +1,80 @@
+import json
+import os
+import shutil
+import tempfile
+import unittest
+from multiprocessing import Pool
+
+import numpy
+
+from flib.core.dab import Dab
+from flib.core.metrics import StageMetrics, summarize_metrics
+from flib.core.svm import NetworkSVM
+from flib.tests.test_svm import synthetic_network
+
+_metrics = None
+
+
+def run_stage(term):
+    _metrics.set_term(term)
+    with _metrics.stage('work'):
+        sum(range(10000))
+
+
+class TestStageMetrics(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.filename = self.tmp_dir + '/metrics.jsonl'
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_workers(self):
+        """Test records of forked workers aggregate in the metrics file"""
+        global _metrics
+        _metrics = StageMetrics(self.filename)
+        with _metrics.stage('setup'):
+            pass
+        pool = Pool(2)
+        pool.map(run_stage, ['T%i' % i for i in range(6)])
+        pool.close()
+        pool.join()
+
+        records = [json.loads(l) for l in open(self.filename)]
+        self.assertEqual(sorted(r['term'] for r in records if r['stage'] == 'work'),
+                         ['T%i' % i for i in range(6)])
+        totals = _metrics.summarize()
+        self.assertEqual(totals['work'][0], 6)
+        self.assertEqual(totals['setup'][0], 1)
+        self.assertTrue(all(t[4] > 0 for t in totals.values()))
+
+        # Other runs appending to the same file are kept apart
+        other = StageMetrics(self.filename)
+        with other.stage('setup'):
+            pass
+        self.assertEqual(summarize_metrics(self.filename, run=other.run)['setup'][0], 1)
+        self.assertEqual(summarize_metrics(self.filename)['setup'][0], 2)
+
+    @unittest.skipUnless(os.path.exists('/proc/self/clear_refs'),
+                         'needs a resettable peak RSS')
+    def test_stage_peak(self):
+        """Test each stage reports its own peak RSS, not an earlier one"""
+        metrics = StageMetrics()
+        with metrics.stage('outer'):
+            with metrics.stage('large'):
+                x = numpy.ones(1 << 25)  # 256 MB
+                del x
+            with metrics.stage('small'):
+                pass
+        totals = metrics.summarize()
+        self.assertTrue(totals['large'][4] - totals['small'][4] > 200)
+        self.assertEqual(totals['outer'][4], totals['large'][4])
+
+    def test_svm_stages(self):
+        genes = synthetic_network(self.tmp_dir + '/net.dab')
+        metrics = StageMetrics()
+        svm = NetworkSVM(Dab(self.tmp_dir + '/net.dab'), metrics=metrics)
+        svm.predict(set(genes[:12]), set(genes[20:]), predict_all=True, cv_folds=3)
+        self.assertEqual(sorted(metrics.summarize()),
+                         ['calibration', 'features', 'fit', 'predict_all'])
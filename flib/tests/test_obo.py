@@ -0,0 +1,265 @@
+import copy
+import os
+import pickle
+import shutil
+import tempfile
+import unittest
+
+from flib.core.obo import OBO, Annotation
+
+OBO_FILE = 'files/test_data/test_obo.obo'
+
+
+class TestOBOParser(unittest.TestCase):
+
+    def setUp(self):
+        self.obo = OBO(OBO_FILE)
+
+    def test_meta(self):
+        self.assertEqual(self.obo.get_meta_data('format-version'), '1.2')
+        self.assertEqual(self.obo.get_meta_data('subsetdef'), 'goslim_generic')
+        # Typedef stanzas are not metadata
+        self.assertEqual(self.obo.get_meta_data('is_transitive'), None)
+
+    def test_terms(self):
+        self.assertEqual(sorted(self.obo.go_terms),
+                         ['GO:0000724', 'GO:0006281', 'GO:0006974', 'GO:0008150',
+                          'GO:0008409', 'GO:0010569', 'GO:2000779'])
+        term = self.obo.get_term('GO:0000724')
+        self.assertEqual(term.name,
+                         'double_strand_break_repair_via_homologous_recombination')
+        self.assertEqual(term.namespace, 'biological_process')
+        self.assertEqual(self.obo.get_term('GO:0008409').name, '5_3_exonuclease_activity')
+        self.assertEqual(self.obo.get_term('GO:0008409').fullname,
+                         "5'-3' exonuclease activity")
+        self.assertEqual(self.obo.get_term('GO:0006281').desc,
+                         'The process of restoring DNA after damage.')
+
+    def test_graph(self):
+        go = self.obo.go_terms
+        self.assertEqual(sorted(t.go_id for t in self.obo.heads),
+                         ['GO:0008150', 'GO:0008409'])
+        self.assertEqual(go['GO:0000724'].is_a, [go['GO:0006281']])
+        self.assertEqual(go['GO:0000724'].relationship_part_of, [go['GO:0006974']])
+        self.assertEqual(go['GO:0006974'].parent_of,
+                         set([go['GO:0006281'], go['GO:0000724']]))
+        self.assertEqual(go['GO:2000779'].relationship_regulates, [go['GO:0006281']])
+        # has_part is not a parent relationship
+        self.assertFalse(go['GO:2000779'] in go['GO:0000724'].parent_of)
+        self.assertEqual(self.obo.get_ancestors('GO:0000724'),
+                         set(['GO:0006281', 'GO:0006974', 'GO:0008150']))
+
+    def test_alternates(self):
+        self.assertEqual(self.obo.get_term('GO:0000004').go_id, 'GO:0008150')
+        self.assertEqual([t.go_id for t in self.obo.get_obsolete_terms()],
+                         ['GO:0000005'])
+        self.assertEqual(self.obo.get_term('GO:0006281').synonyms,
+                         ['DNA repair process'])
+        self.assertEqual(self.obo.name2synonyms['biological_process'],
+                         ['physiological process'])
+        self.assertEqual(self.obo.get_term('GO:0006281').get_xrefs('Reactome'),
+                         set(['R-HSA-73894']))
+        self.assertEqual(self.obo.get_xref_mapping('EC'), {'3.1.11.-': set(['GO:0008409'])})
+
+    def test_closure(self):
+        self.assertEqual(self.obo.get_ancestors('GO:0010569'),
+                         set(['GO:2000779', 'GO:0006281', 'GO:0006974', 'GO:0008150']))
+        self.assertEqual(self.obo.get_descendents('GO:0006281'),
+                         set(['GO:0000724', 'GO:2000779', 'GO:0010569']))
+        self.assertEqual(self.obo.get_descendents('GO:0008409'), set())
+        self.assertEqual(self.obo.get_ancestors('GO:0000005'), set())
+        self.assertTrue(self.obo.is_ancestor('GO:0008150', 'GO:0000724'))
+        self.assertFalse(self.obo.is_ancestor('GO:0000724', 'GO:0008150'))
+        self.assertFalse(self.obo.is_ancestor('GO:0008409', 'GO:0000724'))
+        self.assertTrue(self.obo.get_closure() is self.obo.get_closure())
+
+        # Loading more terms rebuilds the closure; parents of another
+        # namespace are not followed
+        out_dir = tempfile.mkdtemp()
+        try:
+            obo_file = os.path.join(out_dir, 'more.obo')
+            with open(obo_file, 'w') as f:
+                f.write('[Term]\nid: GO:0000001\nnamespace: biological_process\n'
+                        'is_a: GO:0010569\n\n'
+                        '[Term]\nid: GO:0000002\nnamespace: molecular_function\n'
+                        'is_a: GO:0000001\n')
+            self.obo.load_obo(obo_file)
+        finally:
+            shutil.rmtree(out_dir)
+        self.assertTrue(self.obo.is_ancestor('GO:0006281', 'GO:0000001'))
+        self.assertEqual(self.obo.get_ancestors('GO:0000002'), set())
+        self.assertEqual(self.obo.get_descendents('GO:2000779'),
+                         set(['GO:0010569', 'GO:0000001']))
+
+    def structure(self, obo):
+        def ids(gterms):
+            return sorted(gterm.go_id for gterm in gterms)
+        terms = {}
+        for key, gterms in (('current', obo.go_terms), ('obsolete', obo.go_obsolete)):
+            for go_id, t in gterms.items():
+                terms[key, go_id] = (
+                    t.go_id, t.head, t.obsolete, t.name, t.fullname, t.namespace,
+                    t.desc, t.alt_id, t.synonyms, t.xrefs, ids(t.is_a),
+                    ids(t.relationship_regulates), ids(t.relationship_part_of),
+                    ids(t.parent_of), ids(t.child_of))
+        return (terms, ids(obo.heads), obo.alt_id2std_id, obo.name2synonyms, obo._meta)
+
+    def test_cache(self):
+        cache_dir = tempfile.mkdtemp()
+        try:
+            for _ in range(2):
+                obo = OBO()
+                obo.load_obo_cached(OBO_FILE, cache_dir)
+                self.assertEqual(self.structure(obo), self.structure(self.obo))
+            self.assertEqual(len(os.listdir(cache_dir)), 1)
+
+            # A cached ontology is shared by its terms' relationships
+            go = obo.go_terms
+            self.assertTrue(go['GO:0000724'].is_a[0] is go['GO:0006281'])
+            self.assertTrue(obo.get_term('GO:0000004') is go['GO:0008150'])
+
+            # Other content is another cache entry
+            obo_file = os.path.join(cache_dir, 'copy.obo')
+            with open(OBO_FILE) as f, open(obo_file, 'w') as copy:
+                copy.write(f.read() + '\n')
+            OBO().load_obo_cached(obo_file, cache_dir)
+            self.assertEqual(len(os.listdir(cache_dir)), 3)
+        finally:
+            shutil.rmtree(cache_dir)
+
+    def propagated(self, go_id):
+        return sorted((a.gid, a.direct, a.ready_regulates_cutoff)
+                      for a in self.obo.get_term(go_id).annotations)
+
+    def test_propagation(self):
+        self.obo.add_annotation('GO:0000724', gid='672', ref=None, direct=True)
+        self.obo.add_annotation('GO:2000779', gid='7157', ref=None, direct=True)
+        self.obo.add_annotation('GO:0010569', gid='5888', ref=None, direct=True)
+        self.obo.propagate()
+
+        self.assertEqual(self.propagated('GO:0000724'), [('672', True, False)])
+        # Through regulates only annotations not yet cut off pass, marked
+        self.assertEqual(self.propagated('GO:2000779'),
+                         [('5888', False, True), ('7157', True, False)])
+        self.assertEqual(self.propagated('GO:0006281'),
+                         [('672', False, False), ('7157', False, True)])
+        # part_of marks the annotation; is_a keeps its mark
+        self.assertEqual(self.propagated('GO:0006974'),
+                         [('672', False, False), ('672', False, True),
+                          ('7157', False, True)])
+        self.assertEqual(self.propagated('GO:0008150'),
+                         [('5888', False, True), ('672', False, False),
+                          ('672', False, True), ('7157', False, False),
+                          ('7157', False, True)])
+        self.assertEqual(self.propagated('GO:0008409'), [])
+
+        # Propagating again adds nothing
+        self.obo.propagate()
+        self.assertEqual(len(self.propagated('GO:0008150')), 5)
+
+        # Equal propagated annotations are one shared object
+        root = dict(((a.gid, a.ready_regulates_cutoff), a)
+                    for a in self.obo.get_term('GO:0008150').annotations)
+        for go_id in ('GO:0006974', 'GO:0006281'):
+            for annotation in self.obo.get_term(go_id).annotations:
+                self.assertTrue(
+                    annotation is root[annotation.gid, annotation.ready_regulates_cutoff])
+
+    def test_annotation(self):
+        gid = ''.join(['6', '7', '2'])
+        annotation = Annotation(gid=gid, ref='PMID:1', evidence='IDA', direct=True)
+        self.assertTrue(annotation.gid is Annotation(gid='672').gid)
+        self.assertRaises(TypeError, setattr, annotation, 'gid', '7157')
+        self.assertRaises(AttributeError, lambda: annotation.__dict__)
+
+        propagated = annotation.prop_copy()
+        self.assertEqual((propagated.gid, propagated.ref, propagated.evidence,
+                          propagated.direct),
+                         ('672', 'PMID:1', 'IDA', False))
+        self.assertTrue(propagated.prop_copy() is propagated)
+        self.assertNotEqual(propagated, annotation)
+        self.assertEqual(hash(propagated), hash(Annotation(gid='672', ref='PMID:1',
+                                                     evidence='IDA')))
+        flyweights = {}
+        self.assertTrue(annotation.prop_copy(True, flyweights) is
+                        propagated.prop_copy(True, flyweights))
+
+        # Annotations round-trip through pickle and deepcopy
+        for annotation in (annotation, propagated.prop_copy(True)):
+            for restored in (pickle.loads(pickle.dumps(annotation, protocol))
+                             for protocol in range(pickle.HIGHEST_PROTOCOL + 1)):
+                self.assertEqual(restored, annotation)
+                self.assertEqual(hash(restored), hash(annotation))
+                self.assertTrue(restored.gid is annotation.gid)
+            self.assertEqual(copy.deepcopy(annotation), annotation)
+        self.obo.add_annotation('GO:0000724', gid='672', ref=None, direct=True)
+        self.obo.propagate()
+        for restored in (pickle.loads(pickle.dumps(self.obo, pickle.HIGHEST_PROTOCOL)),
+                         copy.deepcopy(self.obo)):
+            self.assertEqual(self.structure(restored), self.structure(self.obo))
+            self.assertEqual(restored.get_term('GO:0008150').annotations,
+                             self.obo.get_term('GO:0008150').annotations)
+
+    def test_compact(self):
+        compact = OBO(OBO_FILE, compact=True)
+        for obo in (self.obo, compact):
+            obo.add_annotation('GO:0000724', gid='672', ref=None, direct=True)
+            obo.add_annotation('GO:2000779', gid='7157', ref=None, direct=True)
+            obo.get_term('GO:0010569').add_annotation('5888')
+            obo.get_term('GO:0006281').add_annotation('675', cross_annotated=True)
+            obo.propagate()
+
+        for go_id in self.obo.go_terms:
+            self.assertEqual(sorted(compact.get_term(go_id).get_annotated_genes()),
+                             sorted(set(self.obo.get_term(go_id).get_annotated_genes())))
+        self.assertEqual(compact.get_term('GO:0006281').get_annotated_genes(False),
+                         ['672', '7157'])
+        self.assertEqual(compact.get_term('GO:0008150').get_annotation_size(), 4)
+
+        # Provenance: direct genes and genes cut off from regulates
+        index = compact.gene_index
+        root = compact.get_term('GO:0008150')
+        self.assertEqual(index.decode(compact.get_term('GO:2000779').direct_bits),
+                         ['7157'])
+        self.assertEqual(root.direct_bits, 0)
+        self.assertEqual(index.decode(root.cutoff_bits[None]), ['672', '7157', '5888'])
+        self.assertEqual(index.decode(root.gene_bits[None]), ['672', '7157', '675'])
+
+        self.assertEqual(compact.as_gmt().genesets, self.obo.as_gmt().genesets)
+        out_dir = tempfile.mkdtemp()
+        try:
+            for write in ('print_to_gmt_file', 'print_to_mat_file',
+                          'print_to_single_file'):
+                lines = []
+                for obo in (self.obo, compact):
+                    out_file = os.path.join(out_dir, 'go.txt')
+                    getattr(obo, write)(out_file)
+                    with open(out_file) as f:
+                        # Genes of a GMT line and the gene rows of a matrix
+                        # are unordered
+                        lines.append(sorted(set(
+                            tuple(sorted(line.split())) if write == 'print_to_gmt_file'
+                            else line for line in f)))
+                self.assertEqual(lines[0], lines[1], write)
+            self.assertRaises(ValueError, compact.print_to_single_file,
+                              os.path.join(out_dir, 'go.txt'), gene_asso_format=True)
+        finally:
+            shutil.rmtree(out_dir)
+
+        self.assertEqual(compact.get_leaves(min_annot=1),
+                         self.obo.get_leaves(min_annot=1))
+        self.assertEqual(len(compact.get_leaves(min_annot=1)), 2)
+
+        id_name = {'672': ['A', 'B'], '7157': ['C'], '675': ['A']}
+        for obo in (self.obo, compact):
+            obo.map_genes(id_name)
+        for go_id in self.obo.go_terms:
+            self.assertEqual(sorted(compact.get_term(go_id).get_annotated_genes()),
+                             sorted(set(self.obo.get_term(go_id).get_annotated_genes())))
+        self.assertEqual(sorted(compact.get_term('GO:0008150').get_annotated_genes()),
+                         ['A', 'B', 'C'])
+        self.assertEqual(index.decode(compact.get_term('GO:2000779').direct_bits), ['C'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,43 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from flib.core.onto import Ontology
+
+OBO_FILE = 'files/test_data/test_obo.obo'
+
+
+class TestOntology(unittest.TestCase):
+
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.cache_dir)
+
+    def test_generate(self):
+        onto = Ontology.generate(obo_file=OBO_FILE, cache_dir=None)
+        self.assertEqual(len(onto.go_terms), 7)
+        self.assertEqual(os.listdir(self.cache_dir), [])
+
+        cache_dir = os.path.join(self.cache_dir, 'obo')
+        for _ in range(2):
+            cached = Ontology.generate(obo_file=OBO_FILE, cache_dir=cache_dir)
+            self.assertEqual(sorted(cached.go_terms), sorted(onto.go_terms))
+            self.assertEqual(cached.get_ancestors('GO:0000724'),
+                             onto.get_ancestors('GO:0000724'))
+            self.assertEqual(cached.get_meta_data('format-version'), '1.2')
+            self.assertEqual(len(os.listdir(cache_dir)), 1)
+
+    def test_unwritable_cache(self):
+        # A cache directory that cannot be created only skips caching
+        blocker = os.path.join(self.cache_dir, 'file')
+        open(blocker, 'w').close()
+        onto = Ontology.generate(obo_file=OBO_FILE,
+                                 cache_dir=os.path.join(blocker, 'obo'))
+        self.assertEqual(len(onto.go_terms), 7)
+
+
+if __name__ == '__main__':
+    unittest.main()
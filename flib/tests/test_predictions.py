@@ -0,0 +1,96 @@
+import shutil
+import tempfile
+import unittest
+from multiprocessing import Pool
+import numpy
+
+from flib.core.predictions import PredictionStore
+
+GENES = ['G%i' % i for i in range(20)]
+
+
+def term_predictions(i):
+    predictions = [(g, float(j * i), .5 ** j) for j, g in enumerate(GENES[:10])]
+    return predictions, set(GENES[:3]), set(GENES[5:10])
+
+
+def append_term(args):
+    directory, i = args
+    store = PredictionStore(directory, genes=GENES)
+    store.append('T%i' % i, *term_predictions(i))
+
+
+class TestPredictionStore(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.store_dir = self.tmp_dir + '/store'
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_append(self):
+        store = PredictionStore(self.store_dir, genes=GENES)
+        store.append('T1', *term_predictions(1))
+        store.append('T2', *term_predictions(2))
+        store.append('T1', *term_predictions(3))
+        self.assertEqual(store.terms(), ['T2', 'T1'])
+
+        scores, probs, labels = store.get_term('T1')
+        numpy.testing.assert_array_equal(scores[:10], numpy.arange(10) * 3)
+        self.assertTrue(numpy.isnan(scores[10:]).all())
+        self.assertEqual(list(labels[:10]), [1] * 3 + [0] * 2 + [-1] * 5)
+
+        self.assertEqual(store.get_gene('G2'), {'T1': (6., .25, 1.),
+                                                'T2': (4., .25, 1.)})
+        self.assertEqual(store.matrix('probs').shape, (3, len(GENES)))
+
+        # Reopening requires the same genes
+        self.assertEqual(PredictionStore(self.store_dir).terms(), ['T2', 'T1'])
+        self.assertRaises(ValueError, PredictionStore, self.store_dir, GENES[1:])
+
+    def test_partial_row(self):
+        """Test a row left by an interrupted writer is overwritten"""
+        store = PredictionStore(self.store_dir, genes=GENES)
+        store.append('T1', *term_predictions(1))
+        with open(self.store_dir + '/scores.f32', 'ab') as f:
+            f.write(b'\x00' * 12)
+        store.append('T2', *term_predictions(2))
+        scores, probs, labels = store.get_term('T2')
+        numpy.testing.assert_array_equal(scores[:10], numpy.arange(10) * 2)
+
+    def test_partial_term(self):
+        """Test a term line left without its newline is overwritten"""
+        store = PredictionStore(self.store_dir, genes=GENES)
+        store.append('T1', *term_predictions(1))
+        with open(self.store_dir + '/terms.txt', 'a') as f:
+            f.write('T')
+        self.assertEqual(store.terms(), ['T1'])
+        store.append('T2', *term_predictions(2))
+        self.assertEqual(store.terms(), ['T1', 'T2'])
+        with open(self.store_dir + '/terms.txt') as f:
+            self.assertEqual(f.read(), 'T1\nT2\n')
+        scores, probs, labels = store.get_term('T2')
+        numpy.testing.assert_array_equal(scores[:10], numpy.arange(10) * 2)
+
+    def test_writers(self):
+        """Test concurrent writers each add a complete row"""
+        pool = Pool(4)
+        pool.map(append_term, [(self.store_dir, i) for i in range(20)])
+        pool.close()
+        pool.join()
+
+        store = PredictionStore(self.store_dir)
+        self.assertEqual(sorted(store.terms()), sorted('T%i' % i for i in range(20)))
+        for i in range(20):
+            scores, probs, labels = store.get_term('T%i' % i)
+            numpy.testing.assert_array_equal(scores[:10], numpy.arange(10) * i)
+
+    def test_export_text(self):
+        store = PredictionStore(self.store_dir, genes=GENES)
+        store.append('T2', *term_predictions(2))
+        store.export_text(self.tmp_dir + '/text')
+        lines = [l.split('\t') for l in open(self.tmp_dir + '/text/T2')]
+        self.assertEqual(len(lines), 10)
+        self.assertEqual(lines[0][:3], ['G9', '-1', '18.0'])
+        self.assertEqual(lines[-1][:3], ['G0', '1', '0.0'])
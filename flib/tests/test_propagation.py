@@ -0,0 +1,70 @@
+import os
+import tempfile
+import unittest
+import numpy
+
+from flib.core.dab import Dab
+from flib.core.propagation import NetworkPropagation
+
+
+class TestNetworkPropagation(unittest.TestCase):
+
+    def setUp(self):
+        self.dab = Dab('files/test_data/test_dab.dab')
+        genes = self.dab.gene_list
+        # The last five genes form a clique; the first gene is a hub for the
+        # next ten
+        self.pos = set(genes[11:15])
+        self.neg = set(genes[1:9])
+
+    def tearDown(self):
+        return
+
+    def test_representations(self):
+        """Test dense, sparse and packed networks give the same scores"""
+        results = []
+        for representation in ['dense', 'sparse', 'packed']:
+            prop = NetworkPropagation(self.dab, representation=representation,
+                                      block_size=5)
+            results.append(dict((g, s) for (g, s, p) in
+                                prop.predict(self.pos, self.neg, cv_folds=2)))
+        for result in results[1:]:
+            for g in self.dab.gene_list:
+                assert numpy.isclose(results[0][g], result[g])
+
+    def test_predict(self):
+        """Test unlabeled clique members rank above unconnected genes"""
+        prop = NetworkPropagation(self.dab)
+        predictions = prop.predict(self.pos, self.neg, cv_folds=2)
+        self.assertEqual(len(predictions), self.dab.get_size())
+        scores = dict((g, s) for (g, s, p) in predictions)
+        genes = self.dab.gene_list
+        self.assertTrue(scores[genes[15]] > scores[genes[9]])
+        for (g, s, p) in predictions:
+            self.assertTrue(0 <= p <= 1)
+
+    def test_predict_many(self):
+        """Test batched terms match terms propagated one at a time"""
+        genes = self.dab.gene_list
+        label_sets = {'A': (self.pos, self.neg),
+                      'B': (set(genes[0:4]), set(genes[11:16]))}
+        prop = NetworkPropagation(self.dab)
+        batched = prop.predict_many(label_sets, cv_folds=2, max_columns=3)
+        for term, (pos, neg) in label_sets.items():
+            single = prop.predict(pos, neg, cv_folds=2)
+            for (g1, s1, p1), (g2, s2, p2) in zip(batched[term], single):
+                assert numpy.isclose(s1, s2) and numpy.isclose(p1, p2)
+
+    def test_print_predictions(self):
+        """Test predictions are written in the NetworkSVM format"""
+        prop = NetworkPropagation(self.dab)
+        prop.predict(self.pos, self.neg, cv_folds=2)
+        ofile = tempfile.NamedTemporaryFile(delete=False).name
+        prop.print_predictions(ofile, self.pos, self.neg)
+        labels = {}
+        for l in open(ofile):
+            gene, label, score, prob = l.strip().split('\t')
+            labels[gene] = label
+        os.remove(ofile)
+        self.assertEqual(set(g for g in labels if labels[g] == '1'), self.pos)
+        self.assertEqual(set(g for g in labels if labels[g] == '-1'), self.neg)
@@ -0,0 +1,39 @@
+import time
+import unittest
+
+from flib.core.scheduler import TermScheduler, estimate_costs
+
+
+def sleep_job(job):
+    term, seconds = job
+    time.sleep(seconds)
+    return term
+
+
+class TestScheduler(unittest.TestCase):
+
+    def test_estimate_costs(self):
+        # No history: cost is the number of labeled genes
+        self.assertEqual(estimate_costs({'A': 10, 'B': 20}), {'A': 10, 'B': 20})
+
+        records = [{'event': 'start'},
+                   {'event': 'done', 'term': 'A', 'seconds': 2., 'size': 10},
+                   {'event': 'done', 'term': 'C', 'seconds': 8., 'size': 40}]
+        costs = estimate_costs({'A': 10, 'B': 20}, records)
+        self.assertEqual(costs['A'], 2.)
+        self.assertAlmostEqual(costs['B'], 4.)
+
+    def test_largest_first(self):
+        jobs = dict(('T%i' % i, ('T%i' % i, .01 * i)) for i in range(6))
+        costs = dict((term, seconds) for term, (t, seconds) in jobs.items())
+
+        scheduler = TermScheduler(1)
+        self.assertEqual(list(scheduler.run(sleep_job, jobs, costs)),
+                         ['T%i' % i for i in reversed(range(6))])
+
+        scheduler = TermScheduler(2)
+        self.assertEqual(sorted(scheduler.run(sleep_job, jobs, costs)),
+                         sorted(jobs))
+        utilization = scheduler.utilization()
+        self.assertEqual(sum(u[0] for u in utilization.values()), 6)
+        self.assertTrue(all(0 < u[2] <= 1 for u in utilization.values()))
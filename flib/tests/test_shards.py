@@ -0,0 +1,85 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from flib.core.manifest import RunManifest
+from flib.core.predictions import PredictionStore
+from flib.core.shards import ShardPlan, balance, merge_shards, parse_shard
+from flib.core.svm import write_predictions
+
+COSTS = {'A': 10., 'B': 8., 'C': 5., 'D': 4., 'E': 3., 'F': 1.}
+
+
+class TestShards(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_balance(self):
+        self.assertEqual(parse_shard('1/3'), (1, 3))
+        self.assertRaises(ValueError, parse_shard, '3/3')
+
+        assignment = balance(COSTS, 2)
+        loads = [sum(c for t, c in COSTS.items() if assignment[t] == s)
+                 for s in range(2)]
+        self.assertEqual(sorted(loads), [15., 16.])
+        self.assertEqual(assignment, balance(dict(reversed(list(COSTS.items()))), 2))
+
+    def test_plan(self):
+        """Test nodes share the first plan and claims"""
+        plan = ShardPlan(self.tmp_dir).create(COSTS, 2)
+        other = ShardPlan(self.tmp_dir).create({'A': 1., 'Z': 1.}, 2)
+        self.assertEqual(plan.assignment, other.assignment)
+        self.assertRaises(ValueError, ShardPlan(self.tmp_dir).create, COSTS, 3)
+
+        own = plan.shard_terms(0)
+        self.assertEqual(own[0], 'A')
+        self.assertTrue(all(plan.claim(t, 0) for t in own))
+        # Restarted shards keep their claims, other shards cannot steal them
+        self.assertTrue(plan.claim(own[0], 0))
+        self.assertFalse(other.claim(own[0], 1))
+        stealable = plan.steal_order(1)
+        self.assertEqual(sorted(stealable), sorted(own))
+
+    def complete(self, shard, term, store=False):
+        shard_dir = ShardPlan(self.tmp_dir).shard_dir(shard)
+        predictions = [('G1', 1., .9), ('G2', 0., .1)]
+        if store:
+            PredictionStore(shard_dir, genes=['G1', 'G2', 'G3']).append(
+                term, predictions, set(['G1']), set(['G2']))
+        else:
+            write_predictions(os.path.join(shard_dir, term), predictions,
+                              set(['G1']), set(['G2']))
+        RunManifest(shard_dir).record(term, 'h', 1.)
+
+    def test_merge(self):
+        plan = ShardPlan(self.tmp_dir).create(COSTS, 2)
+        for term in plan.shard_terms(0):
+            self.complete(0, term)
+        stolen = plan.shard_terms(1)[-1]
+        self.complete(0, stolen)
+        self.complete(1, stolen)
+
+        report = merge_shards(self.tmp_dir)
+        missing = sorted(set(plan.shard_terms(1)) - set([stolen]))
+        self.assertEqual(report['missing'], missing)
+        self.assertEqual(report['duplicated'], {stolen: [0, 1]})
+        self.assertEqual(report['merged'], len(COSTS) - len(missing))
+        self.assertTrue(os.path.exists(os.path.join(self.tmp_dir, stolen)))
+
+    def test_merge_store(self):
+        plan = ShardPlan(self.tmp_dir).create(COSTS, 2)
+        for shard in range(2):
+            for term in plan.shard_terms(shard):
+                self.complete(shard, term, store=True)
+        report = merge_shards(self.tmp_dir)
+        self.assertEqual((report['missing'], report['duplicated']), ([], {}))
+        store = PredictionStore(self.tmp_dir)
+        self.assertEqual(sorted(store.terms()), sorted(COSTS))
+        predictions, pos, neg = store.get_predictions('A')
+        self.assertEqual([g for (g, s, p) in predictions], ['G1', 'G2'])
+        self.assertEqual((pos, neg), (set(['G1']), set(['G2'])))
@@ -0,0 +1,234 @@
+import json
+import os
+import shutil
+import tempfile
+import unittest
+import numpy
+
+from flib.core.dab import Dab, write_dab
+from flib.core.svm import NetworkSVM, write_matrix, gram_matrix, sparse_features
+
+
+def synthetic_network(filename, size=60, module=15, seed=0):
+    """Write a network whose first module genes are densely connected"""
+    rng = numpy.random.RandomState(seed)
+    genes = ['G%i' % i for i in range(size)]
+    values = []
+    for i in range(size):
+        for j in range(i + 1, size):
+            mean = .8 if j < module else .2
+            values.append(min(1, max(0, rng.normal(mean, .15))))
+    write_dab(filename, genes, values)
+    return genes
+
+
+class TestNetworkSVM(unittest.TestCase):
+
+    def assertPredictionsEqual(self, first, second):
+        # Same genes and scores up to solver and optimizer noise
+        self.assertEqual(sorted(g for (g, s, p) in first),
+                         sorted(g for (g, s, p) in second))
+        first, second = sorted(first), sorted(second)
+        assert numpy.allclose([s for (g, s, p) in first],
+                              [s for (g, s, p) in second], rtol=1e-4)
+        assert numpy.allclose([p for (g, s, p) in first],
+                              [p for (g, s, p) in second], rtol=1e-4)
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.dab_file = self.tmp_dir + '/net.dab'
+        genes = synthetic_network(self.dab_file)
+        self.dab = Dab(self.dab_file)
+        self.pos = set(genes[:12])
+        self.neg = set(genes[20:])
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_predict(self):
+        svm = NetworkSVM(self.dab)
+        predictions = svm.predict(self.pos, self.neg, cv_folds=3)
+        self.assertEqual(len(predictions), len(self.pos | self.neg))
+        # Positives should rank at the top
+        top = set(g for (g, s, p) in predictions[:len(self.pos)])
+        self.assertTrue(len(top & self.pos) >= len(self.pos) - 2)
+
+    def test_shared_matrix(self):
+        """Test a memory-mapped network matrix gives the same predictions"""
+        X_all = write_matrix(self.dab, self.tmp_dir + '/net.npy', block_size=7)
+        self.assertTrue(isinstance(X_all, numpy.memmap))
+        numpy.testing.assert_array_equal(
+            X_all, self.dab.get_rows(range(self.dab.get_size())))
+
+        expected = NetworkSVM(self.dab).predict(self.pos, self.neg, cv_folds=3)
+        shared = NetworkSVM(self.dab, X_all=X_all).predict(
+            self.pos, self.neg, cv_folds=3)
+        for (g1, s1, p1), (g2, s2, p2) in zip(expected, shared):
+            self.assertEqual(g1, g2)
+            assert numpy.isclose(s1, s2, atol=1e-4)
+
+    def test_predict_many(self):
+        """Test batch training returns predictions for every term"""
+        genes = self.dab.gene_list
+        label_sets = {'A': (self.pos, self.neg),
+                      'B': (set(genes[30:40]), set(genes[:10]) | set(genes[45:])),
+                      'C': (set(genes[:3]), set(genes[50:]))}
+        svm = NetworkSVM(self.dab)
+        results = svm.predict_many(label_sets, cv_folds=3)
+        self.assertEqual(set(results), set(label_sets))
+        for term, (pos, neg) in label_sets.items():
+            self.assertEqual(set(g for (g, s, p) in results[term]), pos | neg)
+
+        top = set(g for (g, s, p) in results['A'][:len(self.pos)])
+        self.assertTrue(len(top & self.pos) >= len(self.pos) - 2)
+
+        # Test the pool gives the same predictions
+        pooled = svm.predict_many(label_sets, cv_folds=3, processes=2)
+        for term in label_sets:
+            self.assertPredictionsEqual(pooled[term], results[term])
+
+    def test_precomputed_kernel(self):
+        """Test training on a cached Gram matrix"""
+        X = self.dab.get_rows(range(self.dab.get_size()))
+        K = gram_matrix(X, block_size=7)
+        assert numpy.allclose(K, X.dot(X.T), rtol=1e-4)
+
+        cache = self.tmp_dir + '/kernels'
+        os.mkdir(cache)
+        svm = NetworkSVM(self.dab, kernel='precomputed', kernel_cache=cache)
+        predictions = svm.predict(self.pos, self.neg, cv_folds=3)
+        self.assertEqual(len(os.listdir(cache)), 1)
+        top = set(g for (g, s, p) in predictions[:len(self.pos)])
+        self.assertTrue(len(top & self.pos) >= len(self.pos) - 2)
+
+        # A new instance reuses the cached kernel
+        svm = NetworkSVM(self.dab, kernel='precomputed', kernel_cache=cache)
+        svm.use_kernel()
+        self.assertTrue(isinstance(svm._K, numpy.memmap))
+        results = svm.predict_many({'A': (self.pos, self.neg)}, cv_folds=3)
+        self.assertEqual(set(g for (g, s, p) in results['A']), self.pos | self.neg)
+        self.assertEqual(len(os.listdir(cache)), 1)
+
+    def test_feature_cache_keys(self):
+        """Test kernels and parameters cached for one feature set are not
+        reused for another"""
+        cache = self.tmp_dir + '/kernels'
+        os.mkdir(cache)
+        X = self.dab.get_rows(range(self.dab.get_size()))
+        embedding = numpy.linalg.svd(X)[0][:, :5].astype(numpy.float32)
+
+        dense = NetworkSVM(self.dab, kernel='precomputed', kernel_cache=cache)
+        described = NetworkSVM(self.dab, X_all=embedding, kernel='precomputed',
+                               kernel_cache=cache, features={'embedding': 5})
+        digested = NetworkSVM(self.dab, X_all=embedding, kernel='precomputed',
+                              kernel_cache=cache)
+        keys = [svm._kernel_key([]) for svm in [dense, described, digested]]
+        self.assertEqual(len(set(keys)), 3)
+        self.assertEqual(digested._kernel_key([]),
+                         NetworkSVM(self.dab, X_all=embedding * 1)._kernel_key([]))
+        self.assertNotEqual(dense._params_key([1], ['G0']),
+                            described._params_key([1], ['G0']))
+
+        dense.use_kernel()
+        K = described.use_kernel()
+        self.assertEqual(len(os.listdir(cache)), 2)
+        assert numpy.allclose(K, embedding.dot(embedding.T), atol=1e-4)
+
+    def test_predict_all(self):
+        """Test genome-wide scoring streamed over blocks of rows"""
+        for kernel in ['linear', 'precomputed']:
+            svm = NetworkSVM(self.dab, kernel=kernel)
+            labeled = dict((g, s) for (g, s, p) in
+                           svm.predict(self.pos, self.neg, cv_folds=3))
+            predictions = svm.predict(self.pos, self.neg, predict_all=True,
+                                      cv_folds=3)
+            self.assertEqual(sorted(g for (g, s, p) in predictions),
+                             sorted(self.dab.gene_list))
+            self.assertTrue(all(0 <= p <= 1 for (g, s, p) in predictions))
+
+            # Labeled genes keep their held out scores
+            scores = dict((g, s) for (g, s, p) in predictions)
+            assert numpy.allclose([scores[g] for g in sorted(labeled)],
+                                  [labeled[g] for g in sorted(labeled)],
+                                  rtol=1e-3, atol=1e-3)
+
+            # Unlabeled module genes outscore unlabeled background genes
+            module = min(scores['G%i' % i] for i in range(12, 15))
+            background = max(scores['G%i' % i] for i in range(15, 20))
+            self.assertTrue(module > background)
+
+    def test_sgd_solver(self):
+        """Test streamed SGD training from a memory-mapped Dab"""
+        dab = Dab(self.dab_file, mmap=True)
+        for loss in ['hinge', 'log']:
+            svm = NetworkSVM(dab, solver='sgd', sgd_loss=loss, batch_size=8)
+            predictions = svm.predict(self.pos, self.neg, cv_folds=3)
+            self.assertEqual(len(predictions), len(self.pos | self.neg))
+            top = set(g for (g, s, p) in predictions[:len(self.pos)])
+            self.assertTrue(len(top & self.pos) >= len(self.pos) - 2)
+
+        predictions = svm.predict(self.pos, self.neg, predict_all=True,
+                                  best_params=True, cv_folds=3)
+        self.assertEqual(len(predictions), dab.get_size())
+        results = svm.predict_many({'A': (self.pos, self.neg)}, cv_folds=3)
+        self.assertEqual(set(g for (g, s, p) in results['A']), self.pos | self.neg)
+
+    def test_sparse_features(self):
+        """Test training on thresholded and top-k sparse rows"""
+        X = self.dab.get_rows(range(self.dab.get_size()))
+        X_sparse = sparse_features(self.dab, threshold=.5, block_size=7)
+        numpy.testing.assert_array_equal(X_sparse.toarray(), numpy.where(X > .5, X, 0))
+
+        X_sparse = sparse_features(self.dab, top_k=5, background='mean')
+        self.assertEqual(list(X_sparse.getnnz(axis=1)), [5] * self.dab.get_size())
+        self.assertAlmostEqual(X_sparse[0].max(), 1 - X[numpy.triu_indices(len(X), 1)].mean(),
+                               places=4)
+
+        # Cached kernels of dense and differently thresholded rows differ
+        keys = set(NetworkSVM(self.dab, X_all=X_all)._kernel_key([])
+                   for X_all in [None, X_sparse,
+                                 sparse_features(self.dab, threshold=.5)])
+        self.assertEqual(len(keys), 3)
+
+        for kwargs in [{}, {'kernel': 'precomputed'}, {'solver': 'sgd'}]:
+            svm = NetworkSVM(self.dab, X_all=X_sparse, **kwargs)
+            predictions = svm.predict(self.pos, self.neg, predict_all=True,
+                                      cv_folds=3)
+            self.assertEqual(len(predictions), self.dab.get_size())
+            # Top genes are from the module, labeled or not
+            module = set(self.dab.gene_list[:15])
+            top = set(g for (g, s, p) in predictions[:len(self.pos)])
+            self.assertTrue(len(top & module) >= len(self.pos) - 2, kwargs)
+
+    def test_parallel_folds(self):
+        """Test folds trained in parallel reproduce sequential training"""
+        expected = NetworkSVM(self.dab).predict(self.pos, self.neg, cv_folds=3)
+        for backend in ['threading', 'loky']:
+            svm = NetworkSVM(self.dab, n_jobs=2, backend=backend)
+            self.assertPredictionsEqual(
+                svm.predict(self.pos, self.neg, cv_folds=3), expected)
+        svm = NetworkSVM(self.dab, n_jobs=2)
+        predictions = svm.predict(self.pos, self.neg, cv_folds=3, best_params=True)
+        self.assertEqual(len(predictions), len(self.pos | self.neg))
+
+    def test_param_path(self):
+        """Test the regularization path picks parameters from the grid and
+        caches them"""
+        cache = self.tmp_dir + '/params'
+        os.mkdir(cache)
+        svm = NetworkSVM(self.dab, param_cache=cache)
+        predictions = svm.predict(self.pos, self.neg, cv_folds=3, best_params=True)
+        self.assertEqual(len(predictions), len(self.pos | self.neg))
+
+        cached = os.listdir(cache)
+        self.assertEqual(len(cached), 1)
+        params = json.load(open(cache + '/' + cached[0]))
+        grid = NetworkSVM.tuned_parameters[0]
+        self.assertTrue(params['C'] in grid['C'])
+        self.assertTrue(params['class_weight'] in grid['class_weight'])
+
+        # Reruns skip the search
+        svm = NetworkSVM(self.dab, param_cache=cache)
+        svm._path_params = None
+        svm.predict(self.pos, self.neg, cv_folds=3, best_params=True)
+        self.assertEqual(os.listdir(cache), cached)
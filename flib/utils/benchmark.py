@@ -0,0 +1,47 @@
+import time
+
+import numpy as np
+from sklearn import metrics
+
+from flib.core.dab import write_dab
+
+
+def synthetic_modules(filename, size, modules, within=.3, between=.2,
+                      noise=.2, seed=0):
+    """Write a network of randomly assigned modules of more densely connected
+    genes.
+
+    Returns:
+        (gene list, list of module gene sets)
+    """
+    rng = np.random.RandomState(seed)
+    genes = ['G%i' % i for i in range(size)]
+    membership = rng.randint(0, modules, size=size)
+    iu, ju = np.triu_indices(size, 1)
+    means = np.where(membership[iu] == membership[ju], within, between)
+    values = np.clip(rng.normal(means, noise), 0, 1).astype(np.float32)
+    write_dab(filename, genes, values)
+    sets = [set(g for g, m in zip(genes, membership) if m == module)
+            for module in range(modules)]
+    return genes, sets
+
+
+def term_labels(genes, module, n_neg, rng):
+    """Return the module genes as positives with a random sample of n_neg
+    other genes as negatives"""
+    others = [g for g in genes if g not in module]
+    neg = set(rng.choice(others, size=min(n_neg, len(others)), replace=False))
+    return module, neg
+
+
+def run(svm, label_sets):
+    """Return the mean cross-validated AUPRC over terms and the total
+    training time"""
+    start = time.time()
+    auprcs = []
+    for term, (pos, neg) in sorted(label_sets.items()):
+        predictions = svm.predict(pos, neg, cv_folds=3)
+        y = [1 if g in pos else 0 for (g, s, p) in predictions]
+        auprcs.append(metrics.average_precision_score(
+            y, [s for (g, s, p) in predictions]))
+    return np.mean(auprcs), time.time() - start
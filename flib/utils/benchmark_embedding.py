@@ -0,0 +1,65 @@
+from __future__ import print_function
+
+import argparse
+import shutil
+import tempfile
+import time
+
+import logging
+logging.basicConfig()
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+import numpy as np
+
+from flib.core.dab import Dab
+from flib.core.embedding import load_embedding
+from flib.core.svm import NetworkSVM, write_matrix
+from flib.utils.benchmark import synthetic_modules, term_labels, run
+
+
+parser = argparse.ArgumentParser(
+    description='Compare SVMs trained on network rows and on low rank '
+                'embeddings of a synthetic network')
+parser.add_argument('--genes', '-n', dest='genes', type=int,
+                    default=3000,
+                    help='Number of genes')
+parser.add_argument('--modules', '-m', dest='modules', type=int,
+                    default=30,
+                    help='Number of modules (one term each)')
+parser.add_argument('--terms', '-t', dest='terms', type=int,
+                    default=10,
+                    help='Number of terms trained')
+parser.add_argument('--negatives', dest='negatives', type=int,
+                    default=500,
+                    help='Number of negative genes per term')
+parser.add_argument('--ranks', '-k', dest='ranks', type=int, nargs='+',
+                    default=[25, 50, 100],
+                    help='Embedding ranks')
+args = parser.parse_args()
+
+tmp_dir = tempfile.mkdtemp()
+try:
+    dab_file = tmp_dir + '/net.dab'
+    genes, modules = synthetic_modules(dab_file, args.genes, args.modules)
+    dab = Dab(dab_file, mmap=True)
+
+    rng = np.random.RandomState(0)
+    label_sets = dict((i, term_labels(genes, modules[i], args.negatives, rng))
+                      for i in range(args.terms))
+
+    start = time.time()
+    X_all = write_matrix(dab, tmp_dir + '/net.npy')
+    setup = time.time() - start
+    auprc, seconds = run(NetworkSVM(dab, X_all=X_all), label_sets)
+    print('features\tdims\tsetup_s\ttrain_s\tauprc')
+    print('rows\t%i\t%.2f\t%.2f\t%.4f' % (X_all.shape[1], setup, seconds, auprc))
+
+    for k in args.ranks:
+        start = time.time()
+        E = load_embedding(dab, k)
+        setup = time.time() - start
+        auprc, seconds = run(NetworkSVM(dab, X_all=E), label_sets)
+        print('emb%i\t%i\t%.2f\t%.2f\t%.4f' % (k, k, setup, seconds, auprc))
+finally:
+    shutil.rmtree(tmp_dir)
@@ -0,0 +1,186 @@
+from __future__ import print_function
+
+import argparse
+import os
+import shutil
+import tempfile
+import time
+import tracemalloc
+
+import logging
+logging.basicConfig()
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+import numpy as np
+
+from flib.core.obo import OBO
+
+NAMESPACES = ['biological_process', 'molecular_function', 'cellular_component']
+RELATIONSHIPS = ['part_of', 'regulates', 'positively_regulates',
+                 'negatively_regulates', 'has_part']
+
+
+def synthetic_obo(filename, terms, seed=0):
+    """Write a Gene Ontology-like obo of terms terms, each with a name,
+    definition, synonyms and cross references.
+
+    The terms of each namespace form a binary tree (about 15 levels for GO's
+    size), and terms take extra is_a and relationship parents among the
+    siblings of their tree parent, so ancestor sets stay as narrow as GO's.
+    """
+    rng = np.random.RandomState(seed)
+    words = ['word%i' % i for i in range(2000)]
+    obsolete = rng.rand(terms) < .02
+    obsolete[:3] = False
+
+    def text(n):
+        return ' '.join(words[i] for i in rng.randint(len(words), size=n))
+
+    def parent(t, offset=0):
+        # Term of the namespace of t at tree position offset from its parent
+        i, namespace = divmod(t, 3)
+        p = (i - 1) // 2 + offset
+        if p < 0 or int(np.log2(p + 1)) != int(np.log2((i - 1) // 2 + 1)):
+            p = (i - 1) // 2
+        while obsolete[3 * p + namespace]:
+            p = (p - 1) // 2
+        return 3 * p + namespace
+
+    with open(filename, 'w') as f:
+        f.write('format-version: 1.2\ndata-version: releases/synthetic\n')
+        for i in range(40):
+            f.write('subsetdef: subset%i "Subset %i"\n' % (i, i))
+        f.write('ontology: go\n\n')
+        for t in range(terms):
+            f.write('[Term]\nid: GO:%07i\nname: %s\nnamespace: %s\n' % (
+                t, text(rng.randint(2, 8)), NAMESPACES[t % 3]))
+            if rng.rand() < .1:
+                f.write('alt_id: GO:%07i\n' % (terms + t))
+            f.write('def: "%s." [GOC:synthetic]\n' % text(rng.randint(10, 40)))
+            for _ in range(rng.poisson(2)):
+                f.write('synonym: "%s" EXACT []\n' % text(rng.randint(2, 6)))
+            for _ in range(rng.poisson(1)):
+                f.write('xref: Reactome:R-HSA-%i\n' % rng.randint(1e6))
+            if obsolete[t]:
+                f.write('is_obsolete: true\n\n')
+                continue
+            if t >= 3:
+                parents = set(parent(t, o) for o in range(rng.randint(1, 3)))
+                for p in sorted(parents):
+                    f.write('is_a: GO:%07i ! %s\n' % (p, text(3)))
+                if rng.rand() < .3:
+                    f.write('relationship: %s GO:%07i ! %s\n' % (
+                        RELATIONSHIPS[rng.randint(len(RELATIONSHIPS))],
+                        parent(t, rng.randint(-2, 3)), text(3)))
+            f.write('\n')
+        f.write('[Typedef]\nid: part_of\nname: part of\n\n')
+
+
+def synthetic_gaf(filename, obo, annotations, genes=20000, seed=0):
+    """Write a GAF of annotations direct annotations of random genes to
+    random current terms of obo"""
+    rng = np.random.RandomState(seed)
+    terms = sorted(obo.go_terms)
+    with open(filename, 'w') as f:
+        f.write('!gaf-version: 2.1\n')
+        for _ in range(annotations):
+            gene = rng.randint(genes)
+            f.write('\t'.join(['UniProtKB', 'P%05i' % gene, 'G%i' % gene, '',
+                                terms[rng.randint(len(terms))],
+                                'PMID:%i' % rng.randint(annotations // 10),
+                                'IDA', '', 'P', '', '', 'protein',
+                                'taxon:9606', '20170713', 'UniProt']) + '\n')
+
+
+parser = argparse.ArgumentParser(
+    description='Time loading an obo file, its peak memory use and the '
+                'propagation of gene annotations')
+parser.add_argument('--obo', dest='obo',
+                    help='obo file (default: a synthetic GO-sized ontology)')
+parser.add_argument('--terms', '-t', dest='terms', type=int,
+                    default=47000,
+                    help='Number of synthetic terms')
+parser.add_argument('--gaf', dest='gaf',
+                    help='GAF annotation file (default: synthetic annotations)')
+parser.add_argument('--annotations', '-a', dest='annotations', type=int,
+                    default=100000,
+                    help='Number of synthetic annotations')
+parser.add_argument('--repeats', '-r', dest='repeats', type=int,
+                    default=3,
+                    help='Number of timed loads')
+parser.add_argument('--compact', '-c', dest='compact', action='store_true',
+                    default=False,
+                    help='Propagate compact (bitset) annotations')
+args = parser.parse_args()
+
+tmp_dir = tempfile.mkdtemp()
+try:
+    obo_file = args.obo
+    if obo_file is None:
+        obo_file = os.path.join(tmp_dir, 'synthetic.obo')
+        synthetic_obo(obo_file, args.terms)
+    size = os.path.getsize(obo_file) / 2.**20
+
+    times = []
+    for _ in range(args.repeats):
+        start = time.time()
+        obo = OBO(obo_file)
+        times.append(time.time() - start)
+        del obo
+
+    tracemalloc.start()
+    obo = OBO(obo_file)
+    peak = tracemalloc.get_traced_memory()[1] / 2.**20
+    tracemalloc.stop()
+
+    print('%s: %.1f MB, %i terms, %i obsolete' % (
+        obo_file, size, len(obo.go_terms), len(obo.go_obsolete)))
+    print('Parse %.2fs (best of %i), peak traced memory %.1f MB' % (
+        min(times), args.repeats, peak))
+
+    cache_dir = os.path.join(tmp_dir, 'cache')
+    OBO().load_obo_cached(obo_file, cache_dir)
+    cache_times = []
+    for _ in range(args.repeats):
+        start = time.time()
+        OBO().load_obo_cached(obo_file, cache_dir)
+        cache_times.append(time.time() - start)
+    print('Cached load %.2fs (best of %i), cache %.1f MB' % (
+        min(cache_times), args.repeats,
+        sum(os.path.getsize(os.path.join(cache_dir, f))
+            for f in os.listdir(cache_dir)) / 2.**20))
+
+    gaf_file = args.gaf
+    if gaf_file is None:
+        gaf_file = os.path.join(tmp_dir, 'synthetic.gaf')
+        synthetic_gaf(gaf_file, obo, args.annotations)
+
+    def propagate(obo):
+        # Populate and propagate obo, returning its direct annotation
+        # count and the propagation time
+        obo.populate_annotations(gaf_file, gene_col=1, term_col=4)
+        direct = sum(t.get_annotation_size() for t in obo.go_terms.values())
+        start = time.time()
+        obo.propagate()
+        return direct, time.time() - start
+
+    obo = OBO(obo_file, compact=args.compact)
+    direct, seconds = propagate(obo)
+    print('Propagate %i direct to %i %s in %.2fs' % (
+        direct, sum(t.get_annotation_size() for t in obo.go_terms.values()),
+        'genes' if args.compact else 'annotations', seconds))
+    del obo
+
+    # Memory held by the fully propagated ontology
+    tracemalloc.start()
+    obo = OBO(obo_file, compact=args.compact)
+    parsed = tracemalloc.get_traced_memory()[0] / 2.**20
+    propagate(obo)
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print('Propagated ontology %.1f MB traced, %.1f MB of it annotations, '
+          'peak %.1f MB' % (current / 2.**20, current / 2.**20 - parsed,
+                            peak / 2.**20))
+finally:
+    shutil.rmtree(tmp_dir)
@@ -0,0 +1,71 @@
+from __future__ import print_function
+
+import argparse
+import shutil
+import tempfile
+import time
+
+import logging
+logging.basicConfig()
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+import numpy as np
+
+from flib.core.dab import Dab
+from flib.core.svm import NetworkSVM, write_matrix, sparse_features
+from flib.utils.benchmark import synthetic_modules, term_labels, run
+
+parser = argparse.ArgumentParser(
+    description='Compare SVMs trained on dense and sparsified rows of a '
+                'synthetic network')
+parser.add_argument('--genes', '-n', dest='genes', type=int,
+                    default=3000,
+                    help='Number of genes')
+parser.add_argument('--modules', '-m', dest='modules', type=int,
+                    default=30,
+                    help='Number of modules (one term each)')
+parser.add_argument('--terms', '-t', dest='terms', type=int,
+                    default=10,
+                    help='Number of terms trained')
+parser.add_argument('--negatives', dest='negatives', type=int,
+                    default=500,
+                    help='Number of negative genes per term')
+parser.add_argument('--thresholds', dest='thresholds', type=float, nargs='+',
+                    default=[0, .1, .2, .3],
+                    help='Thresholds above the mean edge value')
+parser.add_argument('--top-k', '-k', dest='top_k', type=int, nargs='+',
+                    default=[50, 100, 300],
+                    help='Edges kept per row')
+args = parser.parse_args()
+
+tmp_dir = tempfile.mkdtemp()
+try:
+    dab_file = tmp_dir + '/net.dab'
+    genes, modules = synthetic_modules(dab_file, args.genes, args.modules)
+    dab = Dab(dab_file, mmap=True)
+
+    rng = np.random.RandomState(0)
+    label_sets = dict((i, term_labels(genes, modules[i], args.negatives, rng))
+                      for i in range(args.terms))
+
+    print('features\tnnz_per_row\tsetup_s\ttrain_s\tauprc')
+    start = time.time()
+    X_all = write_matrix(dab, tmp_dir + '/net.npy')
+    setup = time.time() - start
+    auprc, seconds = run(NetworkSVM(dab, X_all=X_all), label_sets)
+    print('dense\t%i\t%.2f\t%.2f\t%.4f' % (X_all.shape[1], setup, seconds, auprc))
+
+    configs = [('threshold=%g' % t, {'threshold': t, 'background': 'mean'})
+               for t in args.thresholds]
+    configs += [('top_k=%i' % k, {'top_k': k, 'background': 'mean'})
+                for k in args.top_k]
+    for name, kwargs in configs:
+        start = time.time()
+        X_sparse = sparse_features(dab, **kwargs)
+        setup = time.time() - start
+        auprc, seconds = run(NetworkSVM(dab, X_all=X_sparse), label_sets)
+        print('%s\t%.1f\t%.2f\t%.2f\t%.4f' % (
+            name, X_sparse.nnz / X_sparse.shape[0], setup, seconds, auprc))
+finally:
+    shutil.rmtree(tmp_dir)
@@ -0,0 +1,41 @@
+import argparse
+import json
+import sys
+
+import logging
+logging.basicConfig()
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+from flib.core.dab import Dab
+from flib.core.compare import compare_dabs
+
+parser = argparse.ArgumentParser(
+    description='Compare two networks and print a JSON report')
+parser.add_argument('old', type=str,
+                    help='Previous dab file')
+parser.add_argument('new', type=str,
+                    help='New dab file')
+parser.add_argument('--output', '-o', dest='output', type=str,
+                    help='Output JSON file (default: stdout)')
+parser.add_argument('--top', '-n', dest='top', type=int,
+                    default=100,
+                    help='Number of largest changed edges to report')
+parser.add_argument('--block-size', '-b', dest='block_size', type=int,
+                    default=500,
+                    help='Number of network rows compared at once')
+args = parser.parse_args()
+
+old = Dab(args.old, mmap=True)
+new = Dab(args.new, mmap=True)
+
+report = compare_dabs(old, new, block_size=args.block_size, top=args.top)
+report['old'] = args.old
+report['new'] = args.new
+
+if args.output:
+    with open(args.output, 'w') as outfile:
+        json.dump(report, outfile, indent=2, sort_keys=True)
+else:
+    json.dump(report, sys.stdout, indent=2, sort_keys=True)
+    sys.stdout.write('\n')
@@ -3,7 +3,7 @@ from flib.core.entrez import Entrez
 from flib.core.hgmd import HGMD
 from flib.core.omim import OMIM
 from flib.core.gwas import GWASCatalog
-from flib.core.onto import DiseaseOntology
+from flib.core.onto import DiseaseOntology, CACHE_DIR
 
 parser = argparse.ArgumentParser(
     description='Generate a file of updated disease gene annotations')
@@ -17,6 +17,10 @@ parser.add_argument('--databases', '-d', dest='databases',
                     default=['HGMD', 'OMIM'],
                     nargs='*',
                     help='list of disease databases')
+parser.add_argument('--obo-cache', dest='obo_cache', type=str,
+                    default=CACHE_DIR,
+                    help='Directory to cache parsed ontologies in, empty to '
+                         'disable (default: %(default)s)')
 
 args = parser.parse_args()
 
@@ -26,7 +30,7 @@ dbs = set(args.databases)
 entrez_map = Entrez()
 entrez_map.load()
 
-do = DiseaseOntology.generate()
+do = DiseaseOntology.generate(cache_dir=args.obo_cache)
 
 if 'HGMD' in dbs:
     # Load HGMD annotations
@@ -1,38 +1,56 @@
+from __future__ import print_function
+
 import sys
-import os
-import math
-import numpy as np
-import string
 from optparse import OptionParser
-from collections import defaultdict
 
-from sklearn.metrics import roc_auc_score, average_precision_score
+from flib.core.evaluation import evaluate_directory, compare_directories, \
+    metric_columns, write_summary, COMPARE_COLUMNS
 
 usage = "usage: %prog [options]"
 parser = OptionParser(usage, version="%prog dev-unreleased")
 parser.add_option("-d", "--dir", dest="dir",
-                  help="svmperf directory", metavar="FILE")
+                  help="predictions directory (one file per term or a "
+                       "prediction store)", metavar="FILE")
+parser.add_option("-o", "--output", dest="output",
+                  help="summary table file (default: stdout)", metavar="FILE")
+parser.add_option("-p", "--processes", dest="processes", type="int",
+                  default=1,
+                  help="number of worker processes")
+parser.add_option("-k", dest="ks", type="int", action="append",
+                  help="precision at the top k genes (repeatable, "
+                       "default: 10 and 50)")
+parser.add_option("--fdr", dest="fdrs", type="float", action="append",
+                  help="recall at a false discovery rate (repeatable, "
+                       "default: 0.1)")
+
+parser.add_option("-b", "--bootstrap", dest="bootstrap", type="int",
+                  default=0,
+                  help="add AUROC and AUPRC confidence intervals from this "
+                       "many bootstrap resamples per term")
+parser.add_option("-c", "--compare", dest="compare",
+                  help="compare the predictions in --dir (a) with those in "
+                       "this directory (b) by paired bootstrap", metavar="FILE")
+parser.add_option("-s", "--seed", dest="seed", type="int",
+                  default=0,
+                  help="bootstrap random seed")
 
 (options, args) = parser.parse_args()
 
-files = os.listdir(options.dir)
-files.sort()
-
-for f in files:
-    labels, scores, probs = [], [], []
-
-    for l in open(options.dir + '/' + f):
-        gene, status, val = l.strip().split('\t')[0:3]
-        prob = val
-        if status != '0':
-            if status == '1':
-                labels.append(True)
-            elif status == '-1':
-                labels.append(False)
-            scores.append(float(val))
-            probs.append(float(prob))
-
-    labels, scores, probs = np.array(labels), np.array(scores), np.array(probs)
-
-    print f, average_precision_score(labels, scores), roc_auc_score(labels, scores), \
-        average_precision_score(labels, probs), roc_auc_score(labels, probs)
+ks = tuple(options.ks or (10, 50))
+fdrs = tuple(options.fdrs or (0.1,))
+
+out_file = open(options.output, 'w') if options.output else sys.stdout
+if options.compare:
+    results = compare_directories(options.dir, options.compare,
+                                  processes=options.processes,
+                                  n_boot=options.bootstrap or 1000,
+                                  seed=options.seed)
+    write_summary(results, out_file, columns=COMPARE_COLUMNS)
+else:
+    results = evaluate_directory(options.dir, processes=options.processes,
+                                 ks=ks, fdrs=fdrs, n_boot=options.bootstrap,
+                                 seed=options.seed)
+    write_summary(results, out_file,
+                  columns=metric_columns(ks, fdrs, bootstrap=options.bootstrap > 0))
+if options.output:
+    out_file.close()
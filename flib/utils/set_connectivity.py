@@ -0,0 +1,58 @@
+import argparse
+import sys
+
+import logging
+logging.basicConfig()
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+from flib.core.dab import Dab
+from flib.core.gmt import GMT
+from flib.core.connectivity import SetConnectivity
+
+parser = argparse.ArgumentParser(
+    description='Score gene sets by their connectivity in a network')
+parser.add_argument('--input', '-i', dest='input', type=str,
+                    required=True,
+                    help='Input dab file')
+parser.add_argument('--gmt', '-g', dest='gmt', type=str,
+                    required=True,
+                    help='Input GMT (geneset) file')
+parser.add_argument('--output', '-o', dest='output', type=str,
+                    help='Output file (default: stdout)')
+parser.add_argument('--permutations', '-n', dest='permutations', type=int,
+                    default=1000,
+                    help='Number of random gene sets per set size')
+parser.add_argument('--min-size', dest='min_size', type=int,
+                    default=5,
+                    help='Minimum number of set genes in the network')
+parser.add_argument('--max-size', dest='max_size', type=int,
+                    default=500,
+                    help='Maximum number of set genes in the network')
+parser.add_argument('--background', '-b', dest='background',
+                    choices=['dab', 'gmt'],
+                    default='dab',
+                    help='Draw random sets from all network genes (dab) or '
+                         'from the network genes annotated in the GMT (gmt)')
+parser.add_argument('--threads', '-t', dest='threads', type=int,
+                    default=12,
+                    help='Number of processes')
+parser.add_argument('--seed', '-s', dest='seed', type=int,
+                    default=0,
+                    help='Random seed')
+args = parser.parse_args()
+
+gmt = GMT(filename=args.gmt)
+dab = Dab(args.input)
+
+conn = SetConnectivity(dab)
+conn.score(gmt, n_perm=args.permutations,
+           min_size=args.min_size, max_size=args.max_size,
+           background=args.background, processes=args.threads,
+           seed=args.seed)
+
+if args.output:
+    with open(args.output, 'w') as outfile:
+        conn.print_scores(outfile, setnames=gmt.setnames)
+else:
+    conn.print_scores(sys.stdout, setnames=gmt.setnames)
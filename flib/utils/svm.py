@@ -1,23 +1,34 @@
 import argparse
+import atexit
+import os
+import sys
+import tempfile
+import time
 
 import logging
 logging.basicConfig()
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
 
-from multiprocessing import Pool
+import numpy as np
 
 from flib.core.dab import Dab
 from flib.core.gmt import GMT
 from flib.core.omim import OMIM
-from flib.core.onto import Ontology, DiseaseOntology, GeneOntology
+from flib.core.onto import Ontology, DiseaseOntology, GeneOntology, CACHE_DIR
 from flib.core.labels import OntoLabels, Labels
-from flib.core.svm import NetworkSVM
+from flib.core.svm import NetworkSVM, write_matrix, write_predictions, \
+    sparse_features
+from flib.core.embedding import load_embedding, embedding_file
+from flib.core.predictions import PredictionStore
+from flib.core.metrics import StageMetrics, METRICS_FILE
+from flib.core.manifest import RunManifest, file_signature, input_hash
+from flib.core.scheduler import TermScheduler, estimate_costs
+from flib.core.shards import ShardPlan, parse_shard, merge_shards
 
 parser = argparse.ArgumentParser(
     description='Generate a file of updated disease gene annotations')
 parser.add_argument('--input', '-i', dest='input', type=str,
-                    required=True,
                     help='Input dab file')
 parser.add_argument('--output', '-o', dest='output', type=str,
                                 required=True,
@@ -37,64 +48,345 @@ parser.add_argument('--threads', '-t', dest='threads', type=int,
 parser.add_argument('--best-params', '-b', dest='best_params', action='store_true',
                     default=False,
                     help='Select best parameters by cross validation')
+parser.add_argument('--batch', dest='batch', action='store_true',
+                    default=False,
+                    help='Train all terms against one shared feature matrix '
+                         'and fold assignment (labels are built up front)')
+parser.add_argument('--param-search', dest='param_search',
+                    choices=['path', 'grid'],
+                    default='path',
+                    help='Parameter selection for --best-params: warm-started '
+                         'regularization path or exhaustive grid search')
+parser.add_argument('--param-cache', dest='param_cache', type=str,
+                    help='Directory to cache selected parameters in')
+parser.add_argument('--cv-jobs', dest='cv_jobs', type=int,
+                    default=1,
+                    help='Number of workers for the folds (and parameter '
+                         'search) of each term')
+parser.add_argument('--cv-backend', dest='cv_backend',
+                    choices=['threading', 'loky'],
+                    default='threading',
+                    help='Run fold workers as threads or processes')
+parser.add_argument('--solver', dest='solver',
+                    choices=['liblinear', 'sgd'],
+                    default='liblinear',
+                    help='Fit LinearSVC on the training rows (liblinear) or '
+                         'stream mini-batches of rows from the dab through SGD '
+                         '(sgd, linear kernel only)')
+parser.add_argument('--sgd-loss', dest='sgd_loss',
+                    choices=['hinge', 'log'],
+                    default='hinge',
+                    help='Loss of the sgd solver')
+parser.add_argument('--epochs', dest='epochs', type=int,
+                    default=5,
+                    help='Passes over the training genes of the sgd solver')
+parser.add_argument('--kernel', '-k', dest='kernel',
+                    choices=['linear', 'precomputed'],
+                    default='linear',
+                    help='Train on network rows (linear) or on a Gram matrix '
+                         'computed once for all genes (precomputed)')
+parser.add_argument('--kernel-cache', dest='kernel_cache', type=str,
+                    help='Directory to cache Gram matrices in')
+parser.add_argument('--matrix', '-m', dest='matrix', type=str,
+                    help='Network matrix file (.npy) shared by the workers; '
+                         'written if missing or older than the dab file '
+                         '(default: a temporary file)')
+parser.add_argument('--embedding', '-e', dest='embedding', type=int,
+                    help='Train on a rank k embedding of the network instead '
+                         'of its rows (stored next to the dab file)')
+parser.add_argument('--sparse', dest='sparse', action='store_true',
+                    default=False,
+                    help='Train on sparse network rows keeping only edges '
+                         'above --threshold and/or the --top-k of each row')
+parser.add_argument('--threshold', dest='threshold', type=float,
+                    help='Sparse rows: keep edges above this value (after '
+                         '--background subtraction)')
+parser.add_argument('--top-k', dest='top_k', type=int,
+                    help='Sparse rows: keep the largest edges of each row')
+parser.add_argument('--background', dest='background',
+                    help="Sparse rows: value subtracted from every edge, or "
+                         "'mean' for the mean edge value")
+parser.add_argument('--store', dest='store', action='store_true',
+                    default=False,
+                    help='Write predictions to a binary prediction store in '
+                         'the output directory instead of a file per term')
+parser.add_argument('--metrics', dest='metrics', type=str,
+                    help='JSON-lines file of per-stage time and memory records '
+                         '(default: ' + METRICS_FILE + ' in the output directory)')
 parser.add_argument('--ontology', '-y', dest='ontology',
                     choices=['GO', 'DO'],
                     default='DO',
                     nargs=1,
                     help='Ontology to use for propagation')
+parser.add_argument('--obo-cache', dest='obo_cache', type=str,
+                    default=CACHE_DIR,
+                    help='Directory to cache parsed ontologies in, empty to '
+                         'disable (default: %(default)s)')
+parser.add_argument('--shard', dest='shard', type=str,
+                    help='Run shard i/N (from 0) of the terms, balanced by '
+                         'estimated cost, writing to shard-i in the output '
+                         'directory (shared by all nodes)')
+parser.add_argument('--steal', dest='steal', action='store_true',
+                    default=False,
+                    help='With --shard, run unclaimed terms of other shards '
+                         'once this shard is done')
+parser.add_argument('--merge', dest='merge', action='store_true',
+                    default=False,
+                    help='Merge the shard outputs into the output directory, '
+                         'report missing or duplicated terms and exit')
+parser.add_argument('--status', dest='status', action='store_true',
+                    default=False,
+                    help='Report the progress of the run writing to the output '
+                         'directory and exit')
 args = parser.parse_args()
 
+if args.merge:
+    report = merge_shards(args.output)
+    print('Merged %i of %i terms' % (report['merged'], report['terms']))
+    for term in report['missing']:
+        print('Missing\t' + term)
+    for term, shards in sorted(report['duplicated'].items()):
+        print('Duplicated\t%s\t%s' % (term, ','.join(str(s) for s in shards)))
+    sys.exit(1 if report['missing'] else 0)
+
+# Each shard keeps its outputs, manifest and metrics in its own directory
+run_dir = args.output
+if args.shard:
+    (shard, shard_count) = parse_shard(args.shard)
+    plan = ShardPlan(args.output)
+    run_dir = plan.shard_dir(shard)
+
+manifest = RunManifest(run_dir)
+
+if args.status:
+    status = manifest.status()
+    if status is None:
+        sys.stderr.write('No run recorded in ' + run_dir + '\n')
+        sys.exit(1)
+    eta = status['eta']
+    print('%i/%i terms done (%i this run), %i remaining, elapsed %.0fs, ETA %s' % (
+        status['done'], status['terms'], status['done_this_run'],
+        status['remaining'], status['elapsed'],
+        '%.0fs' % eta if eta is not None else 'unknown'))
+    sys.exit()
+
+if not args.input:
+    parser.error('--input is required')
+
 MIN_POS, MAX_POS = 5, 500
 
-if args.ontology == 'DO':
-    onto = DiseaseOntology.generate()
-elif args.ontology == 'GO':
-    onto = GeneOntology.generate()
-else:
-    onto = Ontology.generate()
-
-if args.gmt:
-    # Load GMT genes onto Disease Ontology and propagate
-    gmt = GMT(filename=args.gmt)
-    onto.populate_annotations_from_gmt(gmt)
-    onto.propagate()
-
-    # Filter terms by number of gene annotations
-    terms = [term.go_id for term in onto.get_termobject_list()
-             if len(term.annotations) >= MIN_POS and len(term.annotations) <= MAX_POS]
-
-    if args.slim:
-        # Build ontology aware labels
-        lines = open(args.slim).readlines()
-        slim_terms = set([l.strip() for l in lines])
-        labels = OntoLabels(obo=onto, slim_terms=slim_terms)
+metrics = StageMetrics(args.metrics or os.path.join(run_dir, METRICS_FILE))
+# Ontology, annotations and labels
+with metrics.stage('setup'):
+    if args.ontology == 'DO':
+        onto = DiseaseOntology.generate(cache_dir=args.obo_cache)
+    elif args.ontology == 'GO':
+        onto = GeneOntology.generate(cache_dir=args.obo_cache)
     else:
-        labels = Labels(gmt=gmt)
+        onto = Ontology.generate(cache_dir=args.obo_cache)
 
-elif args.dir:
-    labels = Labels(labels_dir=args.dir)
-    terms = [term for term in labels.get_terms()
-             if len(labels.get_labels(term)[0]) >= MIN_POS and
-             len(labels.get_labels(term)[0]) <= MAX_POS]
-else:
-    logger.error('Insufficient options to proceed. \
-            Please provide a GMT file or a directory of labels')
-    exit()
+    if args.gmt:
+        # Load GMT genes onto Disease Ontology and propagate
+        gmt = GMT(filename=args.gmt)
+        onto.populate_annotations_from_gmt(gmt)
+        onto.propagate()
+
+        # Filter terms by number of gene annotations
+        terms = [term.go_id for term in onto.get_termobject_list()
+                 if len(term.annotations) >= MIN_POS and len(term.annotations) <= MAX_POS]
+
+        if args.slim:
+            # Build ontology aware labels
+            lines = open(args.slim).readlines()
+            slim_terms = set([l.strip() for l in lines])
+            labels = OntoLabels(obo=onto, slim_terms=slim_terms)
+        else:
+            labels = Labels(gmt=gmt)
+
+    elif args.dir:
+        labels = Labels(labels_dir=args.dir)
+        terms = [term for term in labels.get_terms()
+                 if len(labels.get_labels(term)[0]) >= MIN_POS and
+                 len(labels.get_labels(term)[0]) <= MAX_POS]
+    else:
+        logger.error('Insufficient options to proceed. \
+                Please provide a GMT file or a directory of labels')
+        exit()
 
-dab = Dab(args.input)
-svm = NetworkSVM(dab)
+with metrics.stage('load_dab'):
+    # The sgd solver reads rows on demand, so the network stays on disk
+    dab = Dab(args.input, mmap=args.solver == 'sgd')
 
+def remove_file(filename):
+    """Remove filename if it still exists"""
+    if os.path.exists(filename):
+        os.remove(filename)
 
-def run_svm(term):
-    (pos, neg) = labels.get_labels(term)
 
+# Materialize the network once; forked workers slice the shared memmap
+# instead of each building their own copy
+# Description of the features for the kernel and parameter cache keys
+features = None
+with metrics.stage('matrix'):
+    if args.embedding:
+        X_all = load_embedding(dab, args.embedding)
+        features = {'embedding': args.embedding,
+                    'file': os.path.realpath(embedding_file(dab, args.embedding))}
+    elif args.sparse:
+        background = args.background
+        if background is not None and background != 'mean':
+            background = float(background)
+        X_all = sparse_features(dab, threshold=args.threshold, top_k=args.top_k,
+                                background=background)
+        features = {'sparse': {'threshold': args.threshold,
+                               'top_k': args.top_k,
+                               'background': background}}
+    elif args.solver == 'sgd' and not args.matrix:
+        X_all = None
+    elif args.matrix:
+        X_all = None
+        if os.path.exists(args.matrix) and \
+                os.path.getmtime(args.matrix) >= os.path.getmtime(args.input):
+            X_all = np.load(args.matrix, mmap_mode='r')
+            if X_all.shape != (dab.get_size(), dab.get_size()):
+                logger.warning('Matrix %s does not match the network, '
+                               'rewriting it', args.matrix)
+                X_all = None
+        if X_all is None:
+            X_all = write_matrix(dab, args.matrix)
+    else:
+        (fd, matrix_file) = tempfile.mkstemp(suffix='.npy')
+        os.close(fd)
+        # Removed at exit, even if the run fails
+        atexit.register(remove_file, matrix_file)
+        X_all = write_matrix(dab, matrix_file)
+svm = NetworkSVM(dab, X_all=X_all, kernel=args.kernel,
+                 kernel_cache=args.kernel_cache,
+                 n_jobs=args.cv_jobs, backend=args.cv_backend,
+                 param_search=args.param_search, param_cache=args.param_cache,
+                 metrics=metrics, solver=args.solver, sgd_loss=args.sgd_loss,
+                 epochs=args.epochs, features=features)
+store = PredictionStore(run_dir, genes=dab.gene_list) if args.store else None
+
+# Terms already completed with the same inputs are skipped on restart
+run_params = {'dab': file_signature(args.input),
+              'predict_all': args.predict_all,
+              'best_params': args.best_params,
+              'param_search': args.param_search,
+              'kernel': args.kernel,
+              'solver': args.solver,
+              'sgd_loss': args.sgd_loss,
+              'epochs': args.epochs,
+              'embedding': args.embedding,
+              'sparse': [args.sparse, args.threshold, args.top_k, args.background]}
+completed = manifest.completed()
+
+# Labels of the terms still to run
+label_sets, hashes, sizes = {}, {}, {}
+for term in terms:
+    metrics.set_term(term)
+    with metrics.stage('labels'):
+        (pos, neg) = labels.get_labels(term)
+    hashes[term] = input_hash(pos, neg, run_params)
+    sizes[term] = len(pos | neg)
+    if completed.get(term) == hashes[term]:
+        logger.info('Skipping completed term %s', term)
+    else:
+        label_sets[term] = (pos, neg)
+
+# Estimated cost of each term, by label size or its time in earlier runs
+costs = estimate_costs(sizes, manifest.records())
+
+if args.kernel == 'precomputed' and not args.batch:
+    # Compute the kernel of the labeled genes before forking so workers
+    # share it; genome-wide scores are computed from the features
+    with metrics.stage('kernel'):
+        svm.use_kernel(set().union(*[pos | neg
+                                     for (pos, neg) in label_sets.values()]))
+
+
+def run_svm(job):
+    (term, pos, neg, claim) = job
+    if claim and not plan.claim(term, shard):
+        # Stolen by another shard before this one reached it
+        logger.info('Skipping %s, claimed by another shard', term)
+        return term, None, 0.
+    metrics.set_term(term)
     logger.info('Running SVM for %s, %i pos, %i neg', term, len(pos), len(neg))
 
+    start = time.time()
     predictions = svm.predict(pos, neg,
                               predict_all=args.predict_all,
                               best_params=args.best_params)
-    svm.print_predictions(args.output + '/' + term, pos, neg)
+    return term, predictions, time.time() - start
+
+
+def write_term(term, predictions, seconds):
+    (pos, neg) = label_sets[term]
+    metrics.set_term(term)
+    with metrics.stage('output'):
+        if store:
+            store.append(term, predictions, pos, neg)
+        else:
+            write_predictions(run_dir + '/' + term, predictions, pos, neg)
+    manifest.record(term, hashes[term], seconds, size=len(pos | neg))
+
+
+def run_terms(selected, claim=False):
+    # With claim, terms are claimed for this shard as they start, so
+    # those not yet started stay stealable by other shards
+    if args.batch:
+        # Build features and folds once for all terms, or once per
+        # pool's worth of claimed terms
+        step = args.threads if claim else max(len(selected), 1)
+        for i in range(0, len(selected), step):
+            chunk = selected[i:i + step]
+            if claim:
+                chunk = [term for term in chunk if plan.claim(term, shard)]
+            subset = dict((term, label_sets[term]) for term in chunk)
+            start = time.time()
+            for term, predictions in svm.iter_predict_many(subset,
+                                                           predict_all=args.predict_all,
+                                                           best_params=args.best_params,
+                                                           processes=args.threads):
+                write_term(term, predictions, time.time() - start)
+                start = time.time()
+    else:
+        # Largest terms first; results are written here as workers finish
+        jobs = dict((term, (term, label_sets[term][0], label_sets[term][1], claim))
+                    for term in selected)
+        scheduler = TermScheduler(args.threads)
+        for term, predictions, seconds in scheduler.run(run_svm, jobs, costs):
+            if predictions is not None:
+                write_term(term, predictions, seconds)
+        scheduler.print_utilization()
+
+if args.shard:
+    # Every node reads the plan written by the first one
+    plan.create(costs, shard_count)
+    own = plan.shard_terms(shard)
+    manifest.start(own, run_params)
+    run_terms([term for term in own if term in label_sets], claim=True)
+
+    if args.steal:
+        # Claim unfinished terms of other shards a pool's worth at a time
+        tried = set()
+        while True:
+            stolen = []
+            for term in plan.steal_order(shard):
+                if term in tried or term not in label_sets:
+                    continue
+                tried.add(term)
+                if plan.claim(term, shard):
+                    stolen.append(term)
+                    if len(stolen) >= args.threads:
+                        break
+            if not stolen:
+                break
+            logger.info('Stealing %i terms', len(stolen))
+            run_terms(stolen)
+else:
+    manifest.start(terms, run_params)
+    run_terms(list(label_sets))
 
-pool = Pool(args.threads)
-pool.map(run_svm, terms)
-pool.close()
+metrics.print_summary()